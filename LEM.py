@@ -1,24 +1,54 @@
+import os
+import tempfile
 import torch
 from numpy import average
 import numpy as np
 from sklearn.decomposition import IncrementalPCA
 from torchvision.models.feature_extraction import get_graph_node_names, create_feature_extractor
 from tqdm import tqdm
-from scipy.stats import pearsonr as corr
-from torchvision.models import vgg19
+from sklearn.utils import gen_batches
+from torchvision.models import vgg19, VGG19_Weights
+from feature_cache import FeatureCache
+from inference import InferenceModel
 
 
-def extract_data_features(train_imgs_dataloader, val_imgs_dataloader, test_imgs_dataloader, batch_size, device = "cuda:1"):
-    vgg = vgg19(weights="DEFAULT").to(device)
+def extract_data_features(train_imgs_dataloader, val_imgs_dataloader, test_imgs_dataloader, batch_size, device = "cuda:1",
+                          cache_dir=None, single_pass=True, bfloat16=False):
+    weights = VGG19_Weights.DEFAULT
+    vgg = vgg19(weights=weights).to(device)
     vggConvFeatures = vgg.features[:35]
     model_layer = "avgpool"
 
-    feature_extractor = create_feature_extractor(vgg, return_nodes=[model_layer])
-    pca = fit_pca(feature_extractor, train_imgs_dataloader, batch_size, device)
-
-    features_train = extract_features(feature_extractor, train_imgs_dataloader, pca, device)
-    features_val = extract_features(feature_extractor, val_imgs_dataloader, pca, device)
-    features_test = extract_features(feature_extractor, test_imgs_dataloader, pca, device)
+    # VGG only runs forward: inference mode, channels_last and optionally bfloat16 autocast (inference.py)
+    feature_extractor = InferenceModel(create_feature_extractor(vgg, return_nodes=[model_layer]), device, bfloat16)
+    if cache_dir is not None:
+        # Raw activations come from the on-disk cache, the backbone only runs on images it has never seen
+        model_tag = os.path.basename(weights.url) + ('-bf16' if bfloat16 else '')
+        cache = FeatureCache(cache_dir, model_tag, model_layer)
+        raw_train = cache.features(train_imgs_dataloader, feature_extractor, device)
+        raw_val = cache.features(val_imgs_dataloader, feature_extractor, device)
+        raw_test = cache.features(test_imgs_dataloader, feature_extractor, device)
+
+        pca = fit_pca_cached(raw_train, batch_size)
+        features_train = transform_cached(raw_train, pca, batch_size)
+        features_val = transform_cached(raw_val, pca, batch_size)
+        features_test = transform_cached(raw_test, pca, batch_size)
+    elif single_pass:
+        # Spool the training activations while fitting PCA and project from the spool,
+        # so the backbone only sees the training set once
+        with tempfile.TemporaryDirectory() as spool_dir:
+            pca, spool = fit_pca_spooled(feature_extractor, train_imgs_dataloader, batch_size, device,
+                                         os.path.join(spool_dir, 'train_features.npy'))
+            features_train = transform_cached(spool, pca, batch_size)
+            del spool
+        features_val = extract_features(feature_extractor, val_imgs_dataloader, pca, device)
+        features_test = extract_features(feature_extractor, test_imgs_dataloader, pca, device)
+    else:
+        pca = fit_pca(feature_extractor, train_imgs_dataloader, batch_size, device)
+
+        features_train = extract_features(feature_extractor, train_imgs_dataloader, pca, device)
+        features_val = extract_features(feature_extractor, val_imgs_dataloader, pca, device)
+        features_test = extract_features(feature_extractor, test_imgs_dataloader, pca, device)
 
     print('\nTraining images features:')
     print(features_train.shape)
@@ -39,26 +69,54 @@ def extract_data_features(train_imgs_dataloader, val_imgs_dataloader, test_imgs_
 
 def predAccuracy(lh_fmri_val_pred, lh_fmri_val, rh_fmri_val_pred, rh_fmri_val):
     print("Start PredAccuracy")
-    print("\npredicted\n", lh_fmri_val_pred, "\nactual\n", lh_fmri_val)
-
-    # Empty correlation array of shape: (LH vertices)
-    lh_correlation = np.zeros(lh_fmri_val_pred.shape[1])
-
-    # Correlate each predicted LH vertex with the corresponding ground truth vertex
-    for v in tqdm(range(lh_fmri_val_pred.shape[1])):
-        lh_correlation[v] = corr(lh_fmri_val_pred[:, v], lh_fmri_val[:, v])[0]
+    print("\npredicted\n", lh_fmri_val_pred, "\nactual\n", np.shape(lh_fmri_val))
 
-    # Empty correlation array of shape: (RH vertices)
-    rh_correlation = np.zeros(rh_fmri_val_pred.shape[1])
+    # Correlate each predicted vertex with the corresponding ground truth vertex, both hemispheres in one call
+    lh_correlation, rh_correlation = vertex_correlation([lh_fmri_val_pred, rh_fmri_val_pred],
+                                                        [lh_fmri_val, rh_fmri_val])
 
-    # Correlate each predicted RH vertex with the corresponding ground truth vertex
-    for v in tqdm(range(rh_fmri_val_pred.shape[1])):
-        rh_correlation[v] = corr(rh_fmri_val_pred[:, v], rh_fmri_val[:, v])[0]
-        
     print('average lh ', average(lh_correlation) * 100, 'average rh ', average(rh_correlation) * 100)
     return lh_correlation, rh_correlation
 
 
+def vertex_correlation(preds, actuals, chunk_size=4096):
+    # Pearson's r of every column of all pred/actual pairs (e.g. LH and RH) in one pass over their vertices,
+    # split back into one array per pair. Same values as scipy's pearsonr per vertex
+    correlation = column_correlation(preds, actuals, chunk_size)
+    return np.split(correlation, np.cumsum([np.shape(pred)[1] for pred in preds])[:-1])
+
+
+def column_correlation(preds, actuals, chunk_size=4096):
+    # preds/actuals are one (images x vertices) array or lists of them whose vertices are correlated as one run
+    if not isinstance(preds, (list, tuple)):
+        preds, actuals = [preds], [actuals]
+    preds, actuals = [np.asarray(pred) for pred in preds], [np.asarray(actual) for actual in actuals]
+    correlation = np.empty(sum(pred.shape[1] for pred in preds))
+    blocks = [(pred, actual, start) for pred, actual in zip(preds, actuals) for start in range(0, pred.shape[1], chunk_size)]
+    offset = 0
+    # Work through blocks of vertices so the centered float64 copies stay small. Each block is copied
+    # vertex-major (vertices x images) so every vertex is a contiguous row
+    for pred, actual, start in blocks:
+        end = start + chunk_size
+        p = np.array(pred[:, start:end].T, dtype=np.float64, order='C')
+        a = np.array(actual[:, start:end].T, dtype=np.float64, order='C')
+        # Constant columns have no correlation, pearsonr returns NaN for them too
+        constant = (p.max(axis=1) == p.min(axis=1)) | (a.max(axis=1) == a.min(axis=1))
+        p -= p.mean(axis=1, keepdims=True)
+        a -= a.mean(axis=1, keepdims=True)
+        # Constant columns are divided by 1 instead of their zero norm, they are set to NaN below
+        for centered in (p, a):
+            norm = np.sqrt(np.einsum('ij,ij->i', centered, centered))
+            norm[constant] = 1
+            centered /= norm[:, None]
+        # One dot product of two contiguous rows per vertex
+        r = np.einsum('ij,ij->i', p, a)
+        r[constant] = np.nan
+        correlation[offset:offset + len(r)] = np.clip(r, -1, 1)
+        offset += len(r)
+    return correlation
+
+
 
 def extract_features(feature_extractor, dataloader, pca, device):
     features = []
@@ -93,3 +151,49 @@ def fit_pca(feature_extractor, dataloader, batch_size, device):
         # Fit PCA to batch
         pca.partial_fit(ft.detach().cpu().numpy())
     return pca
+
+
+def fit_pca_spooled(feature_extractor, dataloader, batch_size, device, spool_path):
+    if len(dataloader.dataset) == 0:
+        raise ValueError("no training images to fit PCA on")
+    pca = IncrementalPCA(batch_size=batch_size)
+    spool = None
+    row = 0
+    # Rows not fitted yet. Like fit_pca_cached, PCA is fitted batch_size rows at a time and a short last batch is
+    # folded into the one before it, so partial_fit never sees fewer samples than components
+    pending = None
+    for _, d in tqdm(enumerate(dataloader), total=len(dataloader), desc="PCA"):
+        # Send to tensor to device
+        d = d.to(device)
+        # Extract features
+        ft = feature_extractor(d)
+        # Flatten the features
+        ft = torch.hstack([torch.flatten(l, start_dim=1) for l in ft.values()])
+        ft = ft.detach().cpu().numpy()
+        # Fit PCA to full batches, holding the last one back until it is known whether a short one follows
+        pending = ft if pending is None else np.concatenate([pending, ft])
+        while len(pending) >= 2 * batch_size:
+            pca.partial_fit(pending[:batch_size])
+            pending = pending[batch_size:]
+        # Keep the flattened activations on disk for the transform pass
+        if spool is None:
+            spool = np.lib.format.open_memmap(spool_path, mode='w+', dtype=np.float32,
+                                              shape=(len(dataloader.dataset), ft.shape[1]))
+        spool[row:row + len(ft)] = ft
+        row += len(ft)
+    pca.partial_fit(pending)
+    spool.flush()
+    return pca, spool
+
+
+def fit_pca_cached(raw_features, batch_size):
+    pca = IncrementalPCA(batch_size=batch_size)
+    # min_batch_size folds a short last batch into the previous one so partial_fit never sees too few samples
+    for batch in tqdm(list(gen_batches(len(raw_features), batch_size, min_batch_size=batch_size)), desc="PCA"):
+        pca.partial_fit(raw_features[batch])
+    return pca
+
+
+def transform_cached(raw_features, pca, batch_size):
+    features = [pca.transform(raw_features[batch]) for batch in gen_batches(len(raw_features), batch_size)]
+    return np.vstack(features)
@@ -0,0 +1,88 @@
+# Object categories of the encoding models: the category list (one-hot columns of data.design_matrix) and the
+# YOLO class name -> category mapping make_classifications uses. Plain data, so importing it loads no models
+words = ['furniture', 'food', 'kitchenware', 'appliance', 'person', 'animal', 'vehicle', 'accessory',
+         'electronics', 'sports', 'traffic', 'outdoor', 'home', 'clothing', 'hygiene', 'toy', 'plumbing',
+         'safety', 'luggage', 'computer', 'fruit', 'vegetable', 'tool']
+
+
+class_mapping = {
+    'chair': 'furniture',
+    'bowl': 'kitchenware',
+    'dining table': 'furniture',
+    'person': 'person',
+    'bird': 'animal',
+    'knife': 'kitchenware',
+    'sink': 'appliance',
+    'horse': 'animal',
+    'cake': 'food',
+    'giraffe': 'animal',
+    'car': 'vehicle',
+    'umbrella': 'accessory',
+    'refrigerator': 'appliance',
+    'cow': 'animal',
+    'dog': 'animal',
+    'tv': 'electronics',
+    'surfboard': 'sports',
+    'cat': 'animal',
+    'stop sign': 'traffic',
+    'train': 'vehicle',
+    'zebra': 'animal',
+    'carrot': 'vegetable',
+    'bicycle': 'vehicle',
+    'sports ball': 'sports',
+    'sheep': 'animal',
+    'motorcycle': 'vehicle',
+    'bottle': 'kitchenware',
+    'sandwich': 'food',
+    'clock': 'home',
+    'bear': 'animal',
+    'truck': 'vehicle',
+    'traffic light': 'traffic',
+    'cell phone': 'electronics',
+    'oven': 'appliance',
+    'cup': 'kitchenware',
+    'couch': 'furniture',
+    'airplane': 'vehicle',
+    'boat': 'vehicle',
+    'bus': 'vehicle',
+    'broccoli': 'vegetable',
+    'tennis racket': 'sports',
+    'elephant': 'animal',
+    'parking meter': 'traffic',
+    'tie': 'clothing',
+    'bed': 'furniture',
+    'toaster': 'appliance',
+    'banana': 'fruit',
+    'toothbrush': 'hygiene',
+    'kite': 'toy',
+    'skateboard': 'sports',
+    'potted plant': 'home',
+    'bench': 'outdoor',
+    'donut': 'food',
+    'spoon': 'kitchenware',
+    'toilet': 'plumbing',
+    'baseball bat': 'sports',
+    'pizza': 'food',
+    'scissors': 'tool',
+    'fire hydrant': 'outdoor',
+    'teddy bear': 'toy',
+    'remote': 'electronics',
+    'apple': 'fruit',
+    'suitcase': 'luggage',
+    'vase': 'home',
+    'skis': 'sports',
+    'hot dog': 'food',
+    'frisbee': 'toy',
+    'backpack': 'luggage',
+    'microwave': 'appliance',
+    'wine glass': 'kitchenware',
+    'snowboard': 'sports',
+    'baseball glove': 'sports',
+    'book': 'toy',
+    'orange': 'fruit',
+    'fork': 'kitchenware',
+    'laptop': 'electronics',
+    'handbag': 'accessory',
+    'keyboard': 'computer',
+    'mouse': 'computer'
+}
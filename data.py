@@ -1,74 +1,105 @@
 import os
-import random
+import json
+import hashlib
 import pandas as pd
 import torchvision.transforms as transforms
 import numpy as np
 from pathlib import Path
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import Dataset
 from PIL import Image
 from numpy.linalg import norm
 from sklearn.metrics import mean_squared_error, mean_absolute_error
+from image_store import ImageStore
+from fmri import MappedFMRI
+from categories import words
+from loaders import make_loader
 
 
-def splitdata(train_img_list, test_img_list, train_img_dir):
-    rand_seed = random.randint(0, 100)
-    np.random.seed(rand_seed)
+def image_list_hash(img_list):
+    return hashlib.sha1('\n'.join(img_list).encode()).hexdigest()
 
-    # Calculate how many stimulus images correspond to 90% of the training data
-    num_train = int(np.round(len(train_img_list) / 100 * 90))
 
-    # Shuffle all training stimulus images
-    idxs = np.arange(len(train_img_list))
-    np.random.shuffle(idxs)
+def splitdata(train_img_list, test_img_list, train_img_dir=None, seed=0, manifest_path=None):
+    # Only file names are used, images are never opened. With manifest_path the split is
+    # reloaded when the image lists and seed match, and written for later runs otherwise.
+    train_hash, test_hash = image_list_hash(train_img_list), image_list_hash(test_img_list)
+    manifest = load_split_manifest(manifest_path) if manifest_path and os.path.exists(manifest_path) else None
+    if manifest is not None and manifest['seed'] == seed and manifest['train_hash'] == train_hash \
+            and manifest['test_hash'] == test_hash:
+        idxs_train, idxs_val, idxs_test = manifest['idxs_train'], manifest['idxs_val'], manifest['idxs_test']
+    else:
+        # Calculate how many stimulus images correspond to 90% of the training data
+        num_train = int(np.round(len(train_img_list) / 100 * 90))
 
-    # Assign 90% of the shuffled stimulus images to the training partition, and 10% to the test partition
-    idxs_train, idxs_val = idxs[:num_train], idxs[num_train:]
+        # Shuffle all training stimulus images
+        idxs = np.random.RandomState(seed).permutation(len(train_img_list))
 
-    # No need to shuffle or split the test stimulus images
-    idxs_test = np.arange(len(test_img_list))
+        # Assign 90% of the shuffled stimulus images to the training partition, and 10% to the test partition
+        idxs_train, idxs_val = idxs[:num_train], idxs[num_train:]
+
+        # No need to shuffle or split the test stimulus images
+        idxs_test = np.arange(len(test_img_list))
+
+        if manifest_path:
+            save_split_manifest(manifest_path, seed, train_hash, test_hash, idxs_train, idxs_val, idxs_test)
 
-    val_img_list = []
-    for i in idxs_train:
-        img_dir = os.path.join(train_img_dir, train_img_list[i])
-        train_img = Image.open(img_dir).convert('RGB')
-        # print(train_img)
-        val_img_list.append(train_img)
     print('Training stimulus images: ' + format(len(idxs_train)))
     print('\nValidation stimulus images: ' + format(len(idxs_val)))
     print('\nTest stimulus images: ' + format(len(idxs_test)))
     return idxs_train, idxs_val, idxs_test
 
 
-def transformData(train_img_dir, test_img_dir, idxs_train, idxs_val, idxs_test, batch_size):
+def save_split_manifest(manifest_path, seed, train_hash, test_hash, idxs_train, idxs_val, idxs_test):
+    manifest = {
+        'seed': seed,
+        'train_hash': train_hash,
+        'test_hash': test_hash,
+        'idxs_train': np.asarray(idxs_train).tolist(),
+        'idxs_val': np.asarray(idxs_val).tolist(),
+        'idxs_test': np.asarray(idxs_test).tolist(),
+    }
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def load_split_manifest(manifest_path):
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    for key in ['idxs_train', 'idxs_val', 'idxs_test']:
+        manifest[key] = np.array(manifest[key], dtype=int)
+    return manifest
+
+
+def transformData(train_img_dir, test_img_dir, idxs_train, idxs_val, idxs_test, batch_size, image_store_dir=None):
     transform = transforms.Compose([
         transforms.Resize((224, 224)),  # resize the images to 224x24 pixels
         transforms.ToTensor(),  # convert the images to a PyTorch tensor
         transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])  # normalize the images color channels
     ])
+    train_store, test_store = None, None
+    if image_store_dir is not None:
+        # Images in the store are already decoded and resized, only normalization is left
+        transform = transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+        train_store = ImageStore(image_store_dir, 'training', 224)
+        test_store = ImageStore(image_store_dir, 'test', 224)
     # Get the paths of all image files
     train_imgs_paths = sorted(list(Path(train_img_dir).iterdir()))
     test_imgs_paths = sorted(list(Path(test_img_dir).iterdir()))
 
-    # The DataLoaders contain the ImageDataset class
-    train_imgs_dataloader = DataLoader(
-        ImageDataset(train_imgs_paths, idxs_train, transform),
-        batch_size=batch_size
-    )
-    val_imgs_dataloader = DataLoader(
-        ImageDataset(train_imgs_paths, idxs_val, transform),
-        batch_size=batch_size
-    )
-    test_imgs_dataloader = DataLoader(
-        ImageDataset(test_imgs_paths, idxs_test, transform),
-        batch_size=batch_size
-    )
+    # The DataLoaders contain the ImageDataset class, worker settings come from loaders.LOADER_CONFIG
+    train_imgs_dataloader = make_loader(ImageDataset(train_imgs_paths, idxs_train, transform, train_store), batch_size)
+    val_imgs_dataloader = make_loader(ImageDataset(train_imgs_paths, idxs_val, transform, train_store), batch_size)
+    test_imgs_dataloader = make_loader(ImageDataset(test_imgs_paths, idxs_test, transform, test_store), batch_size)
     return train_imgs_dataloader, val_imgs_dataloader, test_imgs_dataloader
 
 
 class ImageDataset(Dataset):
-    def __init__(self, imgs_paths, idxs, transform):
+    def __init__(self, imgs_paths, idxs, transform, image_store=None):
         self.imgs_paths = np.array(imgs_paths)[idxs]
         self.transform = transform
+        self.image_store = image_store
 
     def __len__(self):
         return len(self.imgs_paths)
@@ -76,7 +107,10 @@ class ImageDataset(Dataset):
     def __getitem__(self, idx):
         # Load the image
         img_path = self.imgs_paths[idx]
-        img = Image.open(img_path).convert('RGB')
+        if self.image_store is not None:
+            img = self.image_store.tensor(img_path)
+        else:
+            img = Image.open(img_path).convert('RGB')
         if self.transform:
             img = self.transform(img)
         return img
@@ -84,6 +118,12 @@ class ImageDataset(Dataset):
 
 def normalize_fmri_data(data):
     clip_percentile = 0.05
+    if isinstance(data, MappedFMRI):
+        # Memory mapped fMRI is never loaded whole: the clip range is found in chunks of rows and the returned
+        # MappedFMRI clips and scales rows as they are read. After clipping the min and max are the clip values
+        min_value, max_value = clip_range(data, clip_percentile)
+        return data.normalized(min_value, max_value), min_value, max_value
+
     # Clip extreme values to handle outliers
     min_clip = np.percentile(data, clip_percentile)
     max_clip = np.percentile(data, 100 - clip_percentile)
@@ -102,6 +142,39 @@ def normalize_fmri_data(data):
     return normalized_data, min_value, max_value
 
 
+def clip_range(data, clip_percentile, chunk_size=256):
+    # np.percentile(data, clip_percentile) and np.percentile(data, 100 - clip_percentile) (linear interpolation)
+    # from chunks of rows. Only the smallest and largest values that can still be one of the two order statistics
+    # each percentile interpolates between are kept, a clip_percentile fraction of the data
+    num_values = int(np.prod(data.shape))
+    low_position = clip_percentile / 100 * (num_values - 1)
+    high_position = (100 - clip_percentile) / 100 * (num_values - 1)
+    num_low = min(int(np.floor(low_position)) + 2, num_values)
+    num_high = num_values - int(np.floor(high_position))
+    low, high = np.empty(0, dtype=data.dtype), np.empty(0, dtype=data.dtype)
+    for start in range(0, len(data), chunk_size):
+        chunk = np.asarray(data[start:start + chunk_size]).ravel()
+        low = np.concatenate([low, smallest(chunk, num_low)])
+        low = smallest(low, num_low)
+        high = np.concatenate([high, -smallest(-chunk, num_high)])
+        high = -smallest(-high, num_high)
+    low, high = np.sort(low).astype(np.float64), np.sort(high).astype(np.float64)
+    return interpolate_sorted(low, low_position, 0), interpolate_sorted(high, high_position, num_values - num_high)
+
+
+def interpolate_sorted(values, position, first):
+    # Linear interpolation at position of sorted values whose first entry is the order statistic at index first
+    below = int(np.floor(position)) - first
+    above = min(below + 1, len(values) - 1)
+    return values[below] + (position - np.floor(position)) * (values[above] - values[below])
+
+
+def smallest(values, count):
+    if len(values) <= count:
+        return values
+    return np.partition(values, count - 1)[:count]
+
+
 def unnormalize_fmri_data(normalized_data, min_value, max_value, clip_percentile=0.05):
     # Reverse the normalization process
     unnormalized_data = normalized_data * (max_value - min_value) + min_value
@@ -123,30 +196,36 @@ def makeList(train_img_dir, train_img_list, idxs_val):
     return val_img_list
 
 
-def organize_input(classifications, image_data, fmri_data):
-    results = []
-    fmri = []
-    index = 0
-
-    for j in enumerate(classifications):
-        # Image NUM
-        arr = []
-        arr.append((j[1][0]))
-        arr.append((j[1][1]))
-        arr = list(arr)
-        # print(arr)
-
-        # Image Data
-        arr0 = (np.array(image_data[index])).tolist()
-        # print(arr0)
-        new_list = arr + arr0
-        results.append(new_list)
+def design_matrix(classifications, image_data, one_hot=False, num_categories=None, out=None):
+    # One contiguous float32 (images x columns) matrix filled with whole-column copies, no per-image lists.
+    # Columns are [YOLO class id, category (index in words)] + features, or with one_hot the category as
+    # num_categories indicator columns (all zero when nothing was detected, id -1) + features.
+    # out can be a preallocated (e.g. memory mapped) matrix of the right shape to fill instead.
+    classifications = np.asarray(classifications)
+    image_data = np.asarray(image_data)
+    num_images = len(classifications)
+    if one_hot:
+        if num_categories is None:
+            num_categories = len(words)
+        num_ids = num_categories
+    else:
+        num_ids = 2
+    if out is None:
+        out = np.empty((num_images, num_ids + image_data.shape[1]), dtype=np.float32)
+    if one_hot:
+        out[:, :num_ids] = 0
+        found = np.flatnonzero(classifications[:, 1] >= 0)
+        out[found, classifications[found, 1]] = 1
+    else:
+        out[:, :2] = classifications[:, :2]
+    out[:, num_ids:] = image_data[:num_images]
+    return out
 
-        # FMRI Data
-        fmri.append(np.array(fmri_data[index]))
-        index = index + 1
 
-    return results, fmri
+def organize_input(classifications, image_data, fmri_data, one_hot=False, num_categories=None):
+    # Design matrix of the images (design_matrix) and their fMRI rows. The fMRI comes back as a view of
+    # fmri_data (an array, memory map or MappedFMRI), nothing is copied row by row
+    return design_matrix(classifications, image_data, one_hot, num_categories), fmri_data[:len(classifications)]
 
 def analyze_results(val_fmri, val_pred):
    
@@ -0,0 +1,126 @@
+import json
+import os
+import uuid
+from collections import namedtuple
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+from tqdm import tqdm
+from ultralytics import YOLO
+from feature_cache import image_key, read_index, write_index
+
+# Boxes of one image: normalized corners (k, 4), class ids (k,) and confidences (k,)
+Detections = namedtuple('Detections', ['xyxyn', 'cls', 'conf'])
+
+detectors = {}
+
+
+# YOLO is frozen everywhere in this repo, so every caller in a process shares one loaded model
+def load_detector(weights='yolov8n.pt', device=None):
+    key = (weights, str(device))
+    if key not in detectors:
+        detector = YOLO(weights)
+        if device is not None:
+            detector.to(device)
+        detectors[key] = detector
+    return detectors[key]
+
+
+# Persistent per-image YOLO detections, one directory per weights file, input size and preprocessing.
+# preprocess='resize' feeds YOLO the way the gradCam models always did (stretched Resize to imgsz x imgsz,
+# ToTensor), preprocess='letterbox' hands YOLO the image files like words.make_classifications always did
+# (YOLO letterboxes them at their own aspect ratio). The two give different boxes and confidences, so they
+# are stored apart. Each shard is an (M, 6) float32 array of [x1, y1, x2, y2, conf, cls] rows and the
+# index maps an image key to its [shard, start, end] rows.
+PREPROCESSING = ('resize', 'letterbox')
+
+
+class DetectionStore:
+    def __init__(self, store_dir, weights='yolov8n.pt', device=None, imgsz=640, hash_images=False, preprocess='resize'):
+        if preprocess not in PREPROCESSING:
+            raise ValueError(f"preprocess must be one of {PREPROCESSING}, not {preprocess!r}")
+        # Resize stores keep their original directory name so existing stores stay valid
+        suffix = f'{imgsz}' if preprocess == 'resize' else f'{imgsz}-{preprocess}'
+        self.store_dir = os.path.join(store_dir, f'{os.path.splitext(os.path.basename(weights))[0]}-{suffix}')
+        self.index_path = os.path.join(self.store_dir, 'index.json')
+        self.names_path = os.path.join(self.store_dir, 'names.json')
+        self.weights = weights
+        self.device = device
+        self.imgsz = imgsz
+        self.preprocess = preprocess
+        self.hash_images = hash_images
+        self.transform = transforms.Compose([
+            transforms.Resize((imgsz, imgsz)),
+            transforms.ToTensor()
+        ])
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.index = read_index(self.index_path)
+        self.keys = {}
+        self.loaded = {}
+        self.shards = {}
+
+    # class id -> COCO class name, saved next to the detections so readers never need the model
+    @property
+    def names(self):
+        if not os.path.exists(self.names_path):
+            names = load_detector(self.weights, self.device).names
+            with open(self.names_path, 'w') as f:
+                json.dump({str(cls): name for cls, name in names.items()}, f)
+        with open(self.names_path) as f:
+            return {int(cls): name for cls, name in json.load(f).items()}
+
+    def image_key(self, img_path):
+        img_path = str(img_path)
+        if img_path not in self.keys:
+            self.keys[img_path] = image_key(img_path, self.hash_images)
+        return self.keys[img_path]
+
+    def detections(self, img_paths, batch_size=64):
+        keys = [self.image_key(img_path) for img_path in img_paths]
+        missing = {}
+        for img_path, key in zip(img_paths, keys):
+            if key not in self.index:
+                missing[key] = img_path
+        if missing:
+            self.detect(list(missing.values()), list(missing.keys()), batch_size)
+        return [self.read(key) for key in keys]
+
+    def detect(self, img_paths, keys, batch_size):
+        detector = load_detector(self.weights, self.device)
+        rows = []
+        spans = []
+        count = 0
+        for start in tqdm(range(0, len(img_paths), batch_size), desc="Detecting Objects"):
+            batch_paths = img_paths[start:start + batch_size]
+            if self.preprocess == 'letterbox':
+                results = detector.predict([str(img_path) for img_path in batch_paths], imgsz=self.imgsz, verbose=False)
+            else:
+                batch = [self.transform(Image.open(img_path).convert('RGB')) for img_path in batch_paths]
+                results = detector.predict(torch.stack(batch), verbose=False)
+            for result in results:
+                boxes = result.boxes
+                data = torch.hstack((boxes.xyxyn, boxes.conf.reshape(-1, 1), boxes.cls.reshape(-1, 1)))
+                rows.append(data.cpu().numpy().astype(np.float32))
+                spans.append((count, count + len(data)))
+                count += len(data)
+        name = 'shard-' + uuid.uuid4().hex + '.npy'
+        tmp_path = os.path.join(self.store_dir, name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.vstack(rows) if count else np.zeros((0, 6), dtype=np.float32))
+        os.replace(tmp_path, os.path.join(self.store_dir, name))
+        for key, (begin, end) in zip(keys, spans):
+            self.index[key] = [name, begin, end]
+        self.index = write_index(self.index_path, self.index)
+
+    def read(self, key):
+        if key not in self.loaded:
+            name, begin, end = self.index[key]
+            data = torch.from_numpy(np.array(self.shard(name)[begin:end]))
+            self.loaded[key] = Detections(data[:, :4], data[:, 5].long(), data[:, 4])
+        return self.loaded[key]
+
+    def shard(self, name):
+        if name not in self.shards:
+            self.shards[name] = np.load(os.path.join(self.store_dir, name), mmap_mode='r')
+        return self.shards[name]
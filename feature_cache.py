@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import uuid
+import numpy as np
+import torch
+from torch.utils.data import Subset
+from tqdm import tqdm
+from loaders import make_loader
+
+
+def image_key(img_path, hash_images=False):
+    # Content hash of the file, or a cheaper hash of its absolute path, size and modification time
+    if hash_images:
+        digest = hashlib.sha1()
+        with open(img_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    stat = os.stat(img_path)
+    key = f'{os.path.abspath(img_path)}:{stat.st_size}:{stat.st_mtime_ns}'
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def read_index(index_path):
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def write_index(index_path, index):
+    # Merge with whatever another process wrote meanwhile, then swap the file in atomically
+    merged = read_index(index_path)
+    merged.update(index)
+    tmp_path = index_path + '.' + uuid.uuid4().hex + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(merged, f)
+    os.replace(tmp_path, index_path)
+    return merged
+
+
+# On-disk store of backbone activations, one directory per (model weights, layer).
+# Every image is keyed by its path + stat (or its content hash) and points at a row in a .npy shard,
+# so features extracted once are reused by any later run, split or entry point.
+class FeatureCache:
+    def __init__(self, cache_dir, model_tag, layer, hash_images=False):
+        self.cache_dir = os.path.join(cache_dir, model_tag, layer)
+        self.index_path = os.path.join(self.cache_dir, 'index.json')
+        self.hash_images = hash_images
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.index = read_index(self.index_path)
+        self.shards = {}
+
+    def image_key(self, img_path):
+        return image_key(img_path, self.hash_images)
+
+    def shard(self, name):
+        # Shards are opened read-only as memory maps, nothing is read until rows are touched
+        if name not in self.shards:
+            self.shards[name] = np.load(os.path.join(self.cache_dir, name), mmap_mode='r')
+        return self.shards[name]
+
+    def features(self, dataloader, feature_extractor, device):
+        # dataloader must iterate its ImageDataset in order (no shuffling)
+        dataset = dataloader.dataset
+        keys = [self.image_key(img_path) for img_path in dataset.imgs_paths]
+        missing = [i for i, key in enumerate(keys) if key not in self.index]
+        if missing:
+            self.extract(dataloader, missing, [keys[i] for i in missing], feature_extractor, device)
+        return self.gather(keys)
+
+    def extract(self, dataloader, idxs, keys, feature_extractor, device):
+        loader = make_loader(Subset(dataloader.dataset, idxs), dataloader.batch_size)
+        name = 'shard-' + uuid.uuid4().hex + '.npy'
+        tmp_path = os.path.join(self.cache_dir, name + '.tmp')
+        shard = None
+        row = 0
+        with torch.no_grad():
+            for d in tqdm(loader, total=len(loader), desc="Caching Features"):
+                ft = feature_extractor(d.to(device))
+                ft = torch.hstack([torch.flatten(l, start_dim=1) for l in ft.values()])
+                ft = ft.cpu().numpy()
+                if shard is None:
+                    shard = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                                      shape=(len(idxs), ft.shape[1]))
+                shard[row:row + len(ft)] = ft
+                row += len(ft)
+        shard.flush()
+        del shard
+        os.replace(tmp_path, os.path.join(self.cache_dir, name))
+        for i, key in enumerate(keys):
+            self.index[key] = [name, i]
+        self.index = write_index(self.index_path, self.index)
+
+    def gather(self, keys):
+        names = [self.index[key][0] for key in keys]
+        rows = np.array([self.index[key][1] for key in keys])
+        # Common case of a repeat run: one shard, contiguous rows -> zero-copy memmap view
+        if len(set(names)) == 1 and np.array_equal(rows, np.arange(rows[0], rows[0] + len(rows))):
+            return self.shard(names[0])[rows[0]:rows[0] + len(rows)]
+        names = np.array(names)
+        features = None
+        for name in np.unique(names):
+            shard = self.shard(name)
+            if features is None:
+                features = np.empty((len(keys), shard.shape[1]), dtype=shard.dtype)
+            positions = np.where(names == name)[0]
+            features[positions] = shard[rows[positions]]
+        return features
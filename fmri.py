@@ -0,0 +1,104 @@
+import os
+import uuid
+import numpy as np
+
+
+# Training fMRI of one hemisphere opened as a read-only memory map. Indexing with a row gives a
+# zero-copy view of that row, indexing with a slice or an index array gives another MappedFMRI over
+# the same file, and np.asarray() reads the selected rows into memory only when a caller needs them.
+# Pickling (e.g. into DataLoader workers) sends the file name and indices, never the data.
+# normalized() gives the same rows clipped and scaled to [0, 1] as they are read (data.normalize_fmri_data).
+class MappedFMRI:
+    def __init__(self, fmri_file, idxs=None, value_range=None):
+        self.fmri_file = fmri_file
+        self.fmri = np.load(fmri_file, mmap_mode='r')
+        self.idxs = np.arange(len(self.fmri)) if idxs is None else np.asarray(idxs)
+        self.value_range = value_range
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['fmri'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.fmri = np.load(self.fmri_file, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.idxs)
+
+    @property
+    def shape(self):
+        return (len(self.idxs),) + self.fmri.shape[1:]
+
+    @property
+    def dtype(self):
+        return self.fmri.dtype if self.value_range is None else np.dtype(np.float32)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, tuple):
+            rows, cols = idx[0], idx[1:]
+            if isinstance(rows, (int, np.integer)):
+                return self[rows][cols]
+            return np.asarray(self[rows])[(slice(None),) + cols]
+        if isinstance(idx, (int, np.integer)):
+            return self.scale(self.fmri[self.idxs[idx]])
+        return self.subset(self.idxs[idx])
+
+    def subset(self, idxs):
+        subset = MappedFMRI.__new__(MappedFMRI)
+        subset.fmri_file, subset.fmri, subset.idxs = self.fmri_file, self.fmri, np.asarray(idxs)
+        subset.value_range = self.value_range
+        return subset
+
+    def normalized(self, min_value, max_value):
+        normalized = self.subset(self.idxs)
+        normalized.value_range = (min_value, max_value)
+        return normalized
+
+    def scale(self, rows):
+        # Raw rows stay zero-copy views, normalized ones are computed in float32 from what was read
+        if self.value_range is None:
+            return rows
+        min_value, max_value = self.value_range
+        rows = np.clip(rows, min_value, max_value).astype(np.float32)
+        rows -= min_value
+        if max_value > min_value:
+            rows /= max_value - min_value
+        return rows
+
+    def __array__(self, dtype=None, copy=None):
+        idxs = self.idxs
+        # Contiguous selections are read as one slice of the memory map
+        if len(idxs) and np.array_equal(idxs, np.arange(idxs[0], idxs[0] + len(idxs))):
+            rows = np.array(self.fmri[idxs[0]:idxs[0] + len(idxs)])
+        else:
+            rows = self.fmri[idxs]
+        rows = self.scale(rows)
+        return rows if dtype is None else rows.astype(dtype, copy=False)
+
+
+def fmri_file(fmri_dir, hemisphere):
+    return os.path.join(fmri_dir, hemisphere[0] + 'h_training_fmri.npy')
+
+
+def load_fmri(fmri_dir, hemisphere, dtype=None):
+    # dtype (e.g. np.float16) opts into a reduced precision working copy written once next to the original
+    path = fmri_file(fmri_dir, hemisphere)
+    if dtype is not None and np.dtype(dtype) != np.load(path, mmap_mode='r').dtype:
+        path = working_copy(path, dtype)
+    return MappedFMRI(path)
+
+
+def working_copy(path, dtype, chunk_size=1024):
+    copy_path = os.path.splitext(path)[0] + '_' + np.dtype(dtype).name + '.npy'
+    if not os.path.exists(copy_path) or os.path.getmtime(copy_path) < os.path.getmtime(path):
+        fmri = np.load(path, mmap_mode='r')
+        tmp_path = copy_path + '.' + uuid.uuid4().hex + '.tmp'
+        copy = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=fmri.shape)
+        for start in range(0, len(fmri), chunk_size):
+            copy[start:start + chunk_size] = fmri[start:start + chunk_size]
+        copy.flush()
+        del copy
+        os.replace(tmp_path, copy_path)
+    return copy_path
@@ -0,0 +1,69 @@
+import os
+import threading
+import torch
+from torch.utils.data import Sampler
+
+#copies every tensor in a (nested) state to the CPU, so training can keep updating the originals
+def cpuCopy(state):
+    if torch.is_tensor(state):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {key: cpuCopy(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(cpuCopy(value) for value in state)
+    return state
+
+#only the parameters being trained (and their buffers), frozen backbones are rebuilt from their weights files
+def trainableState(model):
+    trainable = {name.rsplit(".", 1)[0] for name, param in model.named_parameters() if param.requires_grad}
+    return {name: value for name, value in model.state_dict().items() if name.rsplit(".", 1)[0] in trainable}
+
+#Checkpoints one training run to a single file. save() snapshots the state to the CPU and a background thread writes it
+#to a temporary file that replaces the checkpoint in one step, so a crash mid-write never leaves a broken checkpoint
+class AsyncCheckpointer:
+    def __init__(self, path: str):
+        self.path = path
+        self.thread = None
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+    def save(self, state: dict):
+        cpuState = cpuCopy(state)
+        #one write in flight at a time, a newer snapshot waits for the previous one
+        self.wait()
+        self.thread = threading.Thread(target=self.write, args=(cpuState,))
+        self.thread.start()
+    def write(self, state: dict):
+        #a single writer per checkpoint, so a .tmp left by a killed run is simply overwritten
+        tmpPath = self.path + ".tmp"
+        torch.save(state, tmpPath)
+        os.replace(tmpPath, self.path)
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+    def load(self):
+        self.wait()
+        if not os.path.exists(self.path):
+            return None
+        return torch.load(self.path, map_location="cpu", weights_only=False)
+    def remove(self):
+        self.wait()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+#Shuffles like shuffle = True, but from seed + epoch, so the order of an epoch can be rebuilt after a restart and
+#iteration can start part way through it (setEpoch(epoch, start))
+class ResumableSampler(Sampler):
+    def __init__(self, numSamples: int, seed: int = 0):
+        self.numSamples = numSamples
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+    def setEpoch(self, epoch: int, start: int = 0):
+        self.epoch = epoch
+        self.start = start
+    def __iter__(self):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        return iter(torch.randperm(self.numSamples, generator=generator)[self.start:].tolist())
+    def __len__(self):
+        return self.numSamples - self.start
@@ -1,16 +1,24 @@
 
 import os
+import sys
+import argparse
 from tqdm import tqdm
 
+import numpy as np
 import torch
 from torch.optim import lr_scheduler
-from torch.utils.data import DataLoader
 from torchvision.models import vgg19
 from torchvision import transforms
 
 from sklearn.model_selection import train_test_split
 from datasets import COCOImgWithLabel, BalancedCocoSuperClassDataset
 from models import CocoVGG
+from checkpoints import AsyncCheckpointer, ResumableSampler, cpuCopy
+from earlyStopping import EarlyStopping
+
+#shared data helpers live in the repo root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from loaders import make_loader
 
 class CocoVGG (torch.nn.Module):
     def __init__(self, numClasses):
@@ -44,6 +52,18 @@ class CocoVGG (torch.nn.Module):
 
 
 
+parser = argparse.ArgumentParser(description="Train CocoVGG on the COCO super classes")
+parser.add_argument("--resume", action="store_true", help="continue an interrupted run from ./checkpoints/cocoVGG.pt")
+parser.add_argument("--patience", type=int, default=3, help="epochs without a better validation loss before training stops")
+parser.add_argument("--maxEpochs", type=int, default=30, help="epoch budget")
+parser.add_argument("--minutes", type=float, default=None, help="training time budget")
+args = parser.parse_args()
+
+#the run is checkpointed every checkpointEvery batches and after every epoch
+checkpointer = AsyncCheckpointer("./checkpoints/cocoVGG.pt")
+checkpointEvery = 100
+checkpoint = checkpointer.load() if args.resume else None
+
 device = "cuda:1" if torch.cuda.is_available() else "cpu"
 subj = 1
 parentDir = "./algonauts_2023_challenge_data/"
@@ -58,13 +78,23 @@ tsfms = transforms.Compose([
 
 
 numImages = len(os.listdir(os.path.join(parentDir, f"subj0{subj}/training_split/training_images/")))
-trainIdxs, validIdxs = train_test_split(range(numImages), train_size=0.9)
-
+#a resumed run keeps the split it started with
+if checkpoint is not None:
+    trainIdxs, validIdxs = checkpoint["trainIdxs"], checkpoint["validIdxs"]
+else:
+    trainIdxs, validIdxs = train_test_split(range(numImages), train_size=0.9)
+#the split is kept next to the model so evaluation (quantization.py) uses the same held out images
+np.savez("./cocoVGGModel_split.npz", trainIdxs = np.asarray(trainIdxs), validIdxs = np.asarray(validIdxs))
+
+#training order comes from a seeded sampler so a resumed epoch sees the same batches
+batchSize = 64
 trainingDataset = BalancedCocoSuperClassDataset(parentDir, metaDataDir, idxs=trainIdxs,tsfms = tsfms)
-trainDataLoader = DataLoader(trainingDataset, batch_size = 64, shuffle = True)
+trainSampler = ResumableSampler(len(trainingDataset))
+#both loaders are iterated every epoch, so their workers are kept alive between epochs
+trainDataLoader = make_loader(trainingDataset, batchSize, sampler = trainSampler, persistent_workers = True)
 
 validDataset = BalancedCocoSuperClassDataset(parentDir, metaDataDir, idxs = validIdxs, tsfms = tsfms)
-validDataLoader = DataLoader(validDataset, batch_size = 64, shuffle = True)
+validDataLoader = make_loader(validDataset, 64, shuffle = True, persistent_workers = True)
 
 
 
@@ -76,13 +106,38 @@ optim = torch.optim.Adam(model.parameters(), learningRate, weight_decay=1e-4)#,
 criterion = torch.nn.CrossEntropyLoss()
 
 
-epochs = 30
+epochs = args.maxEpochs
 first = True
-for epoch in range(epochs):
+#stop once validation loss stops improving or the time budget runs out, the best weights are kept as they occur
+stopper = EarlyStopping(args.patience, maxSeconds = None if args.minutes is None else args.minutes * 60)
+bestParams = None
+startEpoch, startBatch, avgTrainingLoss = 0, 0, 0
+if checkpoint is not None:
+    model.load_state_dict(checkpoint["model"])
+    optim.load_state_dict(checkpoint["optim"])
+    stopper.loadStateDict(checkpoint["stopper"])
+    bestParams = checkpoint["bestParams"]
+    learningRate, first = checkpoint["learningRate"], checkpoint["first"]
+    startEpoch, startBatch, avgTrainingLoss = checkpoint["epoch"], checkpoint["batch"], checkpoint["avgTrainingLoss"]
+    print(f"Resuming at epoch {startEpoch} batch {startBatch}")
+
+#everything needed to continue from (epoch, batch)
+def runState(epoch, batch, avgTrainingLoss):
+    return {"model": model.state_dict(), "optim": optim.state_dict(), "stopper": stopper.stateDict(), "bestParams": bestParams, "learningRate": learningRate, "first": first,
+            "epoch": epoch, "batch": batch, "avgTrainingLoss": avgTrainingLoss, "trainIdxs": trainIdxs, "validIdxs": validIdxs}
+
+for epoch in range(startEpoch, epochs):
+    stopReason = stopper.shouldStop()
+    if stopReason is not None:
+        print(f"Stopping before epoch {epoch}: {stopReason}")
+        break
     print(f"Epoch {epoch}")
-    avgTrainingLoss = 0
+    batch = startBatch if epoch == startEpoch else 0
+    if batch == 0:
+        avgTrainingLoss = 0
     avgEvalLoss = 0
     numRight = 0
+    trainSampler.setEpoch(epoch, batch * batchSize)
     for data in tqdm(trainDataLoader, desc="Training", unit="batch"):  # for data in trainDataLoader: #
         img, label = data
         img = img.to(device)
@@ -94,6 +149,9 @@ for epoch in range(epochs):
         optim.step()  
         # numRight += (torch.argmax(pred, 1) == label).sum().item()
         avgTrainingLoss += loss.item()
+        batch += 1
+        if batch % checkpointEvery == 0:
+            checkpointer.save(runState(epoch, batch, avgTrainingLoss))
     model.eval()
     with torch.no_grad():
         for data in tqdm(validDataLoader, desc="Evaluating", unit="batch"): 
@@ -106,7 +164,10 @@ for epoch in range(epochs):
             evalLoss = criterion(pred, label)
             numRight += (torch.argmax(pred, 1) == label).sum().item()
             avgEvalLoss += evalLoss.item()
-    print(f"Epoch {epoch} using lr {learningRate} TrainingCE: {avgTrainingLoss / len(trainDataLoader)}, ValidCE: {avgEvalLoss / len(validDataLoader)}, ValidAcc: {numRight / len(validDataset)}, got {numRight} right")
+    print(f"Epoch {epoch} using lr {learningRate} TrainingCE: {avgTrainingLoss / batch}, ValidCE: {avgEvalLoss / len(validDataLoader)}, ValidAcc: {numRight / len(validDataset)}, got {numRight} right")
+    if stopper.step(avgEvalLoss / len(validDataLoader)):
+        print("BESTMODEL SO FAR")
+        bestParams = cpuCopy(model.state_dict())
     # learningRate = 0.0000001
     # scheduler.step()
     if first:
@@ -120,7 +181,11 @@ for epoch in range(epochs):
             g["lr"] = learningRate
             g["weight_decay"] = 1e-3
     model.train()
+    #epoch finished, a resume starts from the next one
+    checkpointer.save(runState(epoch + 1, 0, 0))
 
 
-torch.save(model.state_dict(), './cocoVGGModel.pth')
+#the saved model is the epoch with the lowest validation loss
+torch.save(bestParams if bestParams is not None else model.state_dict(), './cocoVGGModel.pth')
+checkpointer.remove()
 
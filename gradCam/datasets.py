@@ -1,4 +1,5 @@
 import os
+import sys
 import pandas as pd
 import numpy as np
 import torch
@@ -6,6 +7,12 @@ from torch.utils.data import Dataset
 from PIL import Image
 from sklearn.preprocessing import LabelEncoder
 
+#shared data helpers live in the repo root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from image_store import ImageStore
+from roi_atlas import ROIS, load_atlas
+from fmri import load_fmri, fmri_file
+
 #Gets the absolute path for each image in the subjects training images folder
 def getFileNames(parentDir: str, subj: int):
     imgsPath = f"subj0{subj}/training_split/training_images/"
@@ -43,31 +50,16 @@ def getClassImages(dataDir:str, imgDataFolerDir: str, subj: int, className: str)
     return np.array(imagesInClass), np.array(trainingIDsInClass)
 
 #Calculates the average fmri value for each ROI that has data
-def getAvgROI(parentFolderDir: str, subj: int, fmriData, hemi: str = "l"):
-    rois = np.array(["V1v", "V1d", "V2v", "V2d", "V3v", "V3d", "hV4", "EBA", "FBA-1", "FBA-2", "mTL-bodies", "OFA", "FFA-1", "FFA-2", "mTL-faces", "aTL-faces", "OPA", "PPA", "RSC", "OWFA", "VWFA-1", "VWFA-2", "mfs-words", "mTL-words", "early", "midventral", "midlateral", "midparietal", "ventral", "lateral", "parietal"])
-    avgRoiValues = np.zeros((len(fmriData), len(rois)))
-    for i in range(len(rois)):
-        roi = rois[i]
-        if roi in ["V1v", "V1d", "V2v", "V2d", "V3v", "V3d", "hV4"]:
-            roi_class = 'prf-visualrois'
-        elif roi in ["EBA", "FBA-1", "FBA-2", "mTL-bodies"]:
-            roi_class = 'floc-bodies'
-        elif roi in ["OFA", "FFA-1", "FFA-2", "mTL-faces", "aTL-faces"]:
-            roi_class = 'floc-faces'
-        elif roi in ["OPA", "PPA", "RSC"]:
-            roi_class = 'floc-places'
-        elif roi in ["OWFA", "VWFA-1", "VWFA-2", "mfs-words", "mTL-words"]:
-            roi_class = 'floc-words'
-        elif roi in ["early", "midventral", "midlateral", "midparietal", "ventral", "lateral", "parietal"]:
-            roi_class = 'streams'
-        roiMap = np.load(f"{parentFolderDir}/subj0{subj}/roi_masks/mapping_{roi_class}.npy", allow_pickle=True).item()
-        challenge_roi_class = np.load(f"{parentFolderDir}/subj0{subj}/roi_masks/{hemi}h.{roi_class}_challenge_space.npy")
-        # Select the vertices corresponding to the ROI of interest
-        roi_mapping = list(roiMap.keys())[list(roiMap.values()).index(roi)]
-        challenge_roi = np.asarray(challenge_roi_class == roi_mapping, dtype=int)
-        # print(roi_mapping)       
-        vals = fmriData[:,np.where(challenge_roi)[0]].mean(axis = 1)
-        avgRoiValues[:, i] = vals
+#When fmriData is the whole content of fmriFile the averages are cached on disk next to it
+def getAvgROI(parentFolderDir: str, subj: int, fmriData, hemi: str = "l", fmriFile: str = None):
+    rois = np.array(ROIS)
+    #masks and vertex indices of every ROI are loaded once per subject and hemisphere
+    atlas = load_atlas(os.path.join(parentFolderDir, f"subj0{subj}/roi_masks"), hemi)
+    #all ROI means in one sparse product per chunk of rows instead of copying each ROI's columns
+    if fmriFile is not None:
+        avgRoiValues = atlas.cached_roi_averages(fmriFile, fmriData, ROIS)
+    else:
+        avgRoiValues = atlas.roi_averages(fmriData, ROIS)
     mask = np.arange(len(avgRoiValues[0]))
     print(mask)
     mask = mask[~np.isnan(avgRoiValues.max(axis=0))]
@@ -77,11 +69,12 @@ def getAvgROI(parentFolderDir: str, subj: int, fmriData, hemi: str = "l"):
 #Not used
 #Creates dataset with images that belong to a single coco class
 class NSDDatasetClassSubset(Dataset):
-    def __init__(self, parentFolderDir: str, imgDataFolderDir: str, subj: int, className: str, idxs: list = None, tsfms = None):
+    def __init__(self, parentFolderDir: str, imgDataFolderDir: str, subj: int, className: str, idxs: list = None, tsfms = None, yoloTsfms = None):
         self.imgPaths, self.trainingIDs = getClassImages(parentFolderDir, imgDataFolderDir, subj, className)
-        self.lhFMRI = np.load(os.path.join(parentFolderDir, f"subj0{subj}/training_split/training_fmri/lh_training_fmri.npy"))[self.trainingIDs]
-        self.rhFMRI = np.load(os.path.join(parentFolderDir, f"subj0{subj}/training_split/training_fmri/rh_training_fmri.npy"))[self.trainingIDs]
+        self.lhFMRI = load_fmri(os.path.join(parentFolderDir, f"subj0{subj}/training_split/training_fmri/"), "left")[self.trainingIDs]
+        self.rhFMRI = load_fmri(os.path.join(parentFolderDir, f"subj0{subj}/training_split/training_fmri/"), "right")[self.trainingIDs]
         self.tsfms = tsfms
+        self.yoloTsfms = yoloTsfms
         self.lhROIs, self.lhAvgROIs = getAvgROI(parentFolderDir, subj, self.lhFMRI)
         self.rhROIs, self.rhAvgROIs = getAvgROI(parentFolderDir, subj, self.rhFMRI, "r")
         if idxs is not None:
@@ -99,22 +92,35 @@ class NSDDatasetClassSubset(Dataset):
         rh = self.rhFMRI[idx]
         lhAvg = self.lhAvgROIs[idx]
         rhAvg = self.rhAvgROIs[idx]
+        #the YOLO input comes from the same decoded image
+        yoloImg = self.yoloTsfms(img) if self.yoloTsfms else None
         if self.tsfms:
             img = self.tsfms(img)
-        return img, self.imgPaths[idx], torch.from_numpy(lh), torch.from_numpy(rh), torch.tensor(lhAvg, dtype = torch.float32), torch.tensor(rhAvg, dtype = torch.float32)
+        data = (img, self.imgPaths[idx], torch.tensor(lh, dtype=torch.float32), torch.tensor(rh, dtype=torch.float32), torch.tensor(lhAvg, dtype = torch.float32), torch.tensor(rhAvg, dtype = torch.float32))
+        return data if yoloImg is None else data + (yoloImg,)
 
 #currently using
 #Creates dataset with all training images for a specific subject 
+#imageStore (an image_store.ImageStore) replaces the PNG decode + resize, so transform should only hold tensor ops
+#yoloTransform (or a 640 yoloImageStore) adds the YOLO ready image as a 7th item so models don't reopen the image in forward
+#fMRI is memory mapped and subsets are views of it, fmriDtype (e.g. np.float16) opts into a smaller working copy
 class AlgonautsDataset(Dataset):
-    def __init__(self, parentDir: str, subj: int, dataIdxs: list = None, transform = None):
+    def __init__(self, parentDir: str, subj: int, dataIdxs: list = None, transform = None, imageStore = None, fmriDtype = None, yoloTransform = None, yoloImageStore = None):
         self.imagesPath = os.path.join(parentDir, f"subj0{subj}/training_split/training_images/")
         self.fmriPath = os.path.join(parentDir, f"subj0{subj}/training_split/training_fmri/")
         self.imagePaths = np.array(os.listdir(self.imagesPath))
-        self.lhFMRI = np.load(os.path.join(self.fmriPath, "lh_training_fmri.npy"))
-        self.rhFMRI = np.load(os.path.join(self.fmriPath, "rh_training_fmri.npy"))
-        self.lhROIs, self.lhAvgFMRI = getAvgROI(parentDir, subj, self.lhFMRI)
-        self.rhROIs, self.rhAvgFMRI = getAvgROI(parentDir, subj, self.rhFMRI, hemi="r")
+        self.lhFMRI = load_fmri(self.fmriPath, "left", fmriDtype)
+        self.rhFMRI = load_fmri(self.fmriPath, "right", fmriDtype)
+        #ROI averages always come from the original files
+        self.lhROIs, self.lhAvgFMRI = getAvgROI(parentDir, subj, load_fmri(self.fmriPath, "left"), fmriFile=fmri_file(self.fmriPath, "left"))
+        self.rhROIs, self.rhAvgFMRI = getAvgROI(parentDir, subj, load_fmri(self.fmriPath, "right"), hemi="r", fmriFile=fmri_file(self.fmriPath, "right"))
         self.transform = transform
+        self.imageStore = imageStore
+        self.yoloTransform = yoloTransform
+        self.yoloImageStore = yoloImageStore
+        #with an imageStore nothing is decoded, so the YOLO images have to come from a store too
+        if imageStore is not None and yoloTransform is not None and yoloImageStore is None:
+            raise ValueError("imageStore needs a 640 yoloImageStore for YOLO images, yoloTransform would decode every image again")
         if dataIdxs is not None:
             self.imagePaths = self.imagePaths[dataIdxs]
             self.lhFMRI = self.lhFMRI[dataIdxs]
@@ -127,12 +133,22 @@ class AlgonautsDataset(Dataset):
         if torch.is_tensor(idx):
             idx = idx.tolist()
         imagePath = os.path.join(self.imagesPath, self.imagePaths[idx])
-        image = Image.open(imagePath)
+        if self.imageStore is not None:
+            image = self.imageStore.tensor(self.imagePaths[idx])
+        else:
+            image = Image.open(imagePath)
+        #YOLO input made here in the DataLoader workers, from the 640 image store or the image decoded above
+        yoloImage = None
+        if self.yoloImageStore is not None:
+            yoloImage = self.yoloImageStore.tensor(self.imagePaths[idx])
+        elif self.yoloTransform:
+            yoloImage = self.yoloTransform(image)
         if self.transform:
             image = self.transform(image)
         lh, rh = self.lhFMRI[idx], self.rhFMRI[idx]
         avgLh, avgRh = self.lhAvgFMRI[idx], self.rhAvgFMRI[idx]
-        return image, imagePath, torch.tensor(lh, dtype=torch.float32), torch.tensor(rh, dtype=torch.float32), torch.tensor(avgLh, dtype=torch.float32), torch.tensor(avgRh, dtype=torch.float32)
+        data = (image, imagePath, torch.tensor(lh, dtype=torch.float32), torch.tensor(rh, dtype=torch.float32), torch.tensor(avgLh, dtype=torch.float32), torch.tensor(avgRh, dtype=torch.float32))
+        return data if yoloImage is None else data + (yoloImage,)
 
 #Not using
 #dataset with just image and corresponding labels
@@ -0,0 +1,45 @@
+import time
+
+#Patience based early stopping on a validation metric where lower is better (MSE, cross entropy), with an optional
+#wall clock budget. step() is called after every epoch's validation and says whether that epoch was a new best,
+#shouldStop() is asked before starting the next epoch and gives the reason to stop, or None to keep training
+class EarlyStopping:
+    def __init__(self, patience: int = 3, minDelta: float = 0.0, maxSeconds: float = None):
+        self.patience = patience
+        self.minDelta = minDelta
+        self.maxSeconds = maxSeconds
+        self.best = float("inf")
+        self.badEpochs = 0
+        #training time so far (carried over by resumes) and the length of the last epoch
+        self.elapsed = 0.0
+        self.epochSeconds = 0.0
+        self.started = time.perf_counter()
+    def step(self, metric: float):
+        now = time.perf_counter()
+        self.epochSeconds = now - self.started
+        self.elapsed += self.epochSeconds
+        self.started = now
+        #NaN never improves
+        improved = metric < self.best - self.minDelta
+        if improved:
+            self.best = metric
+            self.badEpochs = 0
+        else:
+            self.badEpochs += 1
+        return improved
+    def shouldStop(self):
+        if self.patience is not None and self.badEpochs >= self.patience:
+            return f"no improvement in {self.badEpochs} epochs (best {self.best})"
+        #don't start an epoch the budget can't fit, assuming it takes as long as the last one
+        if self.maxSeconds is not None and self.elapsed + self.epochSeconds > self.maxSeconds:
+            return f"time budget of {self.maxSeconds:.0f}s reached after {self.elapsed:.0f}s"
+        return None
+    #counters for checkpoints, the clock restarts when the state is loaded
+    def stateDict(self):
+        return {"best": self.best, "badEpochs": self.badEpochs, "elapsed": self.elapsed, "epochSeconds": self.epochSeconds}
+    def loadStateDict(self, state: dict):
+        self.best = state["best"]
+        self.badEpochs = state["badEpochs"]
+        self.elapsed = state["elapsed"]
+        self.epochSeconds = state["epochSeconds"]
+        self.started = time.perf_counter()
@@ -0,0 +1,105 @@
+import os
+import json
+import uuid
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from torchvision.models import VGG19_Weights
+from tqdm import tqdm
+from loaders import make_loader
+
+#VGG and YOLO are frozen in roiVGGYolo, so the ROI pooled (512, 7, 7) object tensors of every image never change.
+#The store keeps them flattened in one float32 file (objects.f32, shape (numObjects, 25088)) plus the offsets of
+#each image's objects, written once so training only has to run the MLP head.
+
+#Everything besides the image list the pooled objects depend on: VGG weights, where the boxes come from (detector
+#weights and how YOLO's input was made), how the images were preprocessed for VGG and bfloat16. A store is only
+#reused when all of it matches
+def storeConfig(dataset, detectionStore, yoloTsfms, bfloat16: bool = False):
+    if detectionStore is not None:
+        detector = {"weights": detectionStore.weights, "imgsz": detectionStore.imgsz, "preprocess": detectionStore.preprocess}
+    else:
+        #roiVGGYolo runs its own yolov8n.pt on the yoloTsfms images
+        detector = {"weights": "yolov8n.pt", "preprocess": repr(yoloTsfms)}
+    imageStore = getattr(dataset, "imageStore", None)
+    images = "ImageStore " + os.path.basename(imageStore.array_path) if imageStore is not None else repr(dataset.transform)
+    return {"vggWeights": os.path.basename(VGG19_Weights.DEFAULT.url), "detector": detector, "images": images, "bfloat16": bool(bfloat16)}
+
+#np.save / json.dump to a temporary file that replaces path in one step
+def replaceFile(path: str, write, mode: str = "w"):
+    tmpPath = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmpPath, mode) as f:
+        write(f)
+    os.replace(tmpPath, path)
+
+#Runs the frozen part of the model over the whole dataset (in dataset order) and writes the pooled objects.
+#meta.json is what makes a store valid: it is removed first and written last, so a crash part way through leaves
+#no store rather than new objects next to old offsets and meta
+def buildObjectFeatureStore(model, dataset, storeDir: str, device, batchSize: int = 64):
+    os.makedirs(storeDir, exist_ok=True)
+    metaPath = os.path.join(storeDir, "meta.json")
+    if os.path.exists(metaPath):
+        os.remove(metaPath)
+    config = storeConfig(dataset, model.detectionStore, model.tsfms, model.bfloat16)
+    loader = make_loader(dataset, batchSize)
+    tmpPath = os.path.join(storeDir, f"objects.f32.{uuid.uuid4().hex}.tmp")
+    offsets = [0]
+    featureSize = 0
+    with open(tmpPath, "wb") as f, torch.inference_mode():
+        for data in tqdm(loader, desc="Pooling Objects", unit="batch"):
+            img, imgPaths = data[0].to(device), data[1]
+            objects, imageIdx = model.poolObjects(img, imgPaths)
+            featureSize = objects.shape[1]
+            f.write(objects.cpu().numpy().astype(np.float32).tobytes())
+            counts = torch.bincount(imageIdx, minlength = len(imgPaths)).cpu().numpy()
+            offsets.extend((offsets[-1] + np.cumsum(counts)).tolist())
+    os.replace(tmpPath, os.path.join(storeDir, "objects.f32"))
+    replaceFile(os.path.join(storeDir, "offsets.npy"), lambda f: np.save(f, np.array(offsets, dtype=np.int64)), "wb")
+    meta = {"numObjects": offsets[-1], "featureSize": featureSize, "config": config, "imagePaths": [str(path) for path in dataset.imagePaths]}
+    replaceFile(metaPath, lambda f: json.dump(meta, f))
+    return ObjectFeatureStore(storeDir)
+
+#Read side of the store, objects are memory mapped
+class ObjectFeatureStore:
+    def __init__(self, storeDir: str):
+        self.storeDir = storeDir
+        with open(os.path.join(storeDir, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.offsets = np.load(os.path.join(storeDir, "offsets.npy"))
+        self.objects = None
+    def __len__(self):
+        return len(self.offsets) - 1
+    #store is only valid for the image list and storeConfig it was built from, with objects and offsets of the size meta records
+    def matches(self, imagePaths, config: dict):
+        objectsPath = os.path.join(self.storeDir, "objects.f32")
+        return (self.meta.get("config") == config
+                and self.meta["imagePaths"] == [str(path) for path in imagePaths]
+                and len(self.offsets) == len(imagePaths) + 1 and self.offsets[-1] == self.meta["numObjects"]
+                and os.path.exists(objectsPath) and os.path.getsize(objectsPath) == self.meta["numObjects"] * self.meta["featureSize"] * 4)
+    def getObjects(self, idx: int):
+        if self.objects is None:
+            self.objects = np.memmap(os.path.join(self.storeDir, "objects.f32"), dtype=np.float32, mode="r",
+                                     shape=(self.meta["numObjects"], self.meta["featureSize"]))
+        return torch.from_numpy(np.array(self.objects[self.offsets[idx]:self.offsets[idx + 1]]))
+    #workers reopen the memory map
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["objects"] = None
+        return state
+
+#Dataset of (pooled objects of an image, target) pairs, indexed like the dataset the store was built from
+class ObjectFeatureDataset(Dataset):
+    def __init__(self, store: ObjectFeatureStore, targets):
+        self.store = store
+        self.targets = targets
+    def __len__(self):
+        return len(self.store)
+    def __getitem__(self, idx):
+        return self.store.getObjects(idx), torch.tensor(self.targets[idx], dtype=torch.float32)
+
+#Collate function for ObjectFeatureDataset: concatenates all objects of the batch and records which image each belongs to
+def collateObjects(batch):
+    objects = torch.cat([item[0] for item in batch])
+    imageIdx = torch.repeat_interleave(torch.arange(len(batch)), torch.tensor([len(item[0]) for item in batch]))
+    targets = torch.stack([item[1] for item in batch])
+    return objects, imageIdx, targets
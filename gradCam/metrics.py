@@ -0,0 +1,36 @@
+import torch
+
+#Running sums of predictions and targets per output, kept on the device the predictions are on.
+#update() never leaves the device, so nothing waits for the GPU/CPU queue during the loop, and compute() gives
+#the exact epoch level MSE (mean over every element, like MSELoss), R2 (sklearn's r2_score(target, pred)
+#averaged over outputs) and Pearson's r (averaged over outputs) from one sync at the end
+class StreamingMetrics:
+    def __init__(self):
+        self.reset()
+    def reset(self):
+        self.count = 0
+        self.sums = None
+    def update(self, pred, target):
+        pred, target = pred.detach().double(), target.detach().double()
+        sums = torch.stack([pred.sum(0), target.sum(0), (pred * pred).sum(0), (target * target).sum(0), (pred * target).sum(0), ((pred - target) ** 2).sum(0)])
+        self.sums = sums if self.sums is None else self.sums.to(sums.device) + sums
+        self.count += len(pred)
+    #running sums for checkpoints, so an epoch can be resumed part way through
+    def stateDict(self):
+        return {"count": self.count, "sums": self.sums}
+    def loadStateDict(self, state: dict):
+        self.count = state["count"]
+        self.sums = state["sums"]
+    def compute(self):
+        if self.sums is None or self.count == 0:
+            return {"mse": float("nan"), "r2": float("nan"), "pearson": float("nan")}
+        n = self.count
+        sumPred, sumTarget, sumPredSq, sumTargetSq, sumPredTarget, sumSqErr = self.sums
+        targetVar = sumTargetSq - sumTarget ** 2 / n
+        predVar = sumPredSq - sumPred ** 2 / n
+        cov = sumPredTarget - sumPred * sumTarget / n
+        #outputs with constant targets score 1 when predicted exactly and 0 otherwise, like sklearn
+        r2 = torch.where(targetVar > 0, 1 - sumSqErr / targetVar.clamp(min=torch.finfo(torch.float64).tiny), (sumSqErr == 0).double())
+        pearson = cov / torch.sqrt(predVar * targetVar)
+        results = torch.stack([sumSqErr.sum() / sumSqErr.numel() / n, r2.mean(), pearson.nanmean()]).tolist()
+        return {"mse": results[0], "r2": results[1], "pearson": results[2]}
@@ -72,6 +72,26 @@ class roiVGG(torch.nn.Module):
     def __repr__(self):
         return ""
 
+#ROI pool the boxes of every image of the batch with that image's own conv features in a single roi_pool call
+#returns the flattened objects (num objects, 25088) and the index of the image each object came from
+def poolBatchObjects(convFeatures, boundingBoxDataAllImages):
+    objectROIPools = ops.roi_pool(convFeatures, boundingBoxDataAllImages, output_size = (7,7)) #output shape (num objects, 512, 7, 7)
+    numObjects = torch.tensor([len(boundingBoxData) for boundingBoxData in boundingBoxDataAllImages], device=convFeatures.device)
+    imageIdx = torch.repeat_interleave(torch.arange(len(boundingBoxDataAllImages), device=convFeatures.device), numObjects)
+    return torch.flatten(objectROIPools, start_dim=1), imageIdx
+
+#run a frozen VGG feature extractor without autograd, on channels_last input and optionally under bfloat16 autocast
+#returns float32 features so the trained head and roi_pool see the same dtype either way
+def frozenConvFeatures(vggConvFeatures, img, bfloat16: bool = False):
+    with torch.no_grad(), torch.autocast(img.device.type, dtype=torch.bfloat16, enabled=bfloat16):
+        return vggConvFeatures(img.contiguous(memory_format=torch.channels_last)).float()
+
+#sum the partial fmri predictions of each image's objects, images without objects are dropped and indices are the images that were kept
+def sumObjectPredictions(fmriPieces, imageIdx, numImages: int):
+    totalFMRI = torch.zeros((numImages, fmriPieces.shape[1]), dtype=fmriPieces.dtype, device=fmriPieces.device).index_add(0, imageIdx, fmriPieces)
+    indices = torch.unique(imageIdx)
+    return totalFMRI[indices], indices
+
 #Currently used
 #A wrapper class to overwrite to string functions so that model isn't printed on server side
 class YoloModel(YOLO):
@@ -84,7 +104,7 @@ class YoloModel(YOLO):
 
 #Currently Using
 class roiVGGYolo(torch.nn.Module):
-    def __init__(self, numROIs: int, tsfms):
+    def __init__(self, numROIs: int, tsfms, detectionStore = None, bfloat16: bool = False):
         super(roiVGGYolo, self).__init__()
         #Make VGG Instance for feature extraction
         self.vgg = vgg19(weights = "DEFAULT")
@@ -110,42 +130,40 @@ class roiVGGYolo(torch.nn.Module):
 
         #Save the torch transforms for the YOLO model
         self.tsfms = tsfms
-
-    def forward(self, img, imgPaths):
-        #extract vgg features from image
-        convFeatures = self.vggConvFeatures(img)
-
-        #transform the original images such as it's compatible with the YOLO model
-        yoloInput = [self.tsfms(Image.open(image)) for image in imgPaths]
-
-        #Make YOLO predictions on images and get bounding box data
-        yoloResults = [results.boxes for results in self.yolo.predict(torch.stack(yoloInput), verbose=False)]
-        boundingBoxDataAllImages = self.getMappedBoundingBox(yoloResults)
-        finalFMRIs = []
-        indices = [] #saved indexes to use that have bounding box info from yolo
-        count = 0
-
-        #for each detected bounding box
-        for boundingBoxData in boundingBoxDataAllImages:
-            #if no bounding boxes, continue (ignore image)
-            if len(boundingBoxData) == 0:
-                continue
-
-            #pool the features in the regions that overlap with a bounding box. returns a result for each detected object
-            objectROIPools = ops.roi_pool(convFeatures, [boundingBoxData], output_size = (7,7)) #output shape (num objects, 512, 7, 7)
-            fmriPieces = []
-
-            #for the pooled results for each object, predict the partial fmri data
-            for objectROIPool in objectROIPools:
-                input = torch.flatten(objectROIPool) #flatten data to pass into mlp, shape (1, 25088)
-                fmriPieces.append(self.MLP(input)) #save partial fmri prediction
-
-            #sum over all partial fmri data
-            totalFMRI = torch.sum(torch.stack(fmriPieces), dim=0)
-            finalFMRIs.append(totalFMRI)
-            indices.append(count)
-            count+=1
-        return torch.stack(finalFMRIs), indices 
+        #optional detections.DetectionStore with YOLO boxes precomputed per image
+        self.detectionStore = detectionStore
+        #frozen VGG runs channels_last, optionally under bfloat16 autocast
+        self.bfloat16 = bfloat16
+        self.vggConvFeatures.to(memory_format=torch.channels_last)
+
+    def forward(self, img, imgPaths, yoloInput = None):
+        #pool every detected object of the batch at once, then run the MLP once over all of them
+        objectFeatures, imageIdx = self.poolObjects(img, imgPaths, yoloInput)
+        return self.forwardPooled(objectFeatures, imageIdx, len(img))
+
+    #YOLO boxes of each image mapped onto the 7x7 grid used for ROI pooling
+    def getBoundingBoxes(self, imgPaths, device, yoloInput = None):
+        #read the bounding boxes from the detection store when there is one (YOLO is frozen so they never change)
+        if self.detectionStore is not None:
+            yoloResults = self.detectionStore.detections(imgPaths)
+        else:
+            #transform the original images such as it's compatible with the YOLO model, unless the dataset already did (yoloTransform)
+            if yoloInput is None:
+                yoloInput = torch.stack([self.tsfms(Image.open(image)) for image in imgPaths])
+
+            #Make YOLO predictions on images and get bounding box data
+            yoloResults = [results.boxes for results in self.yolo.predict(yoloInput, verbose=False)]
+        return [boxes.to(device) for boxes in self.getMappedBoundingBox(yoloResults)]
+
+    #ROI pool the objects of every image with its own conv features, VGG and YOLO are frozen so this can be precomputed (see featureStore.py)
+    #returns the flattened objects (num objects, 25088) and the index of the image each one came from
+    def poolObjects(self, img, imgPaths, yoloInput = None):
+        convFeatures = frozenConvFeatures(self.vggConvFeatures, img, self.bfloat16)
+        return poolBatchObjects(convFeatures, self.getBoundingBoxes(imgPaths, convFeatures.device, yoloInput))
+
+    #predict from pooled objects (from poolObjects or an ObjectFeatureStore), summing the partial fmri of each image's objects
+    def forwardPooled(self, objectFeatures, imageIdx, numImages: int):
+        return sumObjectPredictions(self.MLP(objectFeatures), imageIdx, numImages)
 
     #extract bounding box data for each of the yolo results objects
     def getMappedBoundingBox(self, yoloResults):
@@ -182,7 +200,7 @@ class YoloModel(YOLO):
 
 #Currently Using
 class roiVGGYoloWithGradCam(torch.nn.Module):
-    def __init__(self, numROIs: int, tsfms):
+    def __init__(self, numROIs: int, tsfms, detectionStore = None):
         super(roiVGGYoloWithGradCam, self).__init__()
         #Make VGG Instance for feature extraction
         self.vgg = vgg19(weights = "DEFAULT")
@@ -204,50 +222,38 @@ class roiVGGYoloWithGradCam(torch.nn.Module):
 
         #Save the torch transforms for the YOLO model
         self.tsfms = tsfms
+        #optional detections.DetectionStore with YOLO boxes precomputed per image
+        self.detectionStore = detectionStore
         #variable for the gradients used in grad cam
         self.gradients = None
 
     def activations_hook(self, grad):
         self.gradients = grad
 
-    def forward(self, img, imgPaths):
+    def forward(self, img, imgPaths, yoloInput = None):
         #extract vgg features from image
         convFeatures = self.vggConvFeatures(img)
 
         #define function to call during back prop
         hook = convFeatures.register_hook(self.activations_hook)
 
-        #transform the original images such as it's compatible with the YOLO model
-        yoloInput = [self.tsfms(Image.open(image)) for image in imgPaths]
-
-        #Make YOLO predictions on images and get bounding box data
-        yoloResults = [results.boxes for results in self.yolo.predict(torch.stack(yoloInput), verbose=False)]
-        boundingBoxDataAllImages = self.getMappedBoundingBox(yoloResults)
-        finalFMRIs = []
-        indices = [] #saved indexes to use that have bounding box info from yolo
-        count = 0
-
-        #for each detected bounding box
-        for boundingBoxData in boundingBoxDataAllImages:
-            #if no bounding boxes, continue
-            if len(boundingBoxData) == 0:
-                continue
-
-            #pool the features in the regions that overlap with a bounding box. returns a result for each detected object
-            objectROIPools = ops.roi_pool(convFeatures, [boundingBoxData], output_size = (7,7)) #output shape (num objects, 512, 7, 7)
-            fmriPieces = []
-
-            #for the pooled results for each object, predict the partial fmri data
-            for objectROIPool in objectROIPools:
-                input = torch.flatten(objectROIPool)  #flatten data to pass into mlp, shape (1, 25088)
-                fmriPieces.append(self.MLP(input)) #save partial fmri prediction
-
-            #sum over all partial fmri data
-            totalFMRI = torch.sum(torch.stack(fmriPieces), dim=0)
-            finalFMRIs.append(totalFMRI)
-            indices.append(count)
-            count+=1
-        return torch.stack(finalFMRIs), indices 
+        #pool every detected object of the batch at once, then run the MLP once over all of them
+        objectFeatures, imageIdx = poolBatchObjects(convFeatures, self.getBoundingBoxes(imgPaths, convFeatures.device, yoloInput))
+        return sumObjectPredictions(self.MLP(objectFeatures), imageIdx, len(img))
+
+    #YOLO boxes of each image mapped onto the 7x7 grid used for ROI pooling
+    def getBoundingBoxes(self, imgPaths, device, yoloInput = None):
+        #read the bounding boxes from the detection store when there is one (YOLO is frozen so they never change)
+        if self.detectionStore is not None:
+            yoloResults = self.detectionStore.detections(imgPaths)
+        else:
+            #transform the original images such as it's compatible with the YOLO model, unless the dataset already did (yoloTransform)
+            if yoloInput is None:
+                yoloInput = torch.stack([self.tsfms(Image.open(image)) for image in imgPaths])
+
+            #Make YOLO predictions on images and get bounding box data
+            yoloResults = [results.boxes for results in self.yolo.predict(yoloInput, verbose=False)]
+        return [boxes.to(device) for boxes in self.getMappedBoundingBox(yoloResults)]
 
     #extract bounding box data for each of the yolo results objects
     def getMappedBoundingBox(self, yoloResults):
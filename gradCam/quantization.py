@@ -0,0 +1,162 @@
+import io
+import os
+import sys
+import copy
+import time
+import argparse
+import numpy as np
+import torch
+from torchvision import transforms
+from sklearn.model_selection import KFold
+
+#shared data helpers live in the repo root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from inference import drift
+from loaders import make_loader
+from metrics import StreamingMetrics
+
+#Dynamic int8 quantization of the Linear stacks on top of VGG: the roiVGGYolo MLP and the CocoVGG classifier.
+#Their 25088x4096 first layer is ~400MB of float32 and CPU inference is bound by reading it, int8 weights are a
+#quarter of that and activations are quantized per batch on the fly, so nothing needs calibrating. Quantized
+#Linear layers only run on CPU.
+QUANTIZED_HEADS = ("MLP", "classifier")
+
+#name of the head quantizeModel swaps, MLP for roiVGGYolo and classifier for CocoVGG
+def headName(model):
+    for name in QUANTIZED_HEADS:
+        if isinstance(getattr(model, name, None), torch.nn.Module):
+            return name
+    raise ValueError(f"{type(model).__name__} has none of the heads {QUANTIZED_HEADS}")
+
+#int8 copy of a stack of Linear layers, the float head is left as it was
+def quantizeHead(head):
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(head).cpu().eval(), {torch.nn.Linear}, dtype=torch.qint8)
+
+#swaps the head of a trained model for its int8 version in place, the model moves to the CPU
+def quantizeModel(model):
+    name = headName(model)
+    setattr(model, name, quantizeHead(getattr(model, name)))
+    return model.cpu().eval()
+
+#export: only the int8 head is written, the frozen/pretrained parts come from their usual weights
+def saveQuantizedHead(model, path: str):
+    torch.save(getattr(model, headName(model)).state_dict(), path)
+
+#quantizes a freshly built model's head and loads int8 weights written by saveQuantizedHead into it
+def loadQuantizedHead(model, path: str):
+    model = quantizeModel(model)
+    #packed int8 weights are not plain tensors, so weights_only loading can't read them
+    getattr(model, headName(model)).load_state_dict(torch.load(path, map_location="cpu", weights_only=False))
+    return model
+
+#size of a module's weights in MB, int8 packed params included
+def stateDictMB(module):
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.tell() / 2**20
+
+#Runs every batch of head inputs through the float32 and int8 heads (timing only the heads) and returns both outputs
+#with the drift of the int8 outputs from the float32 ones, the seconds per batch of each and the speedup
+def compareHeads(floatHead, quantHead, batches):
+    floatHead = floatHead.cpu().eval()
+    outputs = {}
+    seconds = {}
+    with torch.inference_mode():
+        for name, head in (("float32", floatHead), ("int8", quantHead)):
+            #one untimed batch so one-off setup doesn't count
+            head(batches[0])
+            start = time.perf_counter()
+            outputs[name] = [head(batch) for batch in batches]
+            seconds[name] = (time.perf_counter() - start) / len(batches)
+    results = drift(torch.vstack(outputs["int8"]), torch.vstack(outputs["float32"]))
+    results.update(floatSeconds = seconds["float32"], int8Seconds = seconds["int8"], speedup = seconds["float32"] / seconds["int8"],
+                   floatMB = stateDictMB(floatHead), int8MB = stateDictMB(quantHead))
+    return results, outputs
+
+#roiVGGYolo on a validation fold of kFoldVGGYoloMLP (same KFold split), read from the pooled object store
+#also scores the summed per image predictions of both heads against the roi averages
+#exportPath also writes the int8 MLP there
+def compareFold(paramsFile: str, fold: int, parentDir: str, subj: int, numBatches: int = None, batchSize: int = 128, exportPath: str = None):
+    from servScript import kFoldDatasets, roiVGGYolo, sumObjectPredictions
+    trainingDataset, foldDataset, collateFn, detectionStore, yoloTsfms = kFoldDatasets(parentDir, subj, "cpu", True)
+    _, valIdxs = list(KFold(n_splits=5, shuffle=True, random_state=42).split(trainingDataset.imagePaths))[fold]
+    loader = make_loader(torch.utils.data.Subset(foldDataset, valIdxs), batchSize, collate_fn = collateFn)
+    batches = [batch for _, batch in zip(range(numBatches or len(loader)), loader)]
+
+    model = roiVGGYolo(len(trainingDataset.lhAvgFMRI[0]), yoloTsfms, detectionStore)
+    model.load_state_dict(torch.load(paramsFile, map_location="cpu"))
+    quantHead = quantizeHead(model.MLP)
+    results, outputs = compareHeads(model.MLP, quantHead, [objects for objects, _, _ in batches])
+    if exportPath:
+        torch.save(quantHead.state_dict(), exportPath)
+    for name in outputs:
+        metrics = StreamingMetrics()
+        for pieces, (_, imageIdx, targets) in zip(outputs[name], batches):
+            pred, indices = sumObjectPredictions(pieces, imageIdx, len(targets))
+            metrics.update(pred, targets[indices])
+        results.update({f"{name} {metric}": value for metric, value in metrics.compute().items()})
+    return results
+
+#CocoVGG on the validation images cocoVGG19.py held out (its <model>_split.npz), the VGG features are computed once and only the
+#classifier is timed. Also reports top-1 accuracy of both heads and how often they agree, exportPath writes the int8 classifier
+def compareCoco(paramsFile: str, parentDir: str, metaDataDir: str, numBatches: int = 10, batchSize: int = 64, exportPath: str = None):
+    from servScript import BalancedCocoSuperClassDataset
+    from models import CocoVGG
+    tsfms = transforms.Compose([
+        transforms.Resize((256,256)),
+        transforms.CenterCrop((224,224)),
+        transforms.ToTensor(),
+    ])
+    splitFile = os.path.splitext(paramsFile)[0] + "_split.npz"
+    if not os.path.exists(splitFile):
+        raise FileNotFoundError(f"{splitFile} not found, the held out images of {paramsFile} are unknown (rerun cocoVGG19.py)")
+    validIdxs = np.load(splitFile)["validIdxs"]
+    loader = make_loader(BalancedCocoSuperClassDataset(parentDir, metaDataDir, idxs = validIdxs, tsfms = tsfms), batchSize)
+
+    model = CocoVGG(12)
+    #cocoVGG19.py trains this architecture without the trailing Softmax, compare the logits of the trained head
+    if isinstance(model.classifier[-1], torch.nn.Softmax):
+        model.classifier = model.classifier[:-1]
+    model.load_state_dict(torch.load(paramsFile, map_location="cpu"))
+    model.eval()
+    features, labels = [], []
+    with torch.inference_mode():
+        for _, (img, label) in zip(range(numBatches), loader):
+            features.append(torch.flatten(model.avgpool(model.features(img)), 1))
+            labels.append(label)
+    quantHead = quantizeHead(model.classifier)
+    results, outputs = compareHeads(model.classifier, quantHead, features)
+    if exportPath:
+        torch.save(quantHead.state_dict(), exportPath)
+    labels = torch.cat(labels)
+    floatClass, quantClass = torch.vstack(outputs["float32"]).argmax(1), torch.vstack(outputs["int8"]).argmax(1)
+    results.update({"float32 acc": (floatClass == labels).double().mean().item(), "int8 acc": (quantClass == labels).double().mean().item(),
+                    "agreement": (floatClass == quantClass).double().mean().item()})
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Int8 error and speedup of the roiVGGYolo MLP / CocoVGG classifier against float32 on CPU")
+    parser.add_argument("--model", choices=["roiVGGYolo", "coco"], default="roiVGGYolo")
+    parser.add_argument("--params", default=None, help="trained float32 weights, ./5FoldBestModel.pth or ./cocoVGGModel.pth by default")
+    parser.add_argument("--export", default=None, help="also write the int8 head here (load it with loadQuantizedHead)")
+    parser.add_argument("--fold", type=int, default=0, help="kFoldVGGYoloMLP fold to validate on")
+    parser.add_argument("--parentDir", default="./algonauts_2023_challenge_data/")
+    parser.add_argument("--metaDataDir", default="./subjCocoImgData/")
+    parser.add_argument("--subj", type=int, default=1)
+    parser.add_argument("--numBatches", type=int, default=None)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    if args.model == "roiVGGYolo":
+        paramsFile = args.params or "./5FoldBestModel.pth"
+        results = compareFold(paramsFile, args.fold, args.parentDir, args.subj, args.numBatches, exportPath = args.export)
+    else:
+        paramsFile = args.params or "./cocoVGGModel.pth"
+        results = compareCoco(paramsFile, args.parentDir, args.metaDataDir, args.numBatches or 10, exportPath = args.export)
+    for name, value in results.items():
+        print(f"{name:16s} {value:.6g}")
+    if args.export:
+        print(f"int8 head written to {args.export}")
+
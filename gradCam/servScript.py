@@ -1,9 +1,13 @@
 import os
+import sys
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 
 import torch
 from torch.optim import lr_scheduler
-from torch.utils.data import Dataset, Subset, DataLoader
+from torch.utils.data import Dataset, Subset
 from torchvision.models import vgg19
 from torchvision import transforms
 from torchvision import ops
@@ -29,9 +33,20 @@ from sklearn.metrics import mean_squared_error
 import pandas as pd
 import numpy as np
 from PIL import Image
-from sklearn.metrics import r2_score
 from sklearn.preprocessing import LabelEncoder
 
+#shared data helpers live in the repo root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from image_store import ImageStore
+from roi_atlas import ROIS, load_atlas
+from fmri import load_fmri, fmri_file
+from detections import DetectionStore
+from loaders import make_loader
+from metrics import StreamingMetrics
+from checkpoints import AsyncCheckpointer, ResumableSampler, cpuCopy, trainableState
+from earlyStopping import EarlyStopping
+from featureStore import ObjectFeatureStore, ObjectFeatureDataset, buildObjectFeatureStore, collateObjects, storeConfig
+
 #Gets images that belong to a specific class according to COCO labels
 def getClassImages(dataDir:str, imgDataFolerDir: str, subj: int, className: str):
     pickleFilePath = os.path.join(imgDataFolerDir, f"subj0{subj}ImgData.pkl")
@@ -53,31 +68,16 @@ def getClassImages(dataDir:str, imgDataFolerDir: str, subj: int, className: str)
     return np.array(imagesInClass), np.array(trainingIDsInClass)
 
 #Calculates the average fmri value for each ROI that has data
-def getAvgROI(parentFolderDir: str, subj: int, fmriData, hemi: str = "l"):
-    rois = np.array(["V1v", "V1d", "V2v", "V2d", "V3v", "V3d", "hV4", "EBA", "FBA-1", "FBA-2", "mTL-bodies", "OFA", "FFA-1", "FFA-2", "mTL-faces", "aTL-faces", "OPA", "PPA", "RSC", "OWFA", "VWFA-1", "VWFA-2", "mfs-words", "mTL-words", "early", "midventral", "midlateral", "midparietal", "ventral", "lateral", "parietal"])
-    avgRoiValues = np.zeros((len(fmriData), len(rois)))
-    for i in range(len(rois)):
-        roi = rois[i]
-        if roi in ["V1v", "V1d", "V2v", "V2d", "V3v", "V3d", "hV4"]:
-            roi_class = 'prf-visualrois'
-        elif roi in ["EBA", "FBA-1", "FBA-2", "mTL-bodies"]:
-            roi_class = 'floc-bodies'
-        elif roi in ["OFA", "FFA-1", "FFA-2", "mTL-faces", "aTL-faces"]:
-            roi_class = 'floc-faces'
-        elif roi in ["OPA", "PPA", "RSC"]:
-            roi_class = 'floc-places'
-        elif roi in ["OWFA", "VWFA-1", "VWFA-2", "mfs-words", "mTL-words"]:
-            roi_class = 'floc-words'
-        elif roi in ["early", "midventral", "midlateral", "midparietal", "ventral", "lateral", "parietal"]:
-            roi_class = 'streams'
-        roiMap = np.load(f"{parentFolderDir}/subj0{subj}/roi_masks/mapping_{roi_class}.npy", allow_pickle=True).item()
-        challenge_roi_class = np.load(f"{parentFolderDir}/subj0{subj}/roi_masks/{hemi}h.{roi_class}_challenge_space.npy")
-        # Select the vertices corresponding to the ROI of interest
-        roi_mapping = list(roiMap.keys())[list(roiMap.values()).index(roi)]
-        challenge_roi = np.asarray(challenge_roi_class == roi_mapping, dtype=int)
-        # print(roi_mapping)       
-        vals = fmriData[:,np.where(challenge_roi)[0]].mean(axis = 1)
-        avgRoiValues[:, i] = vals
+#When fmriData is the whole content of fmriFile the averages are cached on disk next to it
+def getAvgROI(parentFolderDir: str, subj: int, fmriData, hemi: str = "l", fmriFile: str = None):
+    rois = np.array(ROIS)
+    #masks and vertex indices of every ROI are loaded once per subject and hemisphere
+    atlas = load_atlas(os.path.join(parentFolderDir, f"subj0{subj}/roi_masks"), hemi)
+    #all ROI means in one sparse product per chunk of rows instead of copying each ROI's columns
+    if fmriFile is not None:
+        avgRoiValues = atlas.cached_roi_averages(fmriFile, fmriData, ROIS)
+    else:
+        avgRoiValues = atlas.roi_averages(fmriData, ROIS)
     mask = np.arange(len(avgRoiValues[0]))
     print(mask)
     mask = mask[~np.isnan(avgRoiValues.max(axis=0))]
@@ -86,16 +86,26 @@ def getAvgROI(parentFolderDir: str, subj: int, fmriData, hemi: str = "l"):
 
 #currently using
 #Creates dataset with all training images for a specific subject 
+#imageStore (an image_store.ImageStore) replaces the PNG decode + resize, so transform should only hold tensor ops
+#yoloTransform (or a 640 yoloImageStore) adds the YOLO ready image as a 7th item so models don't reopen the image in forward
+#fMRI is memory mapped and subsets are views of it, fmriDtype (e.g. np.float16) opts into a smaller working copy
 class AlgonautsDataset(Dataset):
-    def __init__(self, parentDir: str, subj: int, dataIdxs: list = None, transform = None):
+    def __init__(self, parentDir: str, subj: int, dataIdxs: list = None, transform = None, imageStore = None, fmriDtype = None, yoloTransform = None, yoloImageStore = None):
         self.imagesPath = os.path.join(parentDir, f"subj0{subj}/training_split/training_images/")
         self.fmriPath = os.path.join(parentDir, f"subj0{subj}/training_split/training_fmri/")
         self.imagePaths = np.array(os.listdir(self.imagesPath))
-        self.lhFMRI = np.load(os.path.join(self.fmriPath, "lh_training_fmri.npy"))
-        self.rhFMRI = np.load(os.path.join(self.fmriPath, "rh_training_fmri.npy"))
-        self.lhROIs, self.lhAvgFMRI = getAvgROI(parentDir, subj, self.lhFMRI)
-        self.rhROIs, self.rhAvgFMRI = getAvgROI(parentDir, subj, self.rhFMRI, hemi="r")
+        self.lhFMRI = load_fmri(self.fmriPath, "left", fmriDtype)
+        self.rhFMRI = load_fmri(self.fmriPath, "right", fmriDtype)
+        #ROI averages always come from the original files
+        self.lhROIs, self.lhAvgFMRI = getAvgROI(parentDir, subj, load_fmri(self.fmriPath, "left"), fmriFile=fmri_file(self.fmriPath, "left"))
+        self.rhROIs, self.rhAvgFMRI = getAvgROI(parentDir, subj, load_fmri(self.fmriPath, "right"), hemi="r", fmriFile=fmri_file(self.fmriPath, "right"))
         self.transform = transform
+        self.imageStore = imageStore
+        self.yoloTransform = yoloTransform
+        self.yoloImageStore = yoloImageStore
+        #with an imageStore nothing is decoded, so the YOLO images have to come from a store too
+        if imageStore is not None and yoloTransform is not None and yoloImageStore is None:
+            raise ValueError("imageStore needs a 640 yoloImageStore for YOLO images, yoloTransform would decode every image again")
         if dataIdxs is not None:
             self.imagePaths = self.imagePaths[dataIdxs]
             self.lhFMRI = self.lhFMRI[dataIdxs]
@@ -108,20 +118,31 @@ class AlgonautsDataset(Dataset):
         if torch.is_tensor(idx):
             idx = idx.tolist()
         imagePath = os.path.join(self.imagesPath, self.imagePaths[idx])
-        image = Image.open(imagePath)
+        if self.imageStore is not None:
+            image = self.imageStore.tensor(self.imagePaths[idx])
+        else:
+            image = Image.open(imagePath)
+        #YOLO input made here in the DataLoader workers, from the 640 image store or the image decoded above
+        yoloImage = None
+        if self.yoloImageStore is not None:
+            yoloImage = self.yoloImageStore.tensor(self.imagePaths[idx])
+        elif self.yoloTransform:
+            yoloImage = self.yoloTransform(image)
         if self.transform:
             image = self.transform(image)
         lh, rh = self.lhFMRI[idx], self.rhFMRI[idx]
         avgLh, avgRh = self.lhAvgFMRI[idx], self.rhAvgFMRI[idx]
-        return image, imagePath, torch.tensor(lh, dtype=torch.float32), torch.tensor(rh, dtype=torch.float32), torch.tensor(avgLh, dtype=torch.float32), torch.tensor(avgRh, dtype=torch.float32)
+        data = (image, imagePath, torch.tensor(lh, dtype=torch.float32), torch.tensor(rh, dtype=torch.float32), torch.tensor(avgLh, dtype=torch.float32), torch.tensor(avgRh, dtype=torch.float32))
+        return data if yoloImage is None else data + (yoloImage,)
 
 # not using
 class NSDDatasetClassSubset(Dataset):
-    def __init__(self, parentFolderDir: str, imgDataFolderDir: str, subj: int, className: str, idxs: list = None, tsfms = None):
+    def __init__(self, parentFolderDir: str, imgDataFolderDir: str, subj: int, className: str, idxs: list = None, tsfms = None, yoloTsfms = None):
         self.imgPaths, self.trainingIDs = getClassImages(parentFolderDir, imgDataFolderDir, subj, className)
-        self.lhFMRI = np.load(os.path.join(parentFolderDir, f"subj0{subj}/training_split/training_fmri/lh_training_fmri.npy"))[self.trainingIDs]
-        self.rhFMRI = np.load(os.path.join(parentFolderDir, f"subj0{subj}/training_split/training_fmri/rh_training_fmri.npy"))[self.trainingIDs]
+        self.lhFMRI = load_fmri(os.path.join(parentFolderDir, f"subj0{subj}/training_split/training_fmri/"), "left")[self.trainingIDs]
+        self.rhFMRI = load_fmri(os.path.join(parentFolderDir, f"subj0{subj}/training_split/training_fmri/"), "right")[self.trainingIDs]
         self.tsfms = tsfms
+        self.yoloTsfms = yoloTsfms
         self.lhROIs, self.lhAvgROIs = getAvgROI(parentFolderDir, subj, self.lhFMRI)
         self.rhROIs, self.rhAvgROIs = getAvgROI(parentFolderDir, subj, self.rhFMRI, "r")
         if idxs is not None:
@@ -138,9 +159,12 @@ class NSDDatasetClassSubset(Dataset):
         rh = self.rhFMRI[idx]
         lhAvg = self.lhAvgROIs[idx]
         rhAvg = self.rhAvgROIs[idx]
+        #the YOLO input comes from the same decoded image
+        yoloImg = self.yoloTsfms(img) if self.yoloTsfms else None
         if self.tsfms:
             img = self.tsfms(img)
-        return img, self.imgPaths[idx], torch.from_numpy(lh), torch.from_numpy(rh), torch.tensor(lhAvg, dtype = torch.float32), torch.tensor(rhAvg, dtype = torch.float32)
+        data = (img, self.imgPaths[idx], torch.tensor(lh, dtype=torch.float32), torch.tensor(rh, dtype=torch.float32), torch.tensor(lhAvg, dtype = torch.float32), torch.tensor(rhAvg, dtype = torch.float32))
+        return data if yoloImg is None else data + (yoloImg,)
 
 # not using
 class BalancedCocoSuperClassDataset(Dataset):
@@ -166,6 +190,26 @@ class BalancedCocoSuperClassDataset(Dataset):
             img = self.tsfms(img)
         return img, torch.tensor(self.labelEncoder.transform([label]), dtype=torch.long).squeeze()
 
+#ROI pool the boxes of every image of the batch with that image's own conv features in a single roi_pool call
+#returns the flattened objects (num objects, 25088) and the index of the image each object came from
+def poolBatchObjects(convFeatures, boundingBoxDataAllImages):
+    objectROIPools = ops.roi_pool(convFeatures, boundingBoxDataAllImages, output_size = (7,7)) #output shape (num objects, 512, 7, 7)
+    numObjects = torch.tensor([len(boundingBoxData) for boundingBoxData in boundingBoxDataAllImages], device=convFeatures.device)
+    imageIdx = torch.repeat_interleave(torch.arange(len(boundingBoxDataAllImages), device=convFeatures.device), numObjects)
+    return torch.flatten(objectROIPools, start_dim=1), imageIdx
+
+#run a frozen VGG feature extractor without autograd, on channels_last input and optionally under bfloat16 autocast
+#returns float32 features so the trained head and roi_pool see the same dtype either way
+def frozenConvFeatures(vggConvFeatures, img, bfloat16: bool = False):
+    with torch.no_grad(), torch.autocast(img.device.type, dtype=torch.bfloat16, enabled=bfloat16):
+        return vggConvFeatures(img.contiguous(memory_format=torch.channels_last)).float()
+
+#sum the partial fmri predictions of each image's objects, images without objects are dropped and indices are the images that were kept
+def sumObjectPredictions(fmriPieces, imageIdx, numImages: int):
+    totalFMRI = torch.zeros((numImages, fmriPieces.shape[1]), dtype=fmriPieces.dtype, device=fmriPieces.device).index_add(0, imageIdx, fmriPieces)
+    indices = torch.unique(imageIdx)
+    return totalFMRI[indices], indices
+
 # using
 class YoloModel(YOLO):
     def __init__(self, *args, **kwargs):
@@ -175,10 +219,20 @@ class YoloModel(YOLO):
     def __repr__(self):
         return ""
 
+#MLP head of roiVGGYolo, predicts the partial fmri of one pooled object
+def objectMLP(numROIs: int):
+    return torch.nn.Sequential(
+        torch.nn.Linear(25088, 4096),
+        torch.nn.ReLU(),
+        torch.nn.Linear(4096, 1024),
+        torch.nn.ReLU(),
+        torch.nn.Linear(1024, numROIs),
+    )
+
 #currenly using
 #Currently Using
 class roiVGGYolo(torch.nn.Module):
-    def __init__(self, numROIs: int, tsfms):
+    def __init__(self, numROIs: int, tsfms, detectionStore = None, bfloat16: bool = False):
         super(roiVGGYolo, self).__init__()
         #Make VGG Instance for feature extraction
         self.vgg = vgg19(weights = "DEFAULT")
@@ -191,44 +245,38 @@ class roiVGGYolo(torch.nn.Module):
         for params in self.yolo.parameters():
             params.requires_grad = False
         #Create the MLP which is just a series of linear layers with relu
-        self.MLP = torch.nn.Sequential(
-            torch.nn.Linear(25088, 4096),
-            torch.nn.ReLU(),
-            torch.nn.Linear(4096, 1024),
-            torch.nn.ReLU(),
-            torch.nn.Linear(1024, numROIs),
-        )
+        self.MLP = objectMLP(numROIs)
         #Save the torch transforms for the YOLO model
         self.tsfms = tsfms
-    def forward(self, img, imgPaths):
-        #extract vgg features from image
-        convFeatures = self.vggConvFeatures(img)
-        #transform the original images such as it's compatible with the YOLO model
-        yoloInput = [self.tsfms(Image.open(image)) for image in imgPaths]
-        #Make YOLO predictions on images and get bounding box data
-        yoloResults = [results.boxes for results in self.yolo.predict(torch.stack(yoloInput), verbose=False)]
-        boundingBoxDataAllImages = self.getMappedBoundingBox(yoloResults)
-        finalFMRIs = []
-        indices = [] #saved indices to use that have bounding box info from yolo
-        count = 0
-        #for each detected bounding box
-        for boundingBoxData in boundingBoxDataAllImages:
-            #if no bounding boxes, continue (ignore image)
-            if len(boundingBoxData) == 0:
-                continue
-            #pool the features in the regions that overlap with a bounding box. returns a result for each detected object
-            objectROIPools = ops.roi_pool(convFeatures, [boundingBoxData], output_size = (7,7)) #output shape (num objects, 512, 7, 7)
-            fmriPieces = []
-            #for the pooled results for each object, predict the partial fmri data
-            for objectROIPool in objectROIPools:
-                input = torch.flatten(objectROIPool) #flatten data to pass into mlp, shape (1, 25088)
-                fmriPieces.append(self.MLP(input)) #save partial fmri prediction
-            #sum over all partial fmri data
-            totalFMRI = torch.sum(torch.stack(fmriPieces), dim=0)
-            finalFMRIs.append(totalFMRI)
-            indices.append(count)
-            count+=1
-        return torch.stack(finalFMRIs), indices 
+        #optional detections.DetectionStore with YOLO boxes precomputed per image
+        self.detectionStore = detectionStore
+        #frozen VGG runs channels_last, optionally under bfloat16 autocast
+        self.bfloat16 = bfloat16
+        self.vggConvFeatures.to(memory_format=torch.channels_last)
+    def forward(self, img, imgPaths, yoloInput = None):
+        #pool every detected object of the batch at once, then run the MLP once over all of them
+        objectFeatures, imageIdx = self.poolObjects(img, imgPaths, yoloInput)
+        return self.forwardPooled(objectFeatures, imageIdx, len(img))
+    #YOLO boxes of each image mapped onto the 7x7 grid used for ROI pooling
+    def getBoundingBoxes(self, imgPaths, device, yoloInput = None):
+        #read the bounding boxes from the detection store when there is one (YOLO is frozen so they never change)
+        if self.detectionStore is not None:
+            yoloResults = self.detectionStore.detections(imgPaths)
+        else:
+            #transform the original images such as it's compatible with the YOLO model, unless the dataset already did (yoloTransform)
+            if yoloInput is None:
+                yoloInput = torch.stack([self.tsfms(Image.open(image)) for image in imgPaths])
+            #Make YOLO predictions on images and get bounding box data
+            yoloResults = [results.boxes for results in self.yolo.predict(yoloInput, verbose=False)]
+        return [boxes.to(device) for boxes in self.getMappedBoundingBox(yoloResults)]
+    #ROI pool the objects of every image with its own conv features, VGG and YOLO are frozen so this can be precomputed (see featureStore.py)
+    #returns the flattened objects (num objects, 25088) and the index of the image each one came from
+    def poolObjects(self, img, imgPaths, yoloInput = None):
+        convFeatures = frozenConvFeatures(self.vggConvFeatures, img, self.bfloat16)
+        return poolBatchObjects(convFeatures, self.getBoundingBoxes(imgPaths, convFeatures.device, yoloInput))
+    #predict from pooled objects (from poolObjects or an ObjectFeatureStore), summing the partial fmri of each image's objects
+    def forwardPooled(self, objectFeatures, imageIdx, numImages: int):
+        return sumObjectPredictions(self.MLP(objectFeatures), imageIdx, numImages)
     #extract bounding box data for each of the yolo results objects
     def getMappedBoundingBox(self, yoloResults):
         mappedBoxes = []
@@ -251,9 +299,22 @@ class roiVGGYolo(torch.nn.Module):
     def __repr__(self):
         return ""
 
+#Only the trained part of roiVGGYolo, for training from an ObjectFeatureStore without loading VGG and YOLO
+#its params have the same names as roiVGGYolo's (MLP.*), so they load into a full roiVGGYolo with strict = False
+class roiMLPHead(torch.nn.Module):
+    def __init__(self, numROIs: int):
+        super(roiMLPHead, self).__init__()
+        self.MLP = objectMLP(numROIs)
+    def forwardPooled(self, objectFeatures, imageIdx, numImages: int):
+        return sumObjectPredictions(self.MLP(objectFeatures), imageIdx, numImages)
+    def __str__(self):
+        return ""
+    def __repr__(self):
+        return ""
+
 #kinda maybe using
 class roiVGGYoloRandomForest(torch.nn.Module):
-    def __init__(self, tsfms):
+    def __init__(self, tsfms, detectionStore = None, bfloat16: bool = False):
         super(roiVGGYoloRandomForest, self).__init__()
         self.vgg = vgg19(weights = "DEFAULT")
         self.vggConvFeatures = self.vgg.features[:35]
@@ -263,34 +324,25 @@ class roiVGGYoloRandomForest(torch.nn.Module):
         for params in self.yolo.parameters():
             params.requires_grad = False
         self.tsfms = tsfms
-    def forward(self, img, imgPaths):
+        #optional detections.DetectionStore with YOLO boxes precomputed per image
+        self.detectionStore = detectionStore
+        #frozen VGG runs channels_last, optionally under bfloat16 autocast
+        self.bfloat16 = bfloat16
+        self.vggConvFeatures.to(memory_format=torch.channels_last)
+    def forward(self, img, imgPaths, yoloInput = None):
         # pooling = self.vgg.features(img)
         # pooling = self.vgg.avgpool(pooling)
-        convFeatures = self.vggConvFeatures(img)
-        yoloInput = [self.tsfms(Image.open(image)) for image in imgPaths]
-        yoloResults = [results.boxes for results in self.yolo.predict(torch.stack(yoloInput), verbose=False)]
-        boundingBoxDataAllImages = self.getMappedBoundingBox(yoloResults)
-        finalFMRIs = []
-        indices = []
-        count = 0
-        for boundingBoxData in boundingBoxDataAllImages:
-            # print(boundingBoxData)
-            # print(imgPaths[count])
-            if len(boundingBoxData) == 0:
-                continue
-            objectROIPools = ops.roi_pool(convFeatures, [boundingBoxData], output_size = (7,7))
-            for objectROIPool in objectROIPools:
-                # print("objROIP")
-                # print(objectROIPool.shape)
-                # print(objectROIPool)
-                input = torch.flatten(objectROIPool)
-                finalFMRIs.append(input)
-                indices.append(count)
-            # print("fmriPieces")
-            # print(f"Shape: ({len(fmriPieces)}, {fmriPieces[0].shape})")
-            # print(fmriPieces)
-            count += 1
-        return torch.stack(finalFMRIs), indices 
+        convFeatures = frozenConvFeatures(self.vggConvFeatures, img, self.bfloat16)
+        #every detected object of the batch pooled at once, indices holds the image of each object
+        return poolBatchObjects(convFeatures, self.getBoundingBoxes(imgPaths, convFeatures.device, yoloInput))
+    def getBoundingBoxes(self, imgPaths, device, yoloInput = None):
+        if self.detectionStore is not None:
+            yoloResults = self.detectionStore.detections(imgPaths)
+        else:
+            if yoloInput is None:
+                yoloInput = torch.stack([self.tsfms(Image.open(image)) for image in imgPaths])
+            yoloResults = [results.boxes for results in self.yolo.predict(yoloInput, verbose=False)]
+        return [boxes.to(device) for boxes in self.getMappedBoundingBox(yoloResults)]
     def getMappedBoundingBox(self, yoloResults):
         mappedBoxes = []
         for result in yoloResults:
@@ -335,11 +387,12 @@ def vggYoloTrain():
     numImages = len(getClassImages(parentDir, metaDataDir, subj, "person")[0])
     trainIdxs, validIdxs = train_test_split(range(numImages), train_size=0.9, random_state = 42)
 
-    trainingDataset = NSDDatasetClassSubset(parentDir, metaDataDir, subj, "person", idxs=trainIdxs, tsfms = tsfms)
-    trainDataLoader = DataLoader(trainingDataset, batch_size = 64, shuffle = True)
+    #both loaders are iterated every epoch, so their workers are kept alive between epochs
+    trainingDataset = NSDDatasetClassSubset(parentDir, metaDataDir, subj, "person", idxs=trainIdxs, tsfms = tsfms, yoloTsfms = yoloTsfms)
+    trainDataLoader = make_loader(trainingDataset, 64, shuffle = True, persistent_workers = True)
 
-    validDataset = NSDDatasetClassSubset(parentDir, metaDataDir, subj, "person", idxs = validIdxs, tsfms = tsfms)
-    validDataLoader = DataLoader(validDataset, batch_size = 64, shuffle = True)
+    validDataset = NSDDatasetClassSubset(parentDir, metaDataDir, subj, "person", idxs = validIdxs, tsfms = tsfms, yoloTsfms = yoloTsfms)
+    validDataLoader = make_loader(validDataset, 64, shuffle = True, persistent_workers = True)
 
     # numClasses = 12
     numROIs = len(trainingDataset.lhROIs)
@@ -352,43 +405,41 @@ def vggYoloTrain():
     epochs = 30
     for epoch in range(epochs):
         print(f"Epoch {epoch}")
-        avgTrainingLoss = 0
-        avgEvalLoss = 0
-        avgTrainingR2Score = 0
-        avgEvalR2Score = 0
+        #epoch level metrics accumulated on the device
+        trainMetrics = StreamingMetrics()
+        evalMetrics = StreamingMetrics()
         for data in tqdm(trainDataLoader, desc="Training", unit="batch"):  # for data in trainDataLoader: #
-            img, imgPaths, _, _, avgFMRI, _ = data
+            img, imgPaths, _, _, avgFMRI, _, yoloInput = data
             img = img.to(device)
             avgFMRI = avgFMRI.to(device)
             optim.zero_grad()
             # print("start")
             # print(imgPaths)
             # print("end")
-            pred, indices = model(img, imgPaths)
+            pred, indices = model(img, imgPaths, yoloInput)
             avgFMRI = avgFMRI[indices]
+            #no image of the batch had a detected object, the mse of nothing is NaN so there is no step to take
+            if len(pred) == 0:
+                continue
             loss = criterion(pred, avgFMRI)
             loss.backward()
             optim.step()  
             # numRight += (torch.argmax(pred, 1) == label).sum().item()
-            avgTrainingLoss += loss.item()
-            # print(r2_score(pred.detach().cpu().numpy(), avgFMRI.detach().cpu().numpy()))
-            avgTrainingR2Score += r2_score(pred.detach().cpu().numpy(), avgFMRI.detach().cpu().numpy())
+            trainMetrics.update(pred, avgFMRI)
         # print(f"pred shape {pred.shape} avgFMRI shape {avgFMRI.shape}")
         # model.eval()
         with torch.no_grad():
             for data in tqdm(validDataLoader, desc="Evaluating", unit="batch"): 
-                img, imgPaths, _, _, avgFMRI, _ = data
+                img, imgPaths, _, _, avgFMRI, _, yoloInput = data
                 img = img.to(device)
                 avgFMRI = avgFMRI.to(device)
-                pred, indices = model(img, imgPaths)
+                pred, indices = model(img, imgPaths, yoloInput)
                 avgFMRI = avgFMRI[indices]
                 # print(f"pred shape {pred.shape} avgFMRI shape {avgFMRI.shape}")
-                evalLoss = criterion(pred, avgFMRI)
-                avgEvalLoss += evalLoss.item()
-                # print(r2_score(pred.detach().cpu().numpy(), avgFMRI.detach().cpu().numpy()))
-                avgEvalR2Score += r2_score(pred.detach().cpu().numpy(), avgFMRI.detach().cpu().numpy())
+                evalMetrics.update(pred, avgFMRI)
         scheduler.step()
-        print(f"Epoch {epoch} using lr = {learningRate} TrainingMSE: {avgTrainingLoss / len(trainDataLoader)}, ValidMSE: {avgEvalLoss / len(validDataLoader)}, trainR2 = {avgTrainingR2Score / len(trainDataLoader)}, evalR2= {avgEvalR2Score / len(validDataLoader)}")
+        train, valid = trainMetrics.compute(), evalMetrics.compute()
+        print(f"Epoch {epoch} using lr = {learningRate} TrainingMSE: {train['mse']}, ValidMSE: {valid['mse']}, trainR2 = {train['r2']}, evalR2= {valid['r2']}, trainR = {train['pearson']}, evalR = {valid['pearson']}")
 
 # kinda maybe using
 def vggYoloRandomForest():
@@ -413,13 +464,14 @@ def vggYoloRandomForest():
     validIdxs = np.load(os.path.join(metaDataDir, f"subj{subj}ValidIdxs.npy"))
 
     trainingDataset = AlgonautsDataset(parentDir, subj, dataIdxs=trainIdxs, transform = tsfms)
-    trainDataLoader = DataLoader(trainingDataset, batch_size = 64, shuffle = True)
+    trainDataLoader = make_loader(trainingDataset, 64, shuffle = True)
 
     validDataset = AlgonautsDataset(parentDir, subj, dataIdxs=validIdxs, transform = tsfms)
-    validDataLoader = DataLoader(validDataset, batch_size = 64, shuffle = True)
+    validDataLoader = make_loader(validDataset, 64, shuffle = True)
 
     # numClasses = 12
-    model = roiVGGYoloRandomForest(yoloTsfms).to(device)
+    detectionStore = DetectionStore(os.path.join(parentDir, "detection_store"), device=device)
+    model = roiVGGYoloRandomForest(yoloTsfms, detectionStore).to(device)
 
     features = []
     targets = []
@@ -476,13 +528,23 @@ def vggYoloRandomForest():
     with open('randomForestPredictor.pkl','wb') as file:
         pickle.dump(rf_model, file)
 
-#currently using
-def kFoldVGGYoloMLP():
-    #define some variables to run the function
-    device = "cuda:1" if torch.cuda.is_available() else "cpu"
-    subj = 1
-    parentDir = "./algonauts_2023_challenge_data/"
-
+#Runs one batch through roiVGGYolo, data is a batch of AlgonautsDataset or, with useFeatureStore, of featureStore.ObjectFeatureDataset
+#returns the predictions and the avg lh fmri of the images that had bounding box data
+def predictBatch(model, data, device, useFeatureStore: bool = False):
+    if useFeatureStore:
+        objects, imageIdx, avgLhFMRI = data
+        pred, indices = model.forwardPooled(objects.to(device), imageIdx.to(device), len(avgLhFMRI))
+    else:
+        img, imgPaths, _, _, avgLhFMRI, _ = data[:6]
+        #YOLO ready images when the dataset was made with a yoloTransform
+        yoloInput = data[6] if len(data) > 6 else None
+        pred, indices = model(img.to(device), imgPaths, yoloInput)
+    #only use data for images that had bounding box data
+    return pred, avgLhFMRI.to(device)[indices]
+
+#Builds the datasets kFoldVGGYoloMLP trains from. Detections, ROI averages, images and pooled objects all live on disk,
+#so fold workers calling this again only reopen the memory maps instead of copying the data
+def kFoldDatasets(parentDir: str, subj: int, device, useFeatureStore: bool):
     #define transforms for the images to be passed into the vgg model
     tsfms = transforms.Compose([
         transforms.Resize((224,224)),
@@ -495,94 +557,238 @@ def kFoldVGGYoloMLP():
         transforms.ToTensor()
     ])
 
-    #create dataset
-    trainingDataset = AlgonautsDataset(parentDir, subj,  transform = tsfms)
+    #create dataset, reading pre-decoded images when image_store.py has been run for this subject
+    imageStoreDir = os.path.join(parentDir, f"subj0{subj}/image_store/")
+    if os.path.isdir(imageStoreDir):
+        trainingDataset = AlgonautsDataset(parentDir, subj, imageStore = ImageStore(imageStoreDir, "training", 224))
+    else:
+        trainingDataset = AlgonautsDataset(parentDir, subj,  transform = tsfms)
+
+    #Run YOLO once per image up front, every fold and epoch then reads the boxes from the store
+    detectionStore = DetectionStore(os.path.join(parentDir, "detection_store"), device=device)
+    detectionStore.detections([os.path.join(trainingDataset.imagesPath, imagePath) for imagePath in trainingDataset.imagePaths])
+
+    #Every fold and epoch reads the pooled objects instead of running VGG and YOLO again
+    if useFeatureStore:
+        featureStoreDir = os.path.join(parentDir, f"subj0{subj}/object_feature_store/")
+        config = storeConfig(trainingDataset, detectionStore, yoloTsfms)
+        if os.path.exists(os.path.join(featureStoreDir, "meta.json")) and ObjectFeatureStore(featureStoreDir).matches(trainingDataset.imagePaths, config):
+            featureStore = ObjectFeatureStore(featureStoreDir)
+        else:
+            frozenModel = roiVGGYolo(len(trainingDataset.lhAvgFMRI[0]), yoloTsfms, detectionStore).to(device).eval()
+            featureStore = buildObjectFeatureStore(frozenModel, trainingDataset, featureStoreDir, device)
+            del frozenModel
+        foldDataset = ObjectFeatureDataset(featureStore, trainingDataset.lhAvgFMRI)
+        collateFn = collateObjects
+    else:
+        foldDataset = trainingDataset
+        collateFn = None
+    return trainingDataset, foldDataset, collateFn, detectionStore, yoloTsfms
+
+#everything needed to continue a fold from (epoch, batch): trained params, optimizer, scheduler, training metrics so far and the best epoch
+def foldCheckpoint(model, optim, scheduler, trainMetrics, stopper, bestFold: dict, epoch: int, batch: int):
+    return {
+        "model": trainableState(model),
+        "optim": optim.state_dict(),
+        "scheduler": scheduler.state_dict(),
+        "trainMetrics": trainMetrics.stateDict(),
+        "stopper": stopper.stateDict(),
+        "bestFold": bestFold,
+        "epoch": epoch,
+        "batch": batch,
+    }
+
+#Trains one fold of kFoldVGGYoloMLP, possibly in its own process. The fold's best params are saved to foldConfig["paramsFile"]
+#and its best metrics are returned so the parent can pick the best fold
+def trainFold(fold: int, train_idxs, val_idxs, foldConfig: dict):
+    #stay within this fold's share of the cores
+    torch.set_num_threads(foldConfig["threads"])
+    device = foldConfig["device"]
+    useFeatureStore = foldConfig["useFeatureStore"]
+    trainingDataset, foldDataset, collateFn, detectionStore, yoloTsfms = kFoldDatasets(foldConfig["parentDir"], foldConfig["subj"], device, useFeatureStore)
 
     #Get the number of ROIs with available data for subject of interest
     numROIs = len(trainingDataset.lhAvgFMRI[0])
-    bestModel = {
-        "fold": 0,
+    bestFold = {
+        "fold": fold,
         "mse": float('inf'),  # Set to positive infinity initially
         "r2": float('-inf'),  # Set to negative infinity initially
         "params": None  # Initialize with None, will be updated with model state dict
     }
 
-    #Define KFold technique
-    k_folds = 5
-    skf = KFold(n_splits=k_folds, shuffle=True, random_state=42)
-
-    # Loop over folds
-    for fold, (train_idxs, val_idxs) in enumerate(skf.split(trainingDataset.imagePaths)):
-        #Create subset of dataset with the corresponding training and validation indexes for this fold
-        trainSubset = Subset(trainingDataset, train_idxs)
-        trainDataLoader = DataLoader(trainSubset, batch_size = 128, shuffle = True)
-        validSubset = Subset(trainingDataset, val_idxs)
-        validDataLoader = DataLoader(validSubset, batch_size = 128, shuffle = True)
+    #fold state is checkpointed every checkpointEvery batches and after every epoch, a finished fold keeps only its result
+    checkpointer = AsyncCheckpointer(foldConfig["checkpointFile"])
+    checkpoint = checkpointer.load() if foldConfig["resume"] else None
+    if checkpoint is not None and checkpoint.get("done"):
+        print(f"Fold {fold} already finished")
+        return checkpoint["bestFold"]
+
+    #Create subset of dataset with the corresponding training and validation indexes for this fold
+    #training order comes from a seeded sampler so a resumed epoch sees the same batches
+    batchSize = 128
+    trainSubset = Subset(foldDataset, train_idxs)
+    trainSampler = ResumableSampler(len(trainSubset), seed = fold)
+    #both loaders are iterated every epoch, so their workers are kept alive between epochs
+    trainDataLoader = make_loader(trainSubset, batchSize, sampler = trainSampler, collate_fn = collateFn, num_workers = foldConfig["loaderWorkers"], persistent_workers = True)
+    validSubset = Subset(foldDataset, val_idxs)
+    validDataLoader = make_loader(validSubset, batchSize, shuffle = True, collate_fn = collateFn, num_workers = foldConfig["loaderWorkers"], persistent_workers = True)
+    #The MLP trains from the pooled objects alone, VGG and YOLO were only needed to build the store (in the parent)
+    if useFeatureStore:
+        model = roiMLPHead(numROIs).to(device)
+    else:
         #Create VGG and YOLO model
-        model = roiVGGYolo(numROIs, yoloTsfms).to(device)
-        #Define optimzer params and loss function
-        learningRate = 0.00001
-        optim = torch.optim.Adam(model.parameters(), learningRate)#,  weight_decay=1e-4
-        scheduler = lr_scheduler.StepLR(optim, step_size=10, gamma=0.1)
-        criterion = torch.nn.MSELoss()
-        #Training for specified epochs
-        epochs = 15
-        for epoch in range(epochs):
-            #Variables to hold information on training progess
-            print(f"Epoch {epoch}")
-            avgTrainingLoss = 0
-            avgEvalLoss = 0
-            avgTrainingR2Score = 0
-            avgEvalR2Score = 0
-            for data in tqdm(trainDataLoader, desc="Training", unit="batch"): 
-                #Get data in batch
-                img, imgPaths, _, _, avgLhFMRI, _ = data
-                img = img.to(device)
-                avgLhFMRI = avgLhFMRI.to(device)
-                optim.zero_grad()
-                #make predictions
-                pred, indices = model(img, imgPaths)
-                #only use data for images that had bounding box data
-                avgLhFMRI = avgLhFMRI[indices]
+        model = roiVGGYolo(numROIs, yoloTsfms, detectionStore).to(device)
+    #Define optimzer params and loss function
+    learningRate = 0.00001
+    optim = torch.optim.Adam(model.parameters(), learningRate)#,  weight_decay=1e-4
+    scheduler = lr_scheduler.StepLR(optim, step_size=10, gamma=0.1)
+    criterion = torch.nn.MSELoss()
+    #epoch level metrics accumulated on the device
+    trainMetrics = StreamingMetrics()
+    #stop once validation mse stops improving or the fold's time budget runs out
+    stopper = EarlyStopping(foldConfig["patience"], maxSeconds = foldConfig["maxSeconds"])
+    startEpoch, startBatch = 0, 0
+    if checkpoint is not None:
+        model.load_state_dict(checkpoint["model"], strict = False)
+        optim.load_state_dict(checkpoint["optim"])
+        scheduler.load_state_dict(checkpoint["scheduler"])
+        trainMetrics.loadStateDict(checkpoint["trainMetrics"])
+        stopper.loadStateDict(checkpoint["stopper"])
+        bestFold = checkpoint["bestFold"]
+        startEpoch, startBatch = checkpoint["epoch"], checkpoint["batch"]
+        print(f"Fold {fold} resuming at epoch {startEpoch} batch {startBatch}")
+    #Training for at most the specified epochs
+    epochs = foldConfig["maxEpochs"]
+    for epoch in range(startEpoch, epochs):
+        stopReason = stopper.shouldStop()
+        if stopReason is not None:
+            print(f"Fold {fold} stopping before epoch {epoch}: {stopReason}")
+            break
+        #Variables to hold information on training progess
+        print(f"Fold {fold} Epoch {epoch}")
+        batch = startBatch if epoch == startEpoch else 0
+        if batch == 0:
+            trainMetrics.reset()
+        evalMetrics = StreamingMetrics()
+        trainSampler.setEpoch(epoch, batch * batchSize)
+        for data in tqdm(trainDataLoader, desc=f"Fold {fold} Training", unit="batch"): 
+            optim.zero_grad()
+            #make predictions
+            pred, avgLhFMRI = predictBatch(model, data, device, useFeatureStore)
+            #no image of the batch had a detected object, the mse of nothing is NaN so the step is skipped
+            #(the batch still counts, resuming goes by batch position)
+            if len(pred) > 0:
                 #evaluate based on loss function
                 loss = criterion(pred, avgLhFMRI)
                 loss.backward()
                 optim.step()  
-                #sum r2 scores and loss values for batch
-                avgTrainingLoss += loss.item()
-                avgTrainingR2Score += r2_score(pred.detach().cpu().numpy(), avgLhFMRI.detach().cpu().numpy())
-            with torch.no_grad():
-                for data in tqdm(validDataLoader, desc="Evaluating", unit="batch"): 
-                    #Get data in batch
-                    img, imgPaths, _, _, avgLhFMRI, _ = data
-                    img = img.to(device)
-                    avgLhFMRI = avgLhFMRI.to(device)
-                    #make predictions
-                    pred, indices = model(img, imgPaths)
-                    #only use data for images that had bounding box data
-                    avgLhFMRI = avgLhFMRI[indices]
-                    #evaluate based on loss function
-                    evalLoss = criterion(pred, avgLhFMRI)
-                    #sum r2 scores and loss values for batch
-                    avgEvalLoss += evalLoss.item()
-                    avgEvalR2Score += r2_score(pred.detach().cpu().numpy(), avgLhFMRI.detach().cpu().numpy())
-            scheduler.step()
-            #calculate metrics for epoch
-            validMse = avgEvalLoss / len(validDataLoader)
-            validR2 = avgEvalR2Score / len(validDataLoader)
-            print(f"Epoch {epoch} using lr = {learningRate} TrainingMSE: {avgTrainingLoss / len(trainDataLoader)}, ValidMSE: {validMse}, trainR2 = {avgTrainingR2Score / len(trainDataLoader)}, evalR2= {validR2}")
-            #save model params and info if better than recorded validation mse
-            if validMse < bestModel["mse"]:
-                print("BESTMODEL SO FAR")
-                bestModel["fold"] = fold
-                bestModel["mse"] = validMse
-                bestModel["r2"] = validR2
-                bestModel["params"] = model.state_dict()  # Update with the current model's state dict
-
-    #save best model params and data
-    torch.save(bestModel["params"], './5FoldBestModel.pth')
-    bestModelData = np.array([bestModel["fold"], bestModel["mse"], bestModel["r2"]])
-    np.save("5FoldBestModelData.npy", bestModelData)
-
+                #add the batch to the running sums
+                trainMetrics.update(pred, avgLhFMRI)
+            batch += 1
+            if batch % foldConfig["checkpointEvery"] == 0:
+                checkpointer.save(foldCheckpoint(model, optim, scheduler, trainMetrics, stopper, bestFold, epoch, batch))
+        with torch.no_grad():
+            for data in tqdm(validDataLoader, desc=f"Fold {fold} Evaluating", unit="batch"): 
+                #make predictions
+                pred, avgLhFMRI = predictBatch(model, data, device, useFeatureStore)
+                #add the batch to the running sums
+                evalMetrics.update(pred, avgLhFMRI)
+        scheduler.step()
+        #calculate metrics for epoch
+        train, valid = trainMetrics.compute(), evalMetrics.compute()
+        validMse = valid["mse"]
+        validR2 = valid["r2"]
+        print(f"Fold {fold} Epoch {epoch} using lr = {learningRate} TrainingMSE: {train['mse']}, ValidMSE: {validMse}, trainR2 = {train['r2']}, evalR2= {validR2}, trainR = {train['pearson']}, evalR = {valid['pearson']}")
+        stopper.step(validMse)
+        #save model params and info if better than recorded validation mse
+        if validMse < bestFold["mse"]:
+            print(f"Fold {fold} BESTMODEL SO FAR")
+            bestFold["mse"] = validMse
+            bestFold["r2"] = validR2
+            bestFold["params"] = cpuCopy(trainableState(model))  # a copy, model.state_dict() would keep following the training
+        #epoch finished, a resume starts from the next one
+        checkpointer.save(foldCheckpoint(model, optim, scheduler, trainMetrics, stopper, bestFold, epoch + 1, 0))
+
+    #params go through a file, sending the state dict back to the parent would pickle it through a pipe
+    #the file holds the best trained params only, the parent adds the frozen VGG and YOLO for the best fold
+    bestParams = bestFold.pop("params")
+    if bestParams is not None:
+        model.load_state_dict(bestParams, strict = False)
+    torch.save(trainableState(model), foldConfig["paramsFile"])
+    bestFold["paramsFile"] = foldConfig["paramsFile"]
+    checkpointer.save({"done": True, "bestFold": bestFold})
+    checkpointer.wait()
+    return bestFold
 
+#currently using
+#resume continues every unfinished fold from its last checkpoint (mid-epoch if one was written) instead of starting over
+#each fold trains for at most maxEpochs, stops after patience epochs without a better validation mse and, with
+#foldMinutes set, doesn't start an epoch that would take it past that much training time
+def kFoldVGGYoloMLP(resume: bool = False, patience: int = 3, maxEpochs: int = 15, foldMinutes: float = None):
+    #define some variables to run the function
+    device = "cuda:1" if torch.cuda.is_available() else "cpu"
+    subj = 1
+    parentDir = "./algonauts_2023_challenge_data/"
+    #VGG and YOLO are frozen, so pool the objects of every image once and train the MLP head from the stored objects
+    useFeatureStore = True
 
+    #Define KFold technique
+    k_folds = 5
+    skf = KFold(n_splits=k_folds, shuffle=True, random_state=42)
+    #folds run concurrently in a process pool on CPU, one after another on the GPU
+    parallelFolds = 1 if torch.cuda.is_available() else k_folds
+    #cores are split between the fold processes, each gets some threads for torch and a couple of DataLoader workers
+    threadsPerFold = max(1, (os.cpu_count() or 1) // parallelFolds)
+    loaderWorkersPerFold = min(2, threadsPerFold // 2)
+
+    #build (or reuse) every store once in this process so fold workers only read them
+    trainingDataset, _, _, detectionStore, yoloTsfms = kFoldDatasets(parentDir, subj, device, useFeatureStore)
+    foldConfig = {
+        "parentDir": parentDir,
+        "subj": subj,
+        "device": device,
+        "useFeatureStore": useFeatureStore,
+        "threads": threadsPerFold,
+        "loaderWorkers": loaderWorkersPerFold,
+        "resume": resume,
+        "checkpointEvery": 50,
+        "patience": patience,
+        "maxEpochs": maxEpochs,
+        "maxSeconds": None if foldMinutes is None else foldMinutes * 60,
+    }
+    foldArgs = [(fold, train_idxs, val_idxs, dict(foldConfig, paramsFile = f"./5FoldBestModel_fold{fold}.pth", checkpointFile = f"./checkpoints/kFoldVGGYoloMLP_fold{fold}.pt"))
+                for fold, (train_idxs, val_idxs) in enumerate(skf.split(trainingDataset.imagePaths))]
+
+    # Run the folds
+    if parallelFolds > 1:
+        with ProcessPoolExecutor(max_workers = parallelFolds, mp_context = multiprocessing.get_context("spawn")) as pool:
+            foldResults = list(pool.map(trainFold, *zip(*foldArgs)))
+    else:
+        foldResults = [trainFold(*args) for args in foldArgs]
+
+    #best model is the fold with the lowest validation mse
+    bestModel = min(foldResults, key = lambda foldResult: foldResult["mse"])
+    print(f"BESTMODEL fold {bestModel['fold']} ValidMSE: {bestModel['mse']}, evalR2= {bestModel['r2']}")
+
+    #save best model params and data, as a full roiVGGYolo state dict (frozen VGG and YOLO plus the trained MLP)
+    model = roiVGGYolo(len(trainingDataset.lhAvgFMRI[0]), yoloTsfms, detectionStore)
+    model.load_state_dict(torch.load(bestModel["paramsFile"], map_location = "cpu"), strict = False)
+    torch.save(model.state_dict(), './5FoldBestModel.pth')
+    del model
+    for foldResult in foldResults:
+        if os.path.exists(foldResult["paramsFile"]):
+            os.remove(foldResult["paramsFile"])
+    bestModelData = np.array([bestModel["fold"], bestModel["mse"], bestModel["r2"]])
+    np.save("5FoldBestModelData.npy", bestModelData)
+    #the run is complete, nothing left to resume
+    for _, _, _, config in foldArgs:
+        AsyncCheckpointer(config["checkpointFile"]).remove()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="k-fold training of the roiVGGYolo MLP head")
+    parser.add_argument("--resume", action="store_true", help="continue an interrupted run from its fold checkpoints")
+    parser.add_argument("--patience", type=int, default=3, help="epochs without a better validation mse before a fold stops")
+    parser.add_argument("--maxEpochs", type=int, default=15, help="epoch budget per fold")
+    parser.add_argument("--foldMinutes", type=float, default=None, help="training time budget per fold")
+    args = parser.parse_args()
+    kFoldVGGYoloMLP(resume = args.resume, patience = args.patience, maxEpochs = args.maxEpochs, foldMinutes = args.foldMinutes)
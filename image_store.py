@@ -0,0 +1,85 @@
+import argparse
+import os
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+
+SPLITS = {
+    'training': os.path.join('training_split', 'training_images'),
+    'test': os.path.join('test_split', 'test_images'),
+}
+
+
+# Pre-decoded, pre-resized copy of a subject's images: one uint8 (N, size, size, 3) .npy per split and size,
+# plus the list of file names giving the row order. Rows hold exactly what transforms.Resize((size, size))
+# would produce, so only ToTensor/Normalize are left to do per access.
+class ImageStore:
+    def __init__(self, store_dir, split, size):
+        self.array_path = os.path.join(store_dir, f'{split}_{size}.npy')
+        with open(os.path.join(store_dir, f'{split}_images.txt')) as f:
+            self.names = f.read().splitlines()
+        self.rows = {name: i for i, name in enumerate(self.names)}
+        self.images = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getstate__(self):
+        # DataLoader workers reopen the memory map instead of receiving a pickled copy of it
+        state = self.__dict__.copy()
+        state['images'] = None
+        return state
+
+    def array(self):
+        if self.images is None:
+            self.images = np.load(self.array_path, mmap_mode='r')
+        return self.images
+
+    def row(self, name):
+        return self.array()[self.rows[os.path.basename(name)]]
+
+    def tensor(self, name):
+        # Same result as transforms.ToTensor() on the resized PIL image
+        img = torch.from_numpy(np.array(self.row(name)))
+        return img.permute(2, 0, 1).float().div(255)
+
+
+def build_image_store(subj_dir, store_dir=None, sizes=(224, 640)):
+    if store_dir is None:
+        store_dir = os.path.join(subj_dir, 'image_store')
+    os.makedirs(store_dir, exist_ok=True)
+    for split, img_dir in SPLITS.items():
+        img_dir = os.path.join(subj_dir, img_dir)
+        if not os.path.isdir(img_dir):
+            continue
+        names = sorted(os.listdir(img_dir))
+        arrays = {}
+        for size in sizes:
+            arrays[size] = np.lib.format.open_memmap(os.path.join(store_dir, f'{split}_{size}.npy.tmp'), mode='w+',
+                                                     dtype=np.uint8, shape=(len(names), size, size, 3))
+        # Decode each image once and resize it to every size
+        for i, name in enumerate(tqdm(names, desc=f'{split} images')):
+            img = Image.open(os.path.join(img_dir, name)).convert('RGB')
+            for size, array in arrays.items():
+                array[i] = np.asarray(img.resize((size, size), Image.BILINEAR))
+        for array in arrays.values():
+            array.flush()
+        arrays.clear()
+        for size in sizes:
+            os.replace(os.path.join(store_dir, f'{split}_{size}.npy.tmp'),
+                       os.path.join(store_dir, f'{split}_{size}.npy'))
+        with open(os.path.join(store_dir, f'{split}_images.txt'), 'w') as f:
+            f.write('\n'.join(names))
+    return store_dir
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert subject images into memory-mapped uint8 arrays')
+    parser.add_argument('--data_dir', default='../MQP/algonauts_2023_challenge_data/')
+    parser.add_argument('--subj', type=int, nargs='+', default=[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[224, 640])
+    args = parser.parse_args()
+    for subj in args.subj:
+        subj_dir = os.path.join(args.data_dir, 'subj' + format(subj, '02'))
+        print('Image store written to', build_image_store(subj_dir, sizes=tuple(args.sizes)))
@@ -0,0 +1,108 @@
+import argparse
+import contextlib
+import os
+import time
+import numpy as np
+import torch
+
+
+# Frozen backbones (VGG19 in LEM and the feature caches) are only ever run forward. InferenceModel runs one
+# with autograd off (torch.inference_mode), NHWC weights and inputs (channels_last, the layout oneDNN's CPU
+# convolutions prefer) and, optionally, CPU/GPU bfloat16 autocast. Outputs always come back as float32, so
+# callers (PCA, caches, .numpy()) never see another dtype.
+def inference_context(device, bfloat16=False):
+    stack = contextlib.ExitStack()
+    stack.enter_context(torch.inference_mode())
+    if bfloat16:
+        stack.enter_context(torch.autocast(torch.device(device).type, dtype=torch.bfloat16))
+    return stack
+
+
+def to_float32(output):
+    if isinstance(output, dict):
+        return {name: to_float32(value) for name, value in output.items()}
+    if isinstance(output, (list, tuple)):
+        return type(output)(to_float32(value) for value in output)
+    return output.float() if torch.is_floating_point(output) else output
+
+
+class InferenceModel:
+    def __init__(self, model, device, bfloat16=False, channels_last=True):
+        self.model = model.eval()
+        self.device = device
+        self.bfloat16 = bfloat16
+        self.channels_last = channels_last
+        if channels_last:
+            self.model.to(memory_format=torch.channels_last)
+
+    def __call__(self, x):
+        if self.channels_last and x.dim() == 4:
+            x = x.contiguous(memory_format=torch.channels_last)
+        with inference_context(self.device, self.bfloat16):
+            return to_float32(self.model(x))
+
+
+def drift(features, reference):
+    # How far features are from the float32 reference: worst element, relative L2 error and mean cosine similarity
+    features, reference = features.flatten(1).double(), reference.flatten(1).double()
+    return {
+        'max_abs': (features - reference).abs().max().item(),
+        'rel_l2': ((features - reference).norm() / reference.norm()).item(),
+        'cosine': torch.nn.functional.cosine_similarity(features, reference, dim=1).mean().item(),
+    }
+
+
+def feature_drift(model, batches, device, modes=(('channels_last', False), ('channels_last+bf16', True))):
+    # Runs every batch through the plain float32 model and through each InferenceModel mode,
+    # returning {mode: drift metrics and seconds per batch}
+    def run(forward):
+        outputs, seconds = [], 0
+        for batch in batches:
+            start = time.perf_counter()
+            out = forward(batch.to(device))
+            seconds += time.perf_counter() - start
+            outputs.append(torch.hstack([o.flatten(1) for o in out.values()]) if isinstance(out, dict) else out.flatten(1))
+        return torch.vstack(outputs).cpu(), seconds / len(batches)
+
+    model = model.to(device).eval()
+    with torch.no_grad():
+        reference, reference_seconds = run(model)
+    results = {'float32': dict(drift(reference, reference), seconds=reference_seconds)}
+    for name, bfloat16 in modes:
+        features, seconds = run(InferenceModel(model, device, bfloat16=bfloat16))
+        results[name] = dict(drift(features, reference), seconds=seconds)
+        model.to(memory_format=torch.contiguous_format)
+    return results
+
+
+if __name__ == "__main__":
+    from torchvision.models import vgg19, VGG19_Weights
+    from torchvision.models.feature_extraction import create_feature_extractor
+    import torchvision.transforms as transforms
+    from data import ImageDataset
+    from loaders import make_loader
+
+    parser = argparse.ArgumentParser(description='Feature drift and speed of the VGG19 inference modes against float32')
+    parser.add_argument('--data_dir', default='../MQP/algonauts_2023_challenge_data/')
+    parser.add_argument('--subj', type=int, default=1)
+    parser.add_argument('--num_images', type=int, default=128)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args()
+
+    img_dir = os.path.join(args.data_dir, 'subj' + format(args.subj, '02'), 'training_split', 'training_images')
+    img_paths = sorted(os.path.join(img_dir, name) for name in os.listdir(img_dir))[:args.num_images]
+    transform = transforms.Compose([
+        transforms.Resize((224, 224)),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    ])
+    batches = list(make_loader(ImageDataset(img_paths, np.arange(len(img_paths)), transform), args.batch_size))
+
+    vgg = vgg19(weights=VGG19_Weights.DEFAULT)
+    # avgpool is what LEM extracts, features[:35] is the conv5 map the gradCam models pool objects from
+    for name, model in (('avgpool', create_feature_extractor(vgg, return_nodes=['avgpool'])),
+                        ('conv5', vgg.features[:35])):
+        for mode, result in feature_drift(model, batches, args.device).items():
+            print(f"{name:8s} {mode:20s} max_abs={result['max_abs']:.3e} rel_l2={result['rel_l2']:.3e} "
+                  f"cosine={result['cosine']:.6f} {result['seconds'] * 1000:.1f} ms/batch")
@@ -0,0 +1,100 @@
+import argparse
+import itertools
+import os
+import sys
+import time
+import torch
+from torch.utils.data import DataLoader
+
+# DataLoader settings shared by every entry point (data.transformData, the gradCam scripts, the caches).
+# Each value can be overridden from the environment so a node is sized without editing code, e.g.
+# LOADER_NUM_WORKERS=16 LOADER_PREFETCH_FACTOR=4 python main.py ...
+# Workers are not persistent by default, one-off loaders (feature extraction, caches, evaluation) would otherwise keep
+# theirs alive for the whole run. Loaders iterated every epoch opt in with make_loader(..., persistent_workers=True).
+LOADER_CONFIG = {
+    'num_workers': int(os.environ.get('LOADER_NUM_WORKERS', min(4, os.cpu_count() or 1))),
+    'prefetch_factor': int(os.environ.get('LOADER_PREFETCH_FACTOR', 2)),
+    'persistent_workers': os.environ.get('LOADER_PERSISTENT_WORKERS', '0') == '1',
+    'pin_memory': os.environ.get('LOADER_PIN_MEMORY', '1' if torch.cuda.is_available() else '0') == '1',
+}
+
+
+def loader_settings(config=None, **overrides):
+    settings = dict(LOADER_CONFIG if config is None else config)
+    settings.update(overrides)
+    # prefetching and persistent workers only exist with worker processes
+    if settings['num_workers'] == 0:
+        settings['prefetch_factor'] = None
+        settings['persistent_workers'] = False
+    return settings
+
+
+def make_loader(dataset, batch_size, shuffle=False, collate_fn=None, config=None, **overrides):
+    return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, collate_fn=collate_fn,
+                      **loader_settings(config, **overrides))
+
+
+def images_per_second(dataset, batch_size, settings, num_batches=50):
+    # Steady-state throughput: the clock starts after the first batch so worker start-up is not counted
+    loader = make_loader(dataset, batch_size, shuffle=True, config=settings)
+    batches = iter(loader)
+    next(batches)
+    count = 0
+    start = time.perf_counter()
+    for batch in itertools.islice(batches, num_batches):
+        count += len(batch[0]) if isinstance(batch, (list, tuple)) else len(batch)
+    return count / (time.perf_counter() - start) if count else float('nan')
+
+
+def benchmark_datasets(data_dir, subj, workers, prefetch, batch_size=64, num_batches=50, meta_dir=None):
+    import torchvision.transforms as transforms
+    from data import ImageDataset
+    from image_store import ImageStore
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gradCam'))
+    from datasets import AlgonautsDataset, BalancedCocoSuperClassDataset
+
+    subj_dir = os.path.join(data_dir, 'subj' + format(subj, '02'))
+    img_dir = os.path.join(subj_dir, 'training_split', 'training_images')
+    img_paths = sorted(os.path.join(img_dir, name) for name in os.listdir(img_dir))
+    resize = transforms.Compose([transforms.Resize((224, 224)), transforms.ToTensor()])
+    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    datasets = {
+        'ImageDataset': ImageDataset(img_paths, range(len(img_paths)), transforms.Compose([resize, normalize])),
+        'AlgonautsDataset': AlgonautsDataset(data_dir, subj, transform=resize),
+        'AlgonautsDataset+yolo': AlgonautsDataset(data_dir, subj, transform=resize, yoloTransform=transforms.Compose([
+            transforms.Resize((640, 640)), transforms.ToTensor()])),
+    }
+    store_dir = os.path.join(subj_dir, 'image_store')
+    if os.path.isdir(store_dir):
+        datasets['ImageDataset (image store)'] = ImageDataset(img_paths, range(len(img_paths)), normalize,
+                                                              ImageStore(store_dir, 'training', 224))
+        datasets['AlgonautsDataset (image store)'] = AlgonautsDataset(
+            data_dir, subj, imageStore=ImageStore(store_dir, 'training', 224))
+    if meta_dir is not None:
+        datasets['BalancedCocoSuperClassDataset'] = BalancedCocoSuperClassDataset(data_dir, meta_dir, tsfms=resize)
+
+    results = []
+    for name, dataset in datasets.items():
+        for num_workers, prefetch_factor in itertools.product(workers, prefetch):
+            if num_workers == 0 and prefetch_factor != prefetch[0]:
+                continue  # prefetching does nothing without workers
+            settings = loader_settings(num_workers=num_workers, prefetch_factor=prefetch_factor,
+                                       persistent_workers=False)
+            rate = images_per_second(dataset, batch_size, settings, num_batches)
+            results.append((name, num_workers, prefetch_factor if num_workers else '-', rate))
+            print(f'{name:32s} workers={num_workers:<3d} prefetch={results[-1][2]!s:<3s} {rate:9.1f} images/sec')
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Images/sec of each dataset class under different DataLoader settings')
+    parser.add_argument('--data_dir', default='../MQP/algonauts_2023_challenge_data/')
+    parser.add_argument('--subj', type=int, default=1)
+    parser.add_argument('--meta_dir', default=None, help='COCO metadata folder, adds BalancedCocoSuperClassDataset')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2, 4, 8, 16])
+    parser.add_argument('--prefetch', type=int, nargs='+', default=[2, 4])
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--num_batches', type=int, default=50)
+    args = parser.parse_args()
+    benchmark_datasets(args.data_dir, args.subj, args.workers, args.prefetch, args.batch_size, args.num_batches,
+                       args.meta_dir)
@@ -5,7 +5,9 @@ import torch
 from nilearn import plotting
 import data
 import visualize
-from words import make_classifications, Predictions
+from words import make_classifications, Predictions, HemispherePredictions
+from detections import DetectionStore
+from fmri import load_fmri
 from data import normalize_fmri_data, unnormalize_fmri_data, analyze_results
 from LEM import extract_data_features, predAccuracy
 from visualize import plot_predictions
@@ -22,12 +24,17 @@ def main():
     # setting up the directories and ARGS
     data_dir = '../MQP/algonauts_2023_challenge_data/'
     parent_submission_dir = '../submission'
+    feature_cache_dir = os.path.join(data_dir, 'feature_cache')
+    split_seed = 0
+    fit_chunk_size = 1024
+    # np.float16 reads the fMRI from a half precision working copy written next to it (fmri.load_fmri)
+    fmri_dtype = None
     subj = 1  # @param ["1", "2", "3", "4", "5", "6", "7", "8"] {type:"raw", allow-input: true}
 
     args = argObj(data_dir, parent_submission_dir, subj)
     fmri_dir = os.path.join(args.data_dir, 'training_split', 'training_fmri')
-    lh_fmri = np.load(os.path.join(fmri_dir, 'lh_training_fmri.npy'))
-    rh_fmri = np.load(os.path.join(fmri_dir, 'rh_training_fmri.npy'))
+    lh_fmri = load_fmri(fmri_dir, 'left', fmri_dtype)
+    rh_fmri = load_fmri(fmri_dir, 'right', fmri_dtype)
 
     words = ['furniture', 'food', 'kitchenware', 'appliance', 'person', 'animal', 'vehicle', 'accessory',
              'electronics', 'sports', 'traffic', 'outdoor', 'home', 'clothing', 'hygiene', 'toy', 'plumbing',
@@ -35,7 +42,7 @@ def main():
 
     print("________ Process Data ________")
 
-    # Normalize Data Before Split
+    # Normalize Data Before Split, the memory maps are clipped and scaled as rows are read, never copied whole
     lh_fmri, lh_data_min, lh_data_max = normalize_fmri_data(lh_fmri)
     rh_fmri, rh_data_min, rh_data_max = normalize_fmri_data(rh_fmri)
 
@@ -59,7 +66,8 @@ def main():
 
     print("________ Split Data ________")
 
-    idxs_train, idxs_val, idxs_test = data.splitdata(train_img_list, test_img_list, train_img_dir)
+    idxs_train, idxs_val, idxs_test = data.splitdata(train_img_list, test_img_list, train_img_dir, seed=split_seed,
+                                                     manifest_path=os.path.join(args.data_dir, 'split_manifest.json'))
     lh_fmri_train = lh_fmri[idxs_train]
     rh_fmri_train = rh_fmri[idxs_train]
     lh_fmri_val = lh_fmri[idxs_val]
@@ -74,32 +82,41 @@ def main():
 
     print("________ Make Classifications ________")
 
-    lh_classifications = make_classifications(train_images, idxs_train, device)
+    # Letterboxed like YOLO does for image files, the same detections make_classifications got without a store
+    detection_store = DetectionStore(os.path.join(data_dir, 'detection_store'), device=device, preprocess='letterbox')
+    lh_classifications = make_classifications(train_images, idxs_train, device, detection_store=detection_store)
     rh_classifications = lh_classifications
-    lh_classifications_val = make_classifications(val_images, idxs_val, device)
+    lh_classifications_val = make_classifications(val_images, idxs_val, device, detection_store=detection_store)
     rh_classifications_val = lh_classifications_val
 
     torch.cuda.empty_cache()
 
     print("________ Extract Image Features ________")
 
+    # Use the pre-decoded images written by image_store.py when they exist
+    image_store_dir = os.path.join(args.data_dir, 'image_store')
+    if not os.path.isdir(image_store_dir):
+        image_store_dir = None
     train_imgs_dataloader, val_imgs_dataloader, test_imgs_dataloader = (
-        data.transformData(train_img_dir, test_img_dir, idxs_train, idxs_val, idxs_test, 64))
+        data.transformData(train_img_dir, test_img_dir, idxs_train, idxs_val, idxs_test, 64, image_store_dir))
 
     features_train, features_val, features_test = (
-        extract_data_features(train_imgs_dataloader, val_imgs_dataloader, test_imgs_dataloader, 64, device))
+        extract_data_features(train_imgs_dataloader, val_imgs_dataloader, test_imgs_dataloader, 64, device,
+                              cache_dir=feature_cache_dir))
 
     print("________ LEARN MORE ________")
 
-    LH_train_class, LH_train_FMRI = data.organize_input(lh_classifications, features_train, lh_fmri_train)
-    LH_val_class, LH_val_FMRI = data.organize_input(lh_classifications_val, features_val, lh_fmri_val)
-    RH_train_class, RH_train_FMRI = data.organize_input(rh_classifications, features_train, rh_fmri_train)
-    RH_val_class, RH_val_FMRI = data.organize_input(rh_classifications_val, features_val, rh_fmri_val)
+    # Both hemispheres use the same images and classifications, so the design matrix is built once
+    train_class, LH_train_FMRI = data.organize_input(lh_classifications, features_train, lh_fmri_train)
+    val_class, LH_val_FMRI = data.organize_input(lh_classifications_val, features_val, lh_fmri_val)
+    RH_train_FMRI, RH_val_FMRI = rh_fmri_train, rh_fmri_val
 
     print("________ Predictions ________")
 
-    lh_fmri_val_pred = Predictions(LH_train_class, LH_train_FMRI, LH_val_class, LH_val_FMRI)
-    rh_fmri_val_pred = Predictions(RH_train_class, RH_train_FMRI, RH_val_class, RH_val_FMRI)
+    # One ridge fit for LH and RH together, sharing the factorization of the design. The training fMRI
+    # is streamed from its memory maps into the fit fit_chunk_size rows at a time, never loaded whole
+    (lh_fmri_val_pred, rh_fmri_val_pred), (lh_weights, rh_weights) = HemispherePredictions(
+        train_class, LH_train_FMRI, RH_train_FMRI, val_class, LH_val_FMRI, RH_val_FMRI, chunk_size=fit_chunk_size)
 
     print("________ Analyze Results ________")
 
@@ -111,22 +128,23 @@ def main():
     DT = tree.DecisionTreeRegressor()
     MLP = MLPRegressor()
     print("________ Linear Regression Predictions ________")
-    lh_fmri_val_pred = Predictions(LH_train_class, LH_train_FMRI, LH_val_class, LR)
-    rh_fmri_val_pred = Predictions(RH_train_class, RH_train_FMRI, RH_val_class, LR)
+    lh_fmri_val_pred = Predictions(train_class, LH_train_FMRI, val_class, LR)
+    rh_fmri_val_pred = Predictions(train_class, RH_train_FMRI, val_class, LR)
 
     
     print("________ Decision Tree Predictions ________")
-    lh_fmri_val_pred = Predictions(LH_train_class, LH_train_FMRI, LH_val_class, DT)
-    rh_fmri_val_pred = Predictions(RH_train_class, RH_train_FMRI, RH_val_class,DT)
+    lh_fmri_val_pred = Predictions(train_class, LH_train_FMRI, val_class, DT)
+    rh_fmri_val_pred = Predictions(train_class, RH_train_FMRI, val_class,DT)
 
     
     print("________ MLP Predictions ________")
-    lh_fmri_val_pred = Predictions(LH_train_class, LH_train_FMRI, LH_val_class, MLP)
-    rh_fmri_val_pred = Predictions(RH_train_class, RH_train_FMRI, RH_val_class, MLP)
+    lh_fmri_val_pred = Predictions(train_class, LH_train_FMRI, val_class, MLP)
+    rh_fmri_val_pred = Predictions(train_class, RH_train_FMRI, val_class, MLP)
 
     print("________ Re-Load Data ________")
-    lh_fmri = np.load(os.path.join(fmri_dir, 'lh_training_fmri.npy'))
-    rh_fmri = np.load(os.path.join(fmri_dir, 'rh_training_fmri.npy'))
+    # Memory mapped again, only the validation rows are read when they are used
+    lh_fmri = load_fmri(fmri_dir, 'left', fmri_dtype)
+    rh_fmri = load_fmri(fmri_dir, 'right', fmri_dtype)
 
     lh_fmri_val = lh_fmri[idxs_val]
     rh_fmri_val = rh_fmri[idxs_val]
@@ -0,0 +1,245 @@
+import numpy as np
+from scipy import linalg
+
+
+# Alpha grid for per-vertex selection, log spaced like RidgeCV grids usually are
+DEFAULT_ALPHAS = np.logspace(-2, 6, 17)
+
+
+def column_blocks(num_columns, block_size):
+    for start in range(0, num_columns, block_size):
+        yield slice(start, min(start + block_size, num_columns))
+
+
+def row_chunks(features, fmri, chunk_size=1024, transform=None):
+    # (design rows, fMRI rows) chunks for RidgeEncoder.fit_chunks, read straight from row-indexable memory maps
+    # (FeatureCache features, load_fmri) so only one chunk of either is in memory at a time.
+    # transform(rows, chunk) turns raw feature rows into design rows, e.g. a PCA projection plus class ids
+    # fmri can be a tuple of targets (LH, RH), the chunks then hold a tuple of their rows
+    for start in range(0, len(features), chunk_size):
+        rows = slice(start, min(start + chunk_size, len(features)))
+        chunk = np.asarray(features[rows])
+        targets = tuple(np.asarray(f[rows], dtype=np.float32) for f in fmri) if isinstance(fmri, tuple) \
+            else np.asarray(fmri[rows], dtype=np.float32)
+        yield chunk if transform is None else transform(rows, chunk), targets
+
+
+# Multi-output ridge regression for the encoding models. Every vertex is regressed on the same design matrix,
+# so X^T X (features x features, small) is factorized once in float64 and all vertex columns are solved from
+# that one factorization. The big products, X^T Y and the predictions, are float32 BLAS calls over blocks of
+# vertices, so no float64 copy of the targets is ever made. The intercept is not penalized (X and Y are centered).
+# With alphas, every vertex gets its own alpha from the grid instead: X^T X is eigendecomposed once (its
+# eigenvectors/values are the SVD of X) and each alpha is scored for every vertex by generalized cross-validation
+# ('gcv', computed in the small coefficient space, cheaper than the fit itself) or exact leave-one-out ('loo',
+# closed form through the hat matrix diagonal, one extra (samples x vertices) product per alpha).
+# fit_chunks/partial_fit fit out of core: only X^T X, X^T Y and column sums are kept (float64), so memory no
+# longer grows with the number of stimuli; the solve at the end is the same, GCV included (LOO needs the rows).
+# fit_targets (or tuples of targets in partial_fit) regress several target matrices on the same design, like the
+# LH and RH fMRI, with one centering and one factorization; predict_targets/target_weights split them back up.
+class RidgeEncoder:
+    def __init__(self, alpha=1.0, fit_intercept=True, block_size=4096, alphas=None, alpha_selection='gcv'):
+        if alpha_selection not in ('gcv', 'loo'):
+            raise ValueError(f"alpha_selection must be 'gcv' or 'loo', not {alpha_selection!r}")
+        self.alpha = alpha
+        self.fit_intercept = fit_intercept
+        self.block_size = block_size
+        self.alphas = None if alphas is None else np.sort(np.asarray(alphas, dtype=np.float64))
+        self.alpha_selection = alpha_selection
+        self.reset()
+
+    def fit(self, X, Y):
+        return self.fit_targets(X, [Y])
+
+    def fit_targets(self, X, targets):
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        targets = [np.asarray(Y, dtype=np.float32) for Y in targets]
+        num_columns = self.set_splits([Y.shape[1] for Y in targets])
+        self.x_mean = X.mean(axis=0, dtype=np.float64) if self.fit_intercept else np.zeros(X.shape[1])
+        X = X - self.x_mean.astype(np.float32)
+        gram = X.T.astype(np.float64) @ X.astype(np.float64)
+        if self.alphas is None:
+            solve = self.factorize(gram)
+        else:
+            spectrum = self.spectrum(gram)
+            # LOO needs the left singular vectors, U = X V / s
+            U = (X @ spectrum[1].astype(np.float32)) / np.sqrt(spectrum[0]).astype(np.float32) if self.alpha_selection == 'loo' else None
+            self.vertex_alpha = np.empty(num_columns)
+
+        self.coef = np.empty((X.shape[1], num_columns), dtype=np.float32)
+        self.intercept = np.zeros(num_columns, dtype=np.float32)
+        for Y, target_block, block in self.target_blocks(targets):
+            Y_block = Y[:, target_block]
+            y_mean = Y_block.mean(axis=0, dtype=np.float64) if self.fit_intercept else np.zeros(Y_block.shape[1])
+            # Centered in float32 too, a large mean would otherwise cancel inside the float32 product
+            if self.fit_intercept:
+                Y_block = Y_block - y_mean.astype(np.float32)
+            xty = X.T @ Y_block
+            if self.alphas is None:
+                self.coef[:, block] = solve(xty)
+            else:
+                if U is None:
+                    y_sq = np.einsum('ij,ij->j', Y_block, Y_block, dtype=np.float64)
+                    self.coef[:, block], self.vertex_alpha[block] = self.gcv_columns(spectrum, xty, y_sq, len(Y_block))
+                else:
+                    R = self.project(spectrum, xty)
+                    best = self.loo_scores(spectrum, R, U, Y_block).argmin(axis=0)
+                    self.coef[:, block], self.vertex_alpha[block] = self.select_coef(spectrum, R, best), self.alphas[best]
+            # X is centered, so the intercept is just the mean of the targets
+            self.intercept[block] = y_mean
+        self.intercept -= self.x_mean.astype(np.float32) @ self.coef
+        return self
+
+    def set_splits(self, sizes):
+        # Columns of each target in coef/intercept/vertex_alpha
+        ends = np.cumsum(sizes)
+        self.splits = [slice(int(end - size), int(end)) for size, end in zip(sizes, ends)]
+        return int(ends[-1])
+
+    def target_blocks(self, targets):
+        # (target, block of its columns, the same columns in coef) over every target
+        for Y, columns in zip(targets, self.splits):
+            for block in column_blocks(Y.shape[1], self.block_size):
+                yield Y, block, slice(columns.start + block.start, columns.start + block.stop)
+
+    def fit_chunks(self, chunks):
+        # chunks yields (X rows, Y rows), e.g. row_chunks(cached features, load_fmri(...))
+        self.reset()
+        for X, Y in chunks:
+            self.partial_fit(X, Y)
+        return self.finalize()
+
+    def reset(self):
+        self.num_samples = 0
+        self.x_shift = self.y_shift = None
+
+    def partial_fit(self, X, Y):
+        X = np.asarray(X, dtype=np.float64)
+        # A tuple of targets is one chunk of each, e.g. (LH rows, RH rows)
+        targets = Y if isinstance(Y, tuple) else (Y,)
+        Y = np.hstack([np.asarray(target, dtype=np.float32) for target in targets])
+        if self.x_shift is None:
+            self.set_splits([np.shape(target)[1] for target in targets])
+            # Sums are taken around the first chunk's means, so centering at the end doesn't cancel large values
+            self.x_shift = X.mean(axis=0) if self.fit_intercept else np.zeros(X.shape[1])
+            self.y_shift = Y.mean(axis=0, dtype=np.float64) if self.fit_intercept else np.zeros(Y.shape[1])
+            self.num_samples = 0
+            self.x_sum, self.xtx = np.zeros(X.shape[1]), np.zeros((X.shape[1], X.shape[1]))
+            self.y_sum, self.y_sq = np.zeros(Y.shape[1]), np.zeros(Y.shape[1])
+            self.xty = np.zeros((X.shape[1], Y.shape[1]))
+        X = X - self.x_shift
+        self.num_samples += len(X)
+        self.x_sum += X.sum(axis=0)
+        self.xtx += X.T @ X
+        # Only a block of the chunk's columns is ever converted to float64
+        for block in column_blocks(Y.shape[1], self.block_size):
+            Y_block = Y[:, block] - self.y_shift[block]
+            self.y_sum[block] += Y_block.sum(axis=0)
+            self.y_sq[block] += np.einsum('ij,ij->j', Y_block, Y_block)
+            self.xty[:, block] += X.T @ Y_block
+        return self
+
+    def finalize(self):
+        # Solve from the accumulated sums: centered X^T X, X^T Y and ||y||^2 are the raw sums minus n * mean products
+        if self.alphas is not None and self.alpha_selection == 'loo':
+            raise ValueError("leave-one-out needs every row, use alpha_selection='gcv' for a chunked fit")
+        n = self.num_samples
+        x_mean, y_mean = self.x_sum / n, self.y_sum / n
+        if not self.fit_intercept:
+            x_mean, y_mean = np.zeros_like(x_mean), np.zeros_like(y_mean)
+        gram = self.xtx - n * np.outer(x_mean, x_mean)
+        if self.alphas is None:
+            solve = self.factorize(gram)
+        else:
+            spectrum = self.spectrum(gram)
+            self.vertex_alpha = np.empty(len(y_mean))
+
+        self.coef = np.empty(self.xty.shape, dtype=np.float32)
+        for block in column_blocks(len(y_mean), self.block_size):
+            xty = self.xty[:, block] - n * np.outer(x_mean, y_mean[block])
+            if self.alphas is None:
+                self.coef[:, block] = solve(xty)
+            else:
+                y_sq = self.y_sq[block] - n * y_mean[block] ** 2
+                self.coef[:, block], self.vertex_alpha[block] = self.gcv_columns(spectrum, xty, y_sq, n)
+        self.x_mean = self.x_shift + x_mean
+        self.intercept = ((self.y_shift + y_mean) - self.x_mean @ self.coef).astype(np.float32) if self.fit_intercept \
+            else np.zeros(len(y_mean), dtype=np.float32)
+        return self
+
+    def spectrum(self, gram):
+        # X^T X = V diag(s^2) V^T, directions X has (numerically) no variance along are dropped
+        eigenvalues, eigenvectors = linalg.eigh(gram, check_finite=False)
+        keep = eigenvalues > max(eigenvalues.max(), 0) * len(gram) * np.finfo(np.float64).eps
+        return eigenvalues[keep], eigenvectors[:, keep]
+
+    def project(self, spectrum, xty):
+        # U^T Y = diag(1/s) V^T X^T Y
+        return spectrum[1].T @ xty.astype(np.float64) / np.sqrt(spectrum[0])[:, None]
+
+    def gcv_columns(self, spectrum, xty, y_sq, num_samples):
+        # Weights and alpha of every column from its GCV scores
+        R = self.project(spectrum, xty)
+        best = self.gcv_scores(spectrum, R, y_sq, num_samples).argmin(axis=0)
+        return self.select_coef(spectrum, R, best), self.alphas[best]
+
+    def shrinkage(self, spectrum):
+        # d = s^2 / (s^2 + alpha), one row per alpha
+        return spectrum[0] / (spectrum[0] + self.alphas[:, None])
+
+    def gcv_scores(self, spectrum, R, y_sq, num_samples):
+        # R = U^T Y, so the residual sum of squares of every alpha is ||y||^2 - sum((2d - d^2) R^2) and
+        # GCV = RSS / n / (1 - tr(H) / n)^2 with tr(H) = sum(d) (+1 for the intercept)
+        d = self.shrinkage(spectrum)
+        rss = np.maximum(y_sq - (2 * d - d ** 2) @ R ** 2, 0)
+        trace = d.sum(axis=1) + self.fit_intercept
+        return rss / num_samples / ((1 - trace / num_samples) ** 2)[:, None]
+
+    def loo_scores(self, spectrum, R, U, Y_centered):
+        # Leave-one-out residuals are (y - y_hat) / (1 - h) with h the hat matrix diagonal sum(U^2 d) (+1/n)
+        d = self.shrinkage(spectrum)
+        U_sq = U ** 2
+        scores = np.empty((len(self.alphas), Y_centered.shape[1]))
+        for i, d_alpha in enumerate(d):
+            leverage = U_sq @ d_alpha.astype(np.float32) + self.fit_intercept / len(U)
+            residual = (Y_centered - U @ (d_alpha[:, None] * R).astype(np.float32)) / (1 - leverage)[:, None]
+            scores[i] = np.einsum('ij,ij->j', residual, residual, dtype=np.float64) / len(U)
+        return scores
+
+    def select_coef(self, spectrum, R, best):
+        # W = V diag(s / (s^2 + alpha)) U^T Y with each vertex's own alpha
+        s = np.sqrt(spectrum[0])
+        factor = s / (spectrum[0] + self.alphas[best][:, None])
+        return (spectrum[1] @ (factor.T * R)).astype(np.float32)
+
+    def factorize(self, gram):
+        # Cholesky of X^T X + alpha I, or a pseudo-inverse through its eigendecomposition when that is singular
+        # (alpha=0 with constant or duplicated features), which gives the same least squares solution as lstsq
+        gram = gram + self.alpha * np.eye(len(gram))
+        try:
+            factor = linalg.cho_factor(gram, check_finite=False)
+            return lambda xty: linalg.cho_solve(factor, xty.astype(np.float64), check_finite=False).astype(np.float32)
+        except linalg.LinAlgError:
+            eigenvalues, eigenvectors = linalg.eigh(gram, check_finite=False)
+            keep = eigenvalues > eigenvalues.max() * len(gram) * np.finfo(np.float64).eps
+            projection = (eigenvectors[:, keep] / eigenvalues[keep]) @ eigenvectors[:, keep].T
+            return lambda xty: (projection @ xty.astype(np.float64)).astype(np.float32)
+
+    def predict(self, X):
+        return np.ascontiguousarray(X, dtype=np.float32) @ self.coef + self.intercept
+
+    def predict_targets(self, X):
+        # One prediction per target (views into one prediction matrix)
+        predictions = self.predict(X)
+        return [predictions[:, columns] for columns in self.splits]
+
+    def target_weights(self):
+        # (weights (features x vertices), intercept) of each target
+        return [(self.coef[:, columns], self.intercept[columns]) for columns in self.splits]
+
+    def score(self, X, Y):
+        # R^2 averaged over vertices, what sklearn's LinearRegression.score reports
+        Y = np.asarray(Y, dtype=np.float32)
+        residual = ((Y - self.predict(X)) ** 2).sum(axis=0, dtype=np.float64)
+        total = ((Y - Y.mean(axis=0, dtype=np.float64)) ** 2).sum(axis=0, dtype=np.float64)
+        r2 = np.where(total > 0, 1 - residual / np.where(total > 0, total, 1), (residual == 0).astype(np.float64))
+        return r2.mean()
@@ -0,0 +1,113 @@
+import os
+import uuid
+import numpy as np
+from scipy import sparse
+
+# ROI classes of the challenge data and the ROIs each one contains
+ROI_CLASSES = {
+    'prf-visualrois': ["V1v", "V1d", "V2v", "V2d", "V3v", "V3d", "hV4"],
+    'floc-bodies': ["EBA", "FBA-1", "FBA-2", "mTL-bodies"],
+    'floc-faces': ["OFA", "FFA-1", "FFA-2", "mTL-faces", "aTL-faces"],
+    'floc-places': ["OPA", "PPA", "RSC"],
+    'floc-words': ["OWFA", "VWFA-1", "VWFA-2", "mfs-words", "mTL-words"],
+    'streams': ["early", "midventral", "midlateral", "midparietal", "ventral", "lateral", "parietal"],
+}
+ROIS = [roi for rois in ROI_CLASSES.values() for roi in rois]
+ROI_CLASS_OF = {roi: roi_class for roi_class, rois in ROI_CLASSES.items() for roi in rois}
+
+atlases = {}
+
+
+# One atlas per roi_masks folder and hemisphere for the whole process
+def load_atlas(roi_dir, hemisphere):
+    key = (os.path.abspath(roi_dir), hemisphere[0])
+    if key not in atlases:
+        atlases[key] = ROIAtlas(roi_dir, hemisphere)
+    return atlases[key]
+
+
+# Every mask file of a subject's hemisphere loaded once, with the vertex indices of
+# each ROI precomputed in both challenge and fsaverage space
+class ROIAtlas:
+    def __init__(self, roi_dir, hemisphere):
+        self.roi_dir = roi_dir
+        self.hemi = hemisphere[0]
+        self.mappings = {}
+        self.challenge_classes = {}
+        self.fsaverage_classes = {}
+        self.challenge_idxs = {}
+        self.fsaverage_idxs = {}
+        self.names = []
+        for roi_class in ROI_CLASSES:
+            self.mappings[roi_class] = np.load(os.path.join(roi_dir, 'mapping_' + roi_class + '.npy'),
+                                               allow_pickle=True).item()
+            self.challenge_classes[roi_class] = np.load(
+                os.path.join(roi_dir, self.hemi + 'h.' + roi_class + '_challenge_space.npy'))
+            self.fsaverage_classes[roi_class] = np.load(
+                os.path.join(roi_dir, self.hemi + 'h.' + roi_class + '_fsaverage_space.npy'))
+            for roi_id, roi in self.mappings[roi_class].items():
+                if roi_id != 0:  # zeros indicate to vertices falling outside the ROIs
+                    self.names.append(roi)
+                    self.challenge_idxs[roi] = np.where(self.challenge_classes[roi_class] == roi_id)[0]
+                    self.fsaverage_idxs[roi] = np.where(self.fsaverage_classes[roi_class] == roi_id)[0]
+        self.fsaverage_all_vertices = np.load(os.path.join(roi_dir, self.hemi + 'h.all-vertices_fsaverage_space.npy'))
+        self.fsaverage_vertex_idxs = np.where(self.fsaverage_all_vertices)[0]
+        self.num_fsaverage_vertices = len(self.fsaverage_all_vertices)
+        self.num_challenge_vertices = len(self.challenge_classes['prf-visualrois'])
+
+    def roi_class(self, roi):
+        return ROI_CLASS_OF[roi]
+
+    def class_rois(self, roi_class):
+        return [roi for roi_id, roi in self.mappings[roi_class].items() if roi_id != 0]
+
+    def challenge_indices(self, roi):
+        return self.challenge_idxs[roi]
+
+    def fsaverage_indices(self, roi):
+        return self.fsaverage_idxs[roi]
+
+    def fsaverage_mask(self, roi):
+        # 0/1 surface map of the ROI, what `fsaverage_roi_class == roi_mapping` used to give
+        mask = np.zeros(self.num_fsaverage_vertices, dtype=int)
+        mask[self.fsaverage_idxs[roi]] = 1
+        return mask
+
+    def membership(self, rois=ROIS):
+        # Sparse (challenge vertices x ROIs) matrix holding 1 / ROI size for the vertices of each ROI
+        idxs = [self.challenge_idxs[roi] for roi in rois]
+        rows = np.concatenate(idxs)
+        cols = np.concatenate([np.full(len(idx), i) for i, idx in enumerate(idxs)])
+        data = np.concatenate([np.full(len(idx), 1 / max(len(idx), 1), dtype=np.float32) for idx in idxs])
+        return sparse.csr_matrix((data, (rows, cols)), shape=(self.num_challenge_vertices, len(rois)))
+
+    def roi_averages(self, fmri, rois=ROIS, chunk_size=512):
+        # Mean fMRI value of each ROI per stimulus as one sparse product per block of rows,
+        # ROIs without vertices get NaN like the mean of an empty selection did
+        membership_t = self.membership(rois).T.tocsr()
+        averages = np.empty((len(fmri), len(rois)))
+        for start in range(0, len(fmri), chunk_size):
+            averages[start:start + chunk_size] = membership_t.dot(np.asarray(fmri[start:start + chunk_size]).T).T
+        averages[:, [len(self.challenge_idxs[roi]) == 0 for roi in rois]] = np.nan
+        return averages
+
+    def mask_files(self):
+        # The files the challenge space ROI indices (and so roi_averages) come from
+        return [os.path.join(self.roi_dir, name) for roi_class in ROI_CLASSES
+                for name in ['mapping_' + roi_class + '.npy', self.hemi + 'h.' + roi_class + '_challenge_space.npy']]
+
+    def cached_roi_averages(self, fmri_file, fmri, rois=ROIS):
+        # roi_averages of the whole fmri_file, kept in an .npz next to it until the file or a ROI mask changes
+        cache_file = os.path.splitext(fmri_file)[0] + '_roi_averages.npz'
+        stats = [os.stat(path) for path in [fmri_file] + self.mask_files()]
+        source = ';'.join(f'{stat.st_size}:{stat.st_mtime_ns}' for stat in stats)
+        if os.path.exists(cache_file):
+            cached = np.load(cache_file)
+            if str(cached['source']) == source and list(cached['rois']) == list(rois):
+                return cached['values']
+        values = self.roi_averages(fmri, rois)
+        tmp_file = cache_file + '.' + uuid.uuid4().hex + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, source=source, rois=np.array(rois), values=values)
+        os.replace(tmp_file, cache_file)
+        return values
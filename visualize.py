@@ -3,15 +3,14 @@ import numpy as np
 from matplotlib import pyplot as plt
 from nilearn import datasets, plotting
 from PIL import Image
+from roi_atlas import load_atlas
 
 
 def plotAllVertices(args):
     hemisphere = 'left'  # @param ['left', 'right'] {allow-input: true}
 
     # Load the brain surface map of all vertices
-    roi_dir = os.path.join(args.data_dir, 'roi_masks',
-                           hemisphere[0] + 'h.all-vertices_fsaverage_space.npy')
-    fsaverage_all_vertices = np.load(roi_dir)
+    fsaverage_all_vertices = load_atlas(os.path.join(args.data_dir, 'roi_masks'), hemisphere).fsaverage_all_vertices
 
     # Create the interactive brain surface map
     fsaverage = datasets.fetch_surf_fsaverage('fsaverage')
@@ -33,31 +32,8 @@ def plotROI(args, hemisphere, roi):
     # "aTL-faces", "OPA", "PPA", "RSC", "OWFA", "VWFA-1", "VWFA-2", "mfs-words", "mTL-words", "early", "midventral",
     # "midlateral", "midparietal", "ventral", "lateral", "parietal"] {allow-input: true}
 
-    # Define the ROI class based on the selected ROI
-    if roi in ["V1v", "V1d", "V2v", "V2d", "V3v", "V3d", "hV4"]:
-        roi_class = 'prf-visualrois'
-    elif roi in ["EBA", "FBA-1", "FBA-2", "mTL-bodies"]:
-        roi_class = 'floc-bodies'
-    elif roi in ["OFA", "FFA-1", "FFA-2", "mTL-faces", "aTL-faces"]:
-        roi_class = 'floc-faces'
-    elif roi in ["OPA", "PPA", "RSC"]:
-        roi_class = 'floc-places'
-    elif roi in ["OWFA", "VWFA-1", "VWFA-2", "mfs-words", "mTL-words"]:
-        roi_class = 'floc-words'
-    elif roi in ["early", "midventral", "midlateral", "midparietal", "ventral", "lateral", "parietal"]:
-        roi_class = 'streams'
-
-    # Load the ROI brain surface maps
-    roi_class_dir = os.path.join(args.data_dir, 'roi_masks',
-                                 hemisphere[0] + 'h.' + roi_class + '_fsaverage_space.npy')
-    roi_map_dir = os.path.join(args.data_dir, 'roi_masks',
-                               'mapping_' + roi_class + '.npy')
-    fsaverage_roi_class = np.load(roi_class_dir)
-    roi_map = np.load(roi_map_dir, allow_pickle=True).item()
-
     # Select the vertices corresponding to the ROI of interest
-    roi_mapping = list(roi_map.keys())[list(roi_map.values()).index(roi)]
-    fsaverage_roi = np.asarray(fsaverage_roi_class == roi_mapping, dtype=int)
+    fsaverage_roi = load_atlas(os.path.join(args.data_dir, 'roi_masks'), hemisphere).fsaverage_mask(roi)
 
     # Create the interactive brain surface map
     fsaverage = datasets.fetch_surf_fsaverage('fsaverage')
@@ -83,16 +59,14 @@ def plotFMRIfromIMG(args, train_img_dir, train_img_list, lh_fmri, rh_fmri):
 
 
     # Load the brain surface map of all vertices
-    roi_dir = os.path.join(args.data_dir, 'roi_masks',
-                           hemisphere[0] + 'h.all-vertices_fsaverage_space.npy')
-    fsaverage_all_vertices = np.load(roi_dir)
+    atlas = load_atlas(os.path.join(args.data_dir, 'roi_masks'), hemisphere)
 
     # Map the fMRI data onto the brain surface map
-    fsaverage_response = np.zeros(len(fsaverage_all_vertices))
+    fsaverage_response = np.zeros(atlas.num_fsaverage_vertices)
     if hemisphere == 'left':
-        fsaverage_response[np.where(fsaverage_all_vertices)[0]] = lh_fmri[img]
+        fsaverage_response[atlas.fsaverage_vertex_idxs] = lh_fmri[img]
     elif hemisphere == 'right':
-        fsaverage_response[np.where(fsaverage_all_vertices)[0]] = rh_fmri[img]
+        fsaverage_response[atlas.fsaverage_vertex_idxs] = rh_fmri[img]
 
     # Create the interactive brain surface map
     fsaverage = datasets.fetch_surf_fsaverage('fsaverage')
@@ -126,43 +100,19 @@ def plotFMRIfromIMGandROI(args, train_img_dir, train_img_list, lh_fmri, rh_fmri,
     plt.imshow(train_img)
     plt.title('Training image: ' + str(img + 1));
 
-    if roi in ["V1v", "V1d", "V2v", "V2d", "V3v", "V3d", "hV4"]:
-        roi_class = 'prf-visualrois'
-    elif roi in ["EBA", "FBA-1", "FBA-2", "mTL-bodies"]:
-        roi_class = 'floc-bodies'
-    elif roi in ["OFA", "FFA-1", "FFA-2", "mTL-faces", "aTL-faces"]:
-        roi_class = 'floc-faces'
-    elif roi in ["OPA", "PPA", "RSC"]:
-        roi_class = 'floc-places'
-    elif roi in ["OWFA", "VWFA-1", "VWFA-2", "mfs-words", "mTL-words"]:
-        roi_class = 'floc-words'
-    elif roi in ["early", "midventral", "midlateral", "midparietal", "ventral", "lateral", "parietal"]:
-        roi_class = 'streams'
-
-    # Load the ROI brain surface maps
-    challenge_roi_class_dir = os.path.join(args.data_dir, 'roi_masks',
-                                           hemisphere[0] + 'h.' + roi_class + '_challenge_space.npy')
-    fsaverage_roi_class_dir = os.path.join(args.data_dir, 'roi_masks',
-                                           hemisphere[0] + 'h.' + roi_class + '_fsaverage_space.npy')
-    roi_map_dir = os.path.join(args.data_dir, 'roi_masks',
-                               'mapping_' + roi_class + '.npy')
-    challenge_roi_class = np.load(challenge_roi_class_dir)
-    fsaverage_roi_class = np.load(fsaverage_roi_class_dir)
-    roi_map = np.load(roi_map_dir, allow_pickle=True).item()
-
     # Select the vertices corresponding to the ROI of interest
-    roi_mapping = list(roi_map.keys())[list(roi_map.values()).index(roi)]
-    challenge_roi = np.asarray(challenge_roi_class == roi_mapping, dtype=int)
-    fsaverage_roi = np.asarray(fsaverage_roi_class == roi_mapping, dtype=int)
+    atlas = load_atlas(os.path.join(args.data_dir, 'roi_masks'), hemisphere)
+    challenge_roi_idxs = atlas.challenge_indices(roi)
+    fsaverage_roi_idxs = atlas.fsaverage_indices(roi)
 
     # Map the fMRI data onto the brain surface map
-    fsaverage_response = np.zeros(len(fsaverage_roi))
+    fsaverage_response = np.zeros(atlas.num_fsaverage_vertices)
     if hemisphere == 'left':
-        fsaverage_response[np.where(fsaverage_roi)[0]] = \
-            lh_fmri[img, np.where(challenge_roi)[0]]
+        fsaverage_response[fsaverage_roi_idxs] = \
+            lh_fmri[img, challenge_roi_idxs]
     elif hemisphere == 'right':
-        fsaverage_response[np.where(fsaverage_roi)[0]] = \
-            rh_fmri[img, np.where(challenge_roi)[0]]
+        fsaverage_response[fsaverage_roi_idxs] = \
+            rh_fmri[img, challenge_roi_idxs]
 
     # Create the interactive brain surface map
     fsaverage = datasets.fetch_surf_fsaverage('fsaverage')
@@ -187,18 +137,16 @@ def plot_predictions(args, lh_correlation, rh_correlation):
                "parietal"]
 
 
-    roi_dir = os.path.join(args.data_dir, 'roi_masks',
-                           hemisphere[0] + 'h.all-vertices_fsaverage_space.npy')
-    fsaverage_all_vertices = np.load(roi_dir)
+    atlas = load_atlas(os.path.join(args.data_dir, 'roi_masks'), hemisphere)
 
 
-    fsaverage_correlation = np.zeros(len(fsaverage_all_vertices))
+    fsaverage_correlation = np.zeros(atlas.num_fsaverage_vertices)
     if hemisphere == 'left':
-        fsaverage_correlation[np.where(fsaverage_all_vertices)[0]] = lh_correlation
-        print(fsaverage_correlation[np.where(fsaverage_all_vertices)])
+        fsaverage_correlation[atlas.fsaverage_vertex_idxs] = lh_correlation
+        print(fsaverage_correlation[atlas.fsaverage_vertex_idxs])
     elif hemisphere == 'right':
-        fsaverage_correlation[np.where(fsaverage_all_vertices)[0]] = rh_correlation
-        print(fsaverage_correlation[np.where(fsaverage_all_vertices)])
+        fsaverage_correlation[atlas.fsaverage_vertex_idxs] = rh_correlation
+        print(fsaverage_correlation[atlas.fsaverage_vertex_idxs])
 
     # Create the interactive brain surface map
     fsaverage = datasets.fetch_surf_fsaverage('fsaverage')
@@ -216,46 +164,14 @@ def plot_predictions(args, lh_correlation, rh_correlation):
 
 def AccuracyROI(args, lh_correlation, rh_correlation):
     print("visualize")
-    # Load the ROI classes mapping dictionaries
-    roi_mapping_files = ['mapping_prf-visualrois.npy', 'mapping_floc-bodies.npy',
-                         'mapping_floc-faces.npy', 'mapping_floc-places.npy',
-                         'mapping_floc-words.npy', 'mapping_streams.npy']
-    roi_name_maps = []
-    for r in roi_mapping_files:
-        roi_name_maps.append(np.load(os.path.join(args.data_dir, 'roi_masks', r),
-                                     allow_pickle=True).item())
-
-    # Load the ROI brain surface maps
-    lh_challenge_roi_files = ['lh.prf-visualrois_challenge_space.npy',
-                              'lh.floc-bodies_challenge_space.npy', 'lh.floc-faces_challenge_space.npy',
-                              'lh.floc-places_challenge_space.npy', 'lh.floc-words_challenge_space.npy',
-                              'lh.streams_challenge_space.npy']
-    rh_challenge_roi_files = ['rh.prf-visualrois_challenge_space.npy',
-                              'rh.floc-bodies_challenge_space.npy', 'rh.floc-faces_challenge_space.npy',
-                              'rh.floc-places_challenge_space.npy', 'rh.floc-words_challenge_space.npy',
-                              'rh.streams_challenge_space.npy']
-    lh_challenge_rois = []
-    rh_challenge_rois = []
-    for r in range(len(lh_challenge_roi_files)):
-        lh_challenge_rois.append(np.load(os.path.join(args.data_dir, 'roi_masks',
-                                                      lh_challenge_roi_files[r])))
-        rh_challenge_rois.append(np.load(os.path.join(args.data_dir, 'roi_masks',
-                                                      rh_challenge_roi_files[r])))
+    # Load the ROI atlases of both hemispheres
+    lh_atlas = load_atlas(os.path.join(args.data_dir, 'roi_masks'), 'left')
+    rh_atlas = load_atlas(os.path.join(args.data_dir, 'roi_masks'), 'right')
 
     # Select the correlation results vertices of each ROI
-    roi_names = []
-    lh_roi_correlation = []
-    rh_roi_correlation = []
-    for r1 in range(len(lh_challenge_rois)):
-        for r2 in roi_name_maps[r1].items():
-            if r2[0] != 0:  # zeros indicate to vertices falling outside the ROI of interest
-                roi_names.append(r2[1])
-                lh_roi_idx = np.where(lh_challenge_rois[r1] == r2[0])[0]
-                rh_roi_idx = np.where(rh_challenge_rois[r1] == r2[0])[0]
-                lh_roi_correlation.append(lh_correlation[lh_roi_idx])
-                rh_roi_correlation.append(rh_correlation[rh_roi_idx])
-                #print(r2, lh_correlation[lh_roi_idx])
-                #print(r2, rh_correlation[rh_roi_idx])
+    roi_names = list(lh_atlas.names)
+    lh_roi_correlation = [lh_correlation[lh_atlas.challenge_indices(roi)] for roi in roi_names]
+    rh_roi_correlation = [rh_correlation[rh_atlas.challenge_indices(roi)] for roi in roi_names]
 
 
     roi_names.append('All vertices')
@@ -301,43 +217,19 @@ def plotFMRI_ROI_IMG(args, lh_fmri, rh_fmri):
     plt.imshow(train_img)
     plt.title('Training image: ' + str(img + 1));
 
-    if roi in ["V1v", "V1d", "V2v", "V2d", "V3v", "V3d", "hV4"]:
-        roi_class = 'prf-visualrois'
-    elif roi in ["EBA", "FBA-1", "FBA-2", "mTL-bodies"]:
-        roi_class = 'floc-bodies'
-    elif roi in ["OFA", "FFA-1", "FFA-2", "mTL-faces", "aTL-faces"]:
-        roi_class = 'floc-faces'
-    elif roi in ["OPA", "PPA", "RSC"]:
-        roi_class = 'floc-places'
-    elif roi in ["OWFA", "VWFA-1", "VWFA-2", "mfs-words", "mTL-words"]:
-        roi_class = 'floc-words'
-    elif roi in ["early", "midventral", "midlateral", "midparietal", "ventral", "lateral", "parietal"]:
-        roi_class = 'streams'
-
-    # Load the ROI brain surface maps
-    challenge_roi_class_dir = os.path.join(args.data_dir, 'roi_masks',
-                                           hemisphere[0] + 'h.' + roi_class + '_challenge_space.npy')
-    fsaverage_roi_class_dir = os.path.join(args.data_dir, 'roi_masks',
-                                           hemisphere[0] + 'h.' + roi_class + '_fsaverage_space.npy')
-    roi_map_dir = os.path.join(args.data_dir, 'roi_masks',
-                               'mapping_' + roi_class + '.npy')
-    challenge_roi_class = np.load(challenge_roi_class_dir)
-    fsaverage_roi_class = np.load(fsaverage_roi_class_dir)
-    roi_map = np.load(roi_map_dir, allow_pickle=True).item()
-
     # Select the vertices corresponding to the ROI of interest
-    roi_mapping = list(roi_map.keys())[list(roi_map.values()).index(roi)]
-    challenge_roi = np.asarray(challenge_roi_class == roi_mapping, dtype=int)
-    fsaverage_roi = np.asarray(fsaverage_roi_class == roi_mapping, dtype=int)
+    atlas = load_atlas(os.path.join(args.data_dir, 'roi_masks'), hemisphere)
+    challenge_roi_idxs = atlas.challenge_indices(roi)
+    fsaverage_roi_idxs = atlas.fsaverage_indices(roi)
 
     # Map the fMRI data onto the brain surface map
-    fsaverage_response = np.zeros(len(fsaverage_roi))
+    fsaverage_response = np.zeros(atlas.num_fsaverage_vertices)
     if hemisphere == 'left':
-        fsaverage_response[np.where(fsaverage_roi)[0]] = \
-            lh_fmri[img, np.where(challenge_roi)[0]]
+        fsaverage_response[fsaverage_roi_idxs] = \
+            lh_fmri[img, challenge_roi_idxs]
     elif hemisphere == 'right':
-        fsaverage_response[np.where(fsaverage_roi)[0]] = \
-            rh_fmri[img, np.where(challenge_roi)[0]]
+        fsaverage_response[fsaverage_roi_idxs] = \
+            rh_fmri[img, challenge_roi_idxs]
 
     # Create the interactive brain surface map
     fsaverage = datasets.fetch_surf_fsaverage('fsaverage')
@@ -364,46 +256,22 @@ def ROI_IMG(args, lh_fmri, rh_fmri):
     # Load the image
     img_dir = 'subj01/training_split/training_images/train-0001_nsd-00013.png'
     train_img = Image.open(img_dir).convert('RGB')
+    atlas = load_atlas(os.path.join(args.data_dir, 'roi_masks'), hemisphere)
     for roi in rois:
-        if roi in ["V1v", "V1d", "V2v", "V2d", "V3v", "V3d", "hV4"]:
-            roi_class = 'prf-visualrois'
-        elif roi in ["EBA", "FBA-1", "FBA-2", "mTL-bodies"]:
-            roi_class = 'floc-bodies'
-        elif roi in ["OFA", "FFA-1", "FFA-2", "mTL-faces", "aTL-faces"]:
-            roi_class = 'floc-faces'
-        elif roi in ["OPA", "PPA", "RSC"]:
-            roi_class = 'floc-places'
-        elif roi in ["OWFA", "VWFA-1", "VWFA-2", "mfs-words", "mTL-words"]:
-            roi_class = 'floc-words'
-        elif roi in ["early", "midventral", "midlateral", "midparietal", "ventral", "lateral", "parietal"]:
-            roi_class = 'streams'
-
-        # Load the ROI brain surface maps
-        challenge_roi_class_dir = os.path.join(args.data_dir, 'roi_masks',
-                                               hemisphere[0] + 'h.' + roi_class + '_challenge_space.npy')
-        fsaverage_roi_class_dir = os.path.join(args.data_dir, 'roi_masks',
-                                               hemisphere[0] + 'h.' + roi_class + '_fsaverage_space.npy')
-        roi_map_dir = os.path.join(args.data_dir, 'roi_masks',
-                                   'mapping_' + roi_class + '.npy')
-        challenge_roi_class = np.load(challenge_roi_class_dir)
-        fsaverage_roi_class = np.load(fsaverage_roi_class_dir)
-        roi_map = np.load(roi_map_dir, allow_pickle=True).item()
-
         # Select the vertices corresponding to the ROI of interest
-        roi_mapping = list(roi_map.keys())[list(roi_map.values()).index(roi)]
-        challenge_roi = np.asarray(challenge_roi_class == roi_mapping, dtype=int)
-        fsaverage_roi = np.asarray(fsaverage_roi_class == roi_mapping, dtype=int)
+        challenge_roi_idxs = atlas.challenge_indices(roi)
+        fsaverage_roi_idxs = atlas.fsaverage_indices(roi)
 
         # Map the fMRI data onto the brain surface map
-        fsaverage_response = np.zeros(len(fsaverage_roi))
+        fsaverage_response = np.zeros(atlas.num_fsaverage_vertices)
         if hemisphere == 'left':
-            fsaverage_response[np.where(fsaverage_roi)[0]] = \
-                lh_fmri[img, np.where(challenge_roi)[0]]
-            #print(fsaverage_response[np.where(fsaverage_roi)[0]])
+            fsaverage_response[fsaverage_roi_idxs] = \
+                lh_fmri[img, challenge_roi_idxs]
+            #print(fsaverage_response[fsaverage_roi_idxs])
             #print(fsaverage_response.sum()/fsaverage_response.__len__())
         elif hemisphere == 'right':
-            fsaverage_response[np.where(fsaverage_roi)[0]] = \
-                rh_fmri[img, np.where(challenge_roi)[0]]
-            #print(fsaverage_response[np.where(fsaverage_roi)[0]])
+            fsaverage_response[fsaverage_roi_idxs] = \
+                rh_fmri[img, challenge_roi_idxs]
+            #print(fsaverage_response[fsaverage_roi_idxs])
             #print(fsaverage_response.sum() / fsaverage_response.__len__())
 
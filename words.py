@@ -1,154 +1,114 @@
-import pandas as pd
-from sklearn.linear_model import LinearRegression
+import numpy as np
+import torch
 from sklearn.metrics import mean_squared_error
-from ultralytics import YOLO
-
+from detections import load_detector
+from ridge import RidgeEncoder, row_chunks
+from categories import words, class_mapping
+
+
+def Predictions(train, train_fmri, val, val_fmri, alpha=0.0, alphas=None, alpha_selection='gcv', chunk_size=None):
+    # Ridge encoder with one factorization of the design shared by all vertices (ridge.py). The default alpha=0 is plain
+    # least squares, the same fit LinearRegression made, a positive alpha shrinks the weights.
+    # With alphas (e.g. ridge.DEFAULT_ALPHAS) every vertex picks its own alpha by GCV or leave-one-out in the same fit.
+    # With chunk_size the training rows are streamed through the fit (ridge.row_chunks), so memory mapped fMRI
+    # (fmri.load_fmri) is read one chunk at a time instead of being loaded whole
+    encoder = RidgeEncoder(alpha, alphas=alphas, alpha_selection=alpha_selection)
+    fit(encoder, train, [train_fmri], chunk_size)
+    if alphas is not None:
+        print("per vertex alpha, median", np.median(encoder.vertex_alpha))
+    ridge_predictions = encoder.predict(val)
+
+    print(val_fmri, "\n _ _ _ _ _ _ _ _ _ _ _ _ _ _ _\n", ridge_predictions)
+    ridge_mse = mean_squared_error(val_fmri, ridge_predictions)
+    print(f'Ridge Mean Squared Error: {ridge_mse}')
+    score = encoder.score(val, val_fmri)
+    print("accuracy score", score)
 
-def Predictions(train, train_fmri, val, val_fmri):
+    return ridge_predictions
 
-    linear_regression_model = LinearRegression()
-    linear_regression_model.fit(train, train_fmri)
-    linear_regression_predictions = linear_regression_model.predict(val)
 
-    print(val_fmri, "\n _ _ _ _ _ _ _ _ _ _ _ _ _ _ _\n", linear_regression_predictions)
-    linear_regression_mse = mean_squared_error(val_fmri, linear_regression_predictions)
-    print(f'Random Forest Mean Squared Error: {linear_regression_mse}')
-    score = linear_regression_model.score(val, val_fmri)
-    print("accuracy score", score)
+def HemispherePredictions(train, lh_train_fmri, rh_train_fmri, val, lh_val_fmri, rh_val_fmri, alpha=0.0, alphas=None,
+                          alpha_selection='gcv', chunk_size=None):
+    # LH and RH share the design matrix, so both are fitted in one pass with one factorization of it.
+    # chunk_size streams the training rows like in Predictions.
+    # Returns (lh, rh) predictions and (lh, rh) (weights, intercept)
+    encoder = RidgeEncoder(alpha, alphas=alphas, alpha_selection=alpha_selection)
+    fit(encoder, train, [lh_train_fmri, rh_train_fmri], chunk_size)
+    predictions = encoder.predict_targets(val)
 
-    return linear_regression_predictions
+    for hemisphere, val_fmri, ridge_predictions in zip(['LH', 'RH'], [lh_val_fmri, rh_val_fmri], predictions):
+        print(hemisphere, val_fmri, "\n _ _ _ _ _ _ _ _ _ _ _ _ _ _ _\n", ridge_predictions)
+        print(f'{hemisphere} Ridge Mean Squared Error: {mean_squared_error(val_fmri, ridge_predictions)}')
+    if alphas is not None:
+        print("per vertex alpha, median", np.median(encoder.vertex_alpha))
 
+    return predictions, encoder.target_weights()
 
-def make_classifications(image_list, idxs, device, batch_size=100):
-    modelYOLO = YOLO('yolov8n.pt')
-    modelYOLO.to(device)
-    results = []
 
-    words = ['furniture', 'food', 'kitchenware', 'appliance', 'person', 'animal', 'vehicle', 'accessory',
-             'electronics', 'sports', 'traffic', 'outdoor', 'home', 'clothing', 'hygiene', 'toy', 'plumbing',
-             'safety', 'luggage', 'computer', 'fruit', 'vegetable', 'tool']
+def fit(encoder, train, targets, chunk_size=None):
+    # In memory, or out of core from (design rows, fMRI rows) chunks; leave-one-out alphas need the in memory fit
+    if chunk_size is None:
+        return encoder.fit_targets(train, targets)
+    return encoder.fit_chunks(row_chunks(train, tuple(targets), chunk_size))
 
-    for start_idx in range(0, len(image_list), batch_size):
-        end_idx = start_idx + batch_size
-        batch_imgs = image_list[start_idx:end_idx]
-        batch_idxs = idxs[start_idx:end_idx]
 
-        image_results = modelYOLO.predict(batch_imgs, stream=True)
+def make_classifications(image_list, idxs, device, batch_size=100, detection_store=None):
+    # Boxes come from the detection store when one is given, otherwise from the process-wide YOLO model.
+    # Only a preprocess='letterbox' store gives the same detections as running YOLO on the image files
+    if detection_store is not None:
+        names = detection_store.names
+        image_boxes = detection_store.detections(image_list, batch_size)
+        batches = (image_boxes[start:start + batch_size] for start in range(0, len(image_boxes), batch_size))
+    else:
+        modelYOLO = load_detector('yolov8n.pt', device)
         names = modelYOLO.names
+        batches = yolo_boxes(modelYOLO, image_list, batch_size)
 
-        for i, result in enumerate(image_results):
-            detection_count = result.boxes.shape[0]
-            image_idx = batch_idxs[i]
-
-            best_confidence = 0.3
-            best_item = None
-            for j in range(len(result.boxes)):
-                confidence = float(result.boxes.conf[j].item())
-                if confidence > best_confidence:
-                    cls = int(result.boxes.cls[j].item())
-                    name = names[cls]
-                    name = class_mapping.get(name)
-                    num = words.index(name)
-                    best_confidence = confidence
-
-                    if best_item is None or confidence > best_item['confidence']:
-                        best_item = {
-                            'cls': cls,
-                            'name': name,
-                            'num': num,
-                            'confidence': confidence
-                        }
-            if best_item:
-                results.append([cls, num])
-            else:
-
-                results.append([-1, -1])
-
-    df = pd.DataFrame(results)
-    df = df.fillna(-1)
-    final = df.to_numpy()
+    # One row per image: [YOLO class id, index in words] of its most confident box, or [-1, -1]
+    class_words = class_word_index(names)
+    final = np.full((len(image_list), 2), -1, dtype=np.int32)
+    start = 0
+    for batch in batches:
+        final[start:start + len(batch)] = select_best_boxes(batch, class_words)
+        start += len(batch)
 
     return final
 
 
-class_mapping = {
-    'chair': 'furniture',
-    'bowl': 'kitchenware',
-    'dining table': 'furniture',
-    'person': 'person',
-    'bird': 'animal',
-    'knife': 'kitchenware',
-    'sink': 'appliance',
-    'horse': 'animal',
-    'cake': 'food',
-    'giraffe': 'animal',
-    'car': 'vehicle',
-    'umbrella': 'accessory',
-    'refrigerator': 'appliance',
-    'cow': 'animal',
-    'dog': 'animal',
-    'tv': 'electronics',
-    'surfboard': 'sports',
-    'cat': 'animal',
-    'stop sign': 'traffic',
-    'train': 'vehicle',
-    'zebra': 'animal',
-    'carrot': 'vegetable',
-    'bicycle': 'vehicle',
-    'sports ball': 'sports',
-    'sheep': 'animal',
-    'motorcycle': 'vehicle',
-    'bottle': 'kitchenware',
-    'sandwich': 'food',
-    'clock': 'home',
-    'bear': 'animal',
-    'truck': 'vehicle',
-    'traffic light': 'traffic',
-    'cell phone': 'electronics',
-    'oven': 'appliance',
-    'cup': 'kitchenware',
-    'couch': 'furniture',
-    'airplane': 'vehicle',
-    'boat': 'vehicle',
-    'bus': 'vehicle',
-    'broccoli': 'vegetable',
-    'tennis racket': 'sports',
-    'elephant': 'animal',
-    'parking meter': 'traffic',
-    'tie': 'clothing',
-    'bed': 'furniture',
-    'toaster': 'appliance',
-    'banana': 'fruit',
-    'toothbrush': 'hygiene',
-    'kite': 'toy',
-    'skateboard': 'sports',
-    'potted plant': 'home',
-    'bench': 'outdoor',
-    'donut': 'food',
-    'spoon': 'kitchenware',
-    'toilet': 'plumbing',
-    'baseball bat': 'sports',
-    'pizza': 'food',
-    'scissors': 'tool',
-    'fire hydrant': 'outdoor',
-    'teddy bear': 'toy',
-    'remote': 'electronics',
-    'apple': 'fruit',
-    'suitcase': 'luggage',
-    'vase': 'home',
-    'skis': 'sports',
-    'hot dog': 'food',
-    'frisbee': 'toy',
-    'backpack': 'luggage',
-    'microwave': 'appliance',
-    'wine glass': 'kitchenware',
-    'snowboard': 'sports',
-    'baseball glove': 'sports',
-    'book': 'toy',
-    'orange': 'fruit',
-    'fork': 'kitchenware',
-    'laptop': 'electronics',
-    'handbag': 'accessory',
-    'keyboard': 'computer',
-    'mouse': 'computer'
-}
+def yolo_boxes(modelYOLO, image_list, batch_size):
+    for start_idx in range(0, len(image_list), batch_size):
+        end_idx = start_idx + batch_size
+        batch_imgs = image_list[start_idx:end_idx]
+
+        yield [result.boxes for result in modelYOLO.predict(batch_imgs, stream=True)]
+
+
+def class_word_index(names):
+    # YOLO class id -> index in words, -1 for classes that have no entry in class_mapping
+    lookup = torch.full((max(names) + 1,), -1, dtype=torch.long)
+    for cls, name in names.items():
+        if class_mapping.get(name) in words:
+            lookup[cls] = words.index(class_mapping[name])
+    return lookup
+
+
+def select_best_boxes(image_boxes, class_words, threshold=0.3):
+    # Pick the most confident box above threshold for every image of the batch with tensor ops
+    num_images = len(image_boxes)
+    counts = torch.tensor([len(boxes.conf) for boxes in image_boxes])
+    conf = torch.cat([boxes.conf.reshape(-1) for boxes in image_boxes]).float().cpu()
+    cls = torch.cat([boxes.cls.reshape(-1) for boxes in image_boxes]).long().cpu()
+    image = torch.repeat_interleave(torch.arange(num_images), counts)
+
+    conf = torch.where(conf > threshold, conf, torch.full_like(conf, -1))
+    best_conf = torch.full((num_images,), -1.0).scatter_reduce(0, image, conf, 'amax')
+    is_best = (conf > threshold) & (conf == best_conf[image])
+    # Ties go to the first box, like the strict > comparison did
+    best_box = torch.full((num_images,), len(conf), dtype=torch.long)
+    best_box = best_box.scatter_reduce(0, image[is_best], torch.arange(len(conf))[is_best], 'amin')
+
+    found = best_box < len(conf)
+    result = torch.full((num_images, 2), -1, dtype=torch.long)
+    result[found, 0] = cls[best_box[found]]
+    result[found, 1] = class_words[result[found, 0]]
+    return result.numpy()